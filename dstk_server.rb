@@ -1292,14 +1292,32 @@ get '/text2times/*' do
   make_json(results, callback)
 end
 
-# Returns a sentiment score for the input text
+# Returns a sentiment score for the input text. If the batch parameter is set, the
+# body should instead be a JSON-encoded array of strings, and an array with a result
+# for each of them is returned
 post '/text2sentiment/?' do
 
   # Pull in the raw data in the body of the request
   text = request.env['rack.input'].read
 
-  score = text2sentiment(text)
-  result = {'score' => score}
+  if params[:batch]
+    begin
+      texts = JSON.parse(text)
+    rescue JSON::ParserError
+      texts = nil
+    end
+    if !texts.is_a?(Array)
+      fatal_error('You need to place the texts as a JSON-encoded array of strings inside the POST body',
+        'json', 500, nil)
+    end
+
+    result = texts.map do |item|
+      {'score' => text2sentiment(item.to_s)}
+    end
+  else
+    score = text2sentiment(text)
+    result = {'score' => score}
+  end
 
   content_type 'application/json'
   make_json(result)
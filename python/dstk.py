@@ -19,17 +19,2967 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import urllib
 try:
   import simplejson as json
 except ImportError:
   import json
 import os
-import httplib
-import mimetypes
 import re
-import csv
+import collections
+import copy
+import sys
+import threading
+import Queue
+import time
+import urlparse
 
+# Modules like httplib, csv and mimetypes take a noticeable time to load, so to keep
+# short command-line runs fast they're only imported by the functions that need them.
+
+
+# Keeps persistent HTTP/1.1 connections open to the DSTK servers, so that repeated
+# calls reuse an existing socket rather than paying for a new TCP handshake every
+# time. It's safe to share between threads. No more than max_size connections are
+# kept in total, and no more than max_per_host to any one server, and callers block
+# until a connection is free if those limits are hit. Connections that have been
+# sitting unused for longer than idle_timeout seconds are closed rather than reused,
+# since the server has probably dropped them by then anyway.
+class ConnectionPool:
+
+  def __init__(self, max_size=10, max_per_host=4, idle_timeout=30):
+    self.max_size = max_size
+    self.max_per_host = max(1, min(max_per_host, max_size))
+    self.idle_timeout = idle_timeout
+    self.condition = threading.Condition()
+    self.idle_connections = {}
+    self.active_counts = {}
+    self.total_count = 0
+
+  # Makes a complete request and returns the status code and the body of the response
+  def request(self, method, url, body=None, headers=None):
+    response = self.urlopen(method, url, body, headers)
+    try:
+      response_string = response.read()
+    finally:
+      response.close()
+    return response.status, response_string
+
+  # Starts a request and returns a PooledResponse that the caller can read from
+  # incrementally. The connection goes back into the pool once it's closed. If a
+  # RequestHandle is passed in, it can be used to cancel the request from another
+  # thread.
+  def urlopen(self, method, url, body=None, headers=None, handle=None):
+    import httplib
+    import socket
+
+    if headers is None:
+      headers = {}
+
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    selector = parts.path or '/'
+    if parts.query:
+      selector += '?'+parts.query
+
+    # The server may have closed a kept-alive connection since we last used it, so
+    # if a reused connection fails we retry once on a brand new one.
+    connection, reused = self.acquire(key)
+    try:
+      if handle is not None:
+        handle.attach(connection)
+      response = self.send_request(connection, method, selector, body, headers)
+    except (socket.error, httplib.HTTPException):
+      self.release(key, connection, False)
+      if not reused or (handle is not None and handle.cancelled):
+        raise
+      connection, reused = self.acquire(key, True)
+      try:
+        if handle is not None:
+          handle.attach(connection)
+        response = self.send_request(connection, method, selector, body, headers)
+      except:
+        self.release(key, connection, False)
+        raise
+    except:
+      self.release(key, connection, False)
+      raise
+
+    return PooledResponse(self, key, connection, response)
+
+  # The body can be a string, or an object like MultipartBody that yields the body
+  # in chunks when it's iterated over, and that can be iterated again if we need to
+  # retry. In that case the headers must include the Content-Length.
+  def send_request(self, connection, method, selector, body, headers):
+    if body is None or isinstance(body, basestring):
+      connection.request(method, selector, body, headers)
+    else:
+      import socket
+
+      # A streamed body goes out in several writes, and Nagle's algorithm would
+      # hold back the small ones until the server acknowledged the earlier ones
+      if connection.sock is None:
+        connection.connect()
+      connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      connection.putrequest(method, selector)
+      for name, value in headers.items():
+        connection.putheader(name, value)
+      connection.endheaders()
+      for chunk in body:
+        connection.send(chunk)
+    return connection.getresponse()
+
+  def acquire(self, key, fresh=False):
+    self.condition.acquire()
+    try:
+      while True:
+        self.close_expired()
+        idle = self.idle_connections.setdefault(key, [])
+        host_count = self.active_counts.get(key, 0)+len(idle)
+        if idle and not fresh:
+          connection, last_used = idle.pop()
+          self.active_counts[key] = self.active_counts.get(key, 0)+1
+          return connection, True
+        if idle:
+          connection, last_used = idle.pop(0)
+          self.close_connection(connection)
+          host_count -= 1
+        if host_count < self.max_per_host:
+          if self.total_count >= self.max_size:
+            self.close_oldest_idle()
+          if self.total_count < self.max_size:
+            connection = self.create_connection(key)
+            self.total_count += 1
+            self.active_counts[key] = self.active_counts.get(key, 0)+1
+            return connection, False
+        self.condition.wait()
+    finally:
+      self.condition.release()
+
+  def release(self, key, connection, reusable):
+    self.condition.acquire()
+    try:
+      self.active_counts[key] -= 1
+      if reusable and connection.sock is not None:
+        self.idle_connections.setdefault(key, []).append((connection, time.time()))
+      else:
+        self.close_connection(connection)
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+  def create_connection(self, key):
+    import httplib
+
+    scheme, netloc = key
+    if scheme == 'https':
+      return httplib.HTTPSConnection(netloc)
+    else:
+      return httplib.HTTPConnection(netloc)
+
+  def close_connection(self, connection):
+    import socket
+
+    self.total_count -= 1
+    try:
+      connection.close()
+    except socket.error:
+      pass
+
+  # Must be called with the condition held
+  def close_expired(self):
+    cutoff = time.time()-self.idle_timeout
+    for key, idle in self.idle_connections.items():
+      fresh_idle = []
+      for connection, last_used in idle:
+        if last_used < cutoff:
+          self.close_connection(connection)
+        else:
+          fresh_idle.append((connection, last_used))
+      self.idle_connections[key] = fresh_idle
+
+  # Must be called with the condition held
+  def close_oldest_idle(self):
+    oldest_key = None
+    oldest_time = None
+    for key, idle in self.idle_connections.items():
+      if idle and (oldest_time is None or idle[0][1] < oldest_time):
+        oldest_key = key
+        oldest_time = idle[0][1]
+    if oldest_key is not None:
+      connection, last_used = self.idle_connections[oldest_key].pop(0)
+      self.close_connection(connection)
+
+  def close(self):
+    self.condition.acquire()
+    try:
+      for key, idle in self.idle_connections.items():
+        for connection, last_used in idle:
+          self.close_connection(connection)
+      self.idle_connections = {}
+      self.condition.notify_all()
+    finally:
+      self.condition.release()
+
+# A response that's being read from a pooled connection. The connection is only
+# handed back for reuse if the whole body has been read, since otherwise the next
+# request on it would see the leftover data.
+class PooledResponse:
+
+  def __init__(self, pool, key, connection, response):
+    self.pool = pool
+    self.key = key
+    self.connection = connection
+    self.response = response
+    self.status = response.status
+    self.reason = response.reason
+    self.bytes_read = 0
+
+  def getheader(self, name, default=None):
+    return self.response.getheader(name, default)
+
+  def read(self, amt=None):
+    data = self.response.read(amt)
+    self.bytes_read += len(data)
+    return data
+
+  def close(self):
+    if self.connection is None:
+      return
+    reusable = self.response.isclosed() and not self.response.will_close
+    if not reusable:
+      self.response.close()
+    self.pool.release(self.key, self.connection, reusable)
+    self.connection = None
+
+# Lets another thread abandon a request that's in progress, by shutting down the
+# socket it's using. The thread making the request will then see a socket error.
+class RequestHandle:
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.cancelled = False
+    self.connection = None
+
+  def attach(self, connection):
+    with self.lock:
+      if self.cancelled:
+        raise RequestCancelled('Request was cancelled')
+      self.connection = connection
+
+  def cancel(self):
+    import socket
+
+    with self.lock:
+      self.cancelled = True
+      if self.connection is not None and self.connection.sock is not None:
+        try:
+          self.connection.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+          pass
+
+class RequestCancelled(Exception):
+  pass
+
+# One of the servers that a ReplicaSet sends requests to
+class Replica:
+
+  def __init__(self, api_base):
+    self.api_base = api_base
+    self.outstanding = 0
+    self.healthy = True
+    self.retry_time = 0
+    self.latencies = collections.deque(maxlen=100)
+
+# Spreads requests across several equivalent DSTK servers. Each request goes to
+# the healthy server with the fewest requests outstanding. If a server fails, it's
+# marked as unhealthy and left alone for retry_interval seconds, after which its
+# /info endpoint is checked in the background to see whether it can be used again.
+#
+# If hedge_percentile is set, and a request has taken longer than that percentile
+# of recent requests, a duplicate is sent to another server and whichever answers
+# first is used. If deadline is set, a request that hasn't been answered within that
+# many seconds fails. In both cases the copies that lose are abandoned by closing
+# their connections. An answer arrives when the server sends its headers, so the
+# deadline doesn't limit how long it then takes to read a large body.
+class ReplicaSet:
+
+  def __init__(self, api_bases, hedge_percentile=None, hedge_min_samples=20,
+    deadline=None, retry_interval=30):
+    self.replicas = [Replica(api_base) for api_base in api_bases]
+    self.hedge_percentile = hedge_percentile
+    self.hedge_min_samples = hedge_min_samples
+    self.deadline = deadline
+    self.retry_interval = retry_interval
+    self.lock = threading.Lock()
+    self.next_index = 0
+
+  # Picks the healthy replica with the fewest outstanding requests, taking turns
+  # between ones that are tied. If none are healthy, the one that failed longest
+  # ago is used, since that's better than giving up.
+  def choose(self, exclude=()):
+    with self.lock:
+      now = time.time()
+      candidates = []
+      for replica in self.replicas:
+        if replica in exclude:
+          continue
+        if replica.healthy:
+          candidates.append(replica)
+        elif replica.retry_time <= now:
+          replica.retry_time = now+self.retry_interval
+          self.start_health_check(replica)
+      if len(candidates) == 0:
+        candidates = [replica for replica in self.replicas if replica not in exclude]
+        candidates.sort(key=lambda replica: replica.retry_time)
+        candidates = candidates[:1]
+      if len(candidates) == 0:
+        return None
+      self.next_index += 1
+      rotated = candidates[self.next_index % len(candidates):]+candidates[:self.next_index % len(candidates)]
+      return min(rotated, key=lambda replica: replica.outstanding)
+
+  def mark_unhealthy(self, replica):
+    with self.lock:
+      replica.healthy = False
+      replica.retry_time = time.time()+self.retry_interval
+
+  def start_health_check(self, replica):
+    thread = threading.Thread(target=self.check_health, args=(replica,))
+    thread.daemon = True
+    thread.start()
+
+  def check_health(self, replica):
+    import httplib
+
+    parts = urlparse.urlsplit(replica.api_base+'/info')
+    try:
+      if parts.scheme == 'https':
+        connection = httplib.HTTPSConnection(parts.netloc, timeout=5)
+      else:
+        connection = httplib.HTTPConnection(parts.netloc, timeout=5)
+      connection.request('GET', parts.path)
+      response = connection.getresponse()
+      info = json.loads(response.read())
+      connection.close()
+      healthy = (response.status == 200 and 'version' in info)
+    except Exception:
+      healthy = False
+    if healthy:
+      with self.lock:
+        replica.healthy = True
+
+  # Returns how long to wait before hedging a request, or None if there aren't
+  # enough recent latencies yet to know what's normal
+  def hedge_delay(self):
+    with self.lock:
+      latencies = []
+      for replica in self.replicas:
+        latencies.extend(replica.latencies)
+    if len(latencies) < self.hedge_min_samples:
+      return None
+    latencies.sort()
+    index = int(len(latencies) * self.hedge_percentile / 100.0)
+    return latencies[min(index, len(latencies)-1)]
+
+  # Calls function(api_base, handle) on one replica and keeps the bookkeeping up to
+  # date. Network errors mark the replica as unhealthy, unless they happened
+  # because we cancelled the request ourselves.
+  def run_on(self, replica, function, handle):
+    import httplib
+    import socket
+
+    with self.lock:
+      replica.outstanding += 1
+    started = time.time()
+    try:
+      result = function(replica.api_base, handle)
+      with self.lock:
+        replica.latencies.append(time.time()-started)
+      return result
+    except (socket.error, httplib.HTTPException):
+      if not handle.cancelled:
+        self.mark_unhealthy(replica)
+      raise
+    finally:
+      with self.lock:
+        replica.outstanding -= 1
+
+  # Runs function(api_base, handle) against the replicas and returns the first
+  # result. If the request fails on one replica it's retried once on another. If
+  # hedge is false, no duplicate requests are sent, for example because the body
+  # can only be read once at a time. Results from copies that lose the race are
+  # passed to discard, so that they can be cleaned up.
+  def run(self, function, hedge=True, discard=None):
+
+    hedge = hedge and self.hedge_percentile is not None and len(self.replicas) > 1
+    if not hedge and self.deadline is None:
+      replica = self.choose()
+      try:
+        return self.run_on(replica, function, RequestHandle())
+      except Exception:
+        other = self.choose((replica,))
+        if other is None:
+          raise
+        return self.run_on(other, function, RequestHandle())
+
+    results = Queue.Queue()
+    state = {'finished': False}
+    handles = []
+    tried = []
+
+    def attempt(replica, handle):
+      try:
+        value = self.run_on(replica, function, handle)
+      except Exception:
+        results.put((False, sys.exc_info()))
+        return
+      with self.lock:
+        lost = state['finished']
+        state['finished'] = True
+      if lost:
+        if discard is not None:
+          discard(value)
+      else:
+        results.put((True, (handle, value)))
+
+    def start(replica):
+      handle = RequestHandle()
+      handles.append(handle)
+      tried.append(replica)
+      thread = threading.Thread(target=attempt, args=(replica, handle))
+      thread.daemon = True
+      thread.start()
+
+    start(self.choose())
+    pending = 1
+    started = time.time()
+    hedge_time = None
+    if hedge:
+      delay = self.hedge_delay()
+      if delay is not None:
+        hedge_time = started+delay
+    deadline_time = None
+    if self.deadline is not None:
+      deadline_time = started+self.deadline
+    last_error = None
+
+    while pending > 0:
+      wake_times = [t for t in (hedge_time, deadline_time) if t is not None]
+      try:
+        if len(wake_times) > 0:
+          succeeded, value = results.get(True, max(0, min(wake_times)-time.time()))
+        else:
+          # Waiting with a timeout keeps the thread responsive to Ctrl-C
+          succeeded, value = results.get(True, 1.0)
+      except Queue.Empty:
+        now = time.time()
+        if deadline_time is not None and now >= deadline_time:
+          with self.lock:
+            state['finished'] = True
+          for handle in handles:
+            handle.cancel()
+          raise Exception('DSTK: No response within the deadline of '+str(self.deadline)+' seconds')
+        if hedge_time is not None and now >= hedge_time:
+          hedge_time = None
+          other = self.choose(tried)
+          if other is not None:
+            start(other)
+            pending += 1
+        continue
+
+      pending -= 1
+      if succeeded:
+        # The winner's body is still to be read, so only the others are stopped
+        winner, value = value
+        for handle in handles:
+          if handle is not winner:
+            handle.cancel()
+        return value
+
+      last_error = value
+      if pending == 0 and len(tried) < 2:
+        other = self.choose(tried)
+        if other is not None:
+          start(other)
+          pending += 1
+
+    error_type, error_value, error_traceback = last_error
+    raise error_type, error_value, error_traceback
+
+# A persistent cache of results, kept in a single SQLite file so that it survives
+# between runs and can be shared by several jobs on the same machine. Entries older
+# than ttl seconds are ignored, and once there are more than max_entries the ones
+# that were least recently used are thrown away. The hits and misses members count
+# how many lookups were answered from the cache and how many weren't.
+class ResponseCache:
+
+  def __init__(self, file_name, ttl=None, max_entries=1000000):
+    import sqlite3
+
+    self.file_name = file_name
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+    self.connection = sqlite3.connect(file_name, check_same_thread=False)
+    self.connection.execute('CREATE TABLE IF NOT EXISTS responses '+
+      '(key TEXT PRIMARY KEY, value TEXT, created REAL, last_used REAL)')
+    self.connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used '+
+      'ON responses (last_used)')
+    self.connection.commit()
+
+  # Returns a dictionary of the cached values for whichever keys were found
+  def get_many(self, keys):
+    found = {}
+    now = time.time()
+    with self.lock:
+      for start in range(0, len(keys), 500):
+        chunk = keys[start:start+500]
+        placeholders = ','.join(['?'] * len(chunk))
+        rows = self.connection.execute('SELECT key, value, created FROM responses '+
+          'WHERE key IN ('+placeholders+')', chunk).fetchall()
+        used = []
+        for key, value, created in rows:
+          if self.ttl is not None and created < (now-self.ttl):
+            continue
+          found[key] = json.loads(value)
+          used.append((now, key))
+        self.connection.executemany('UPDATE responses SET last_used=? WHERE key=?', used)
+      self.connection.commit()
+      self.hits += len(found)
+      self.misses += len(keys)-len(found)
+    return found
+
+  # Stores a dictionary of keys and values, evicting old entries if needed
+  def set_many(self, values):
+    now = time.time()
+    rows = []
+    for key, value in values.items():
+      rows.append((key, json.dumps(value), now, now))
+    with self.lock:
+      self.connection.executemany('INSERT OR REPLACE INTO responses '+
+        '(key, value, created, last_used) VALUES (?, ?, ?, ?)', rows)
+      count = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+      if count > self.max_entries:
+        self.connection.execute('DELETE FROM responses WHERE key IN '+
+          '(SELECT key FROM responses ORDER BY last_used LIMIT ?)',
+          (count-self.max_entries,))
+      self.connection.commit()
+
+  def stats(self):
+    with self.lock:
+      entries = self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+    return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
+
+  def close(self):
+    with self.lock:
+      self.connection.close()
+
+# A bounded in-memory cache that throws away the least recently used entries once
+# it holds more than max_entries. It has the same get_many/set_many interface as
+# ResponseCache, and is safe to share between threads. Values are kept as JSON, so
+# like ResponseCache every lookup returns a fresh copy that callers can change.
+class LRUCache:
+
+  def __init__(self, max_entries=10000):
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+    self.entries = collections.OrderedDict()
+
+  def get_many(self, keys):
+    found = {}
+    with self.lock:
+      for key in keys:
+        if key in self.entries:
+          value = self.entries.pop(key)
+          self.entries[key] = value
+          found[key] = json.loads(value)
+      self.hits += len(found)
+      self.misses += len(keys)-len(found)
+    return found
+
+  def set_many(self, values):
+    with self.lock:
+      for key, value in values.items():
+        self.entries.pop(key, None)
+        self.entries[key] = json.dumps(value)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(False)
+
+  def stats(self):
+    with self.lock:
+      return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+  def close(self):
+    pass
+
+# Answers coordinates2politics and coordinates2statistics for points that fall in
+# a geohash cell the server has already shown to have the same result all over.
+# The check asks the server about a three by three grid of points covering the
+# cell, its corners, edge midpoints and center, so it only pays off for cells that
+# will see more than nine points. A cell is checked once probe_threshold points
+# have landed in it, ten by default, on the basis that a cell that's been that busy
+# so far is likely to see as many again. If all nine give the
+# same answer the cell is taken to lie inside a single area, and the points in it
+# are answered without a request from then on.
+# Otherwise the cell straddles a boundary, and points in it always go to the
+# server.
+#
+# A boundary that crosses a cell without touching any of the sampled points will
+# be missed, so the precision should give cells well below the size of the
+# smallest areas that matter. Precision 7 cells are about 150 meters across.
+# stats() reports the precision, cell size, and how many points were answered
+# from the cache, sent to the server, or sent as extra sample points.
+class SpatialCache:
+
+  PROBING = 'probing'
+  MIXED = 'mixed'
+
+  def __init__(self, precision, max_cells=1000000, probe_threshold=10):
+    self.precision = precision
+    self.max_cells = max_cells
+    self.probe_threshold = probe_threshold
+    self.lock = threading.Lock()
+    # Each cell is mapped to how many points have been seen in it, PROBING while
+    # it's being checked, MIXED, or a tuple holding the answer for the whole cell
+    self.cells = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.probes = 0
+    self.uniform_cells = 0
+    self.mixed_cells = 0
+
+  # Returns the geohash of the cell holding a [latitude, longitude] pair, or None
+  # if it can't be understood as one
+  def cell(self, coordinates):
+    try:
+      latitude = float(coordinates[0])
+      longitude = float(coordinates[1])
+    except (ValueError, TypeError, IndexError):
+      return None
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+      return None
+    return geohash_encode(latitude, longitude, self.precision)
+
+  # Returns the result shared by every point in the cell, or None if there isn't
+  # one yet. The location in the result is replaced with the point's own.
+  def get(self, endpoint, cell, coordinates):
+    with self.lock:
+      state = self.cells.get((endpoint, cell))
+    if not isinstance(state, tuple):
+      return None
+    result = copy.deepcopy(state[0])
+    result['location'] = {'latitude': float(coordinates[0]), 'longitude': float(coordinates[1])}
+    return result
+
+  # Counts more points in the cell, and returns True if it's time to check it
+  def start_probe(self, endpoint, cell, count=1):
+    key = (endpoint, cell)
+    with self.lock:
+      state = self.cells.pop(key, 0)
+      started = False
+      if isinstance(state, int):
+        state += count
+        if state >= self.probe_threshold:
+          state = self.PROBING
+          started = True
+      self.cells[key] = state
+      while len(self.cells) > self.max_cells:
+        self.cells.popitem(False)
+    return started
+
+  # The points a cell is sampled at, as [latitude, longitude] pairs
+  def probe_points(self, cell):
+    south, west, north, east = geohash_bounds(cell)
+    points = []
+    for latitude in (south, (south+north)/2, north):
+      for longitude in (west, (west+east)/2, east):
+        points.append([latitude, longitude])
+    return points
+
+  # Records what the server said for every point sampled in a cell
+  def settle(self, endpoint, cell, results):
+    answers = set()
+    for result in results:
+      if result is MISSING or not isinstance(result, dict):
+        answers.add(None)
+        continue
+      without_location = dict(result)
+      without_location.pop('location', None)
+      answers.add(json.dumps(without_location, sort_keys=True))
+    with self.lock:
+      if len(answers) == 1 and None not in answers:
+        without_location = copy.deepcopy(results[0])
+        without_location.pop('location', None)
+        self.cells[(endpoint, cell)] = (without_location,)
+        self.uniform_cells += 1
+      else:
+        self.cells[(endpoint, cell)] = self.MIXED
+        self.mixed_cells += 1
+
+  # Lets cells whose check failed be checked again later
+  def cancel_probes(self, endpoint, cells):
+    with self.lock:
+      for cell in cells:
+        if self.cells.get((endpoint, cell)) == self.PROBING:
+          self.cells[(endpoint, cell)] = 1
+
+  def record(self, hits, misses, probes):
+    with self.lock:
+      self.hits += hits
+      self.misses += misses
+      self.probes += probes
+
+  def stats(self):
+    lon_bits = (self.precision*5+1) // 2
+    lat_bits = (self.precision*5) // 2
+    cell_width = 360.0 / (1 << lon_bits)
+    cell_height = 180.0 / (1 << lat_bits)
+    with self.lock:
+      lookups = self.hits+self.misses
+      return {
+        'precision': self.precision,
+        'cell_width_degrees': cell_width,
+        'cell_height_degrees': cell_height,
+        # At the equator, cells get narrower towards the poles
+        'cell_width_meters': cell_width*111320,
+        'cell_height_meters': cell_height*110574,
+        'hits': self.hits,
+        'misses': self.misses,
+        'probes': self.probes,
+        'hit_rate': (float(self.hits)/lookups) if lookups else 0.0,
+        'uniform_cells': self.uniform_cells,
+        'mixed_cells': self.mixed_cells,
+      }
+
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def geohash_encode(latitude, longitude, precision):
+  south, north = -90.0, 90.0
+  west, east = -180.0, 180.0
+  characters = []
+  bits = 0
+  bit_count = 0
+  even = True
+  while len(characters) < precision:
+    if even:
+      middle = (west+east)/2
+      if longitude >= middle:
+        bits = (bits << 1) | 1
+        west = middle
+      else:
+        bits = bits << 1
+        east = middle
+    else:
+      middle = (south+north)/2
+      if latitude >= middle:
+        bits = (bits << 1) | 1
+        south = middle
+      else:
+        bits = bits << 1
+        north = middle
+    even = not even
+    bit_count += 1
+    if bit_count == 5:
+      characters.append(GEOHASH_ALPHABET[bits])
+      bits = 0
+      bit_count = 0
+  return ''.join(characters)
+
+# Returns the (south, west, north, east) edges of a geohash cell
+def geohash_bounds(geohash):
+  south, north = -90.0, 90.0
+  west, east = -180.0, 180.0
+  even = True
+  for character in geohash:
+    bits = GEOHASH_ALPHABET.index(character)
+    for shift in range(4, -1, -1):
+      bit = (bits >> shift) & 1
+      if even:
+        middle = (west+east)/2
+        if bit:
+          west = middle
+        else:
+          east = middle
+      else:
+        middle = (south+north)/2
+        if bit:
+          south = middle
+        else:
+          north = middle
+      even = not even
+  return south, west, north, east
+
+# Counts how many values fall into each of a fixed set of buckets, where each bound
+# is the largest value that goes into its bucket, with a final bucket for anything
+# bigger than the last bound. It also keeps the count, sum, minimum and maximum, and
+# can estimate percentiles from the buckets.
+class Histogram:
+
+  def __init__(self, bounds):
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds)+1)
+    self.count = 0
+    self.sum = 0
+    self.min = None
+    self.max = None
+
+  def add(self, value):
+    index = 0
+    while index < len(self.bounds) and value > self.bounds[index]:
+      index += 1
+    self.counts[index] += 1
+    self.count += 1
+    self.sum += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  # Estimates the value that percent of the values are less than or equal to, as
+  # the bound of the bucket it falls in. That's never more than the largest value
+  # seen, which is also the answer for anything past the last bound.
+  def percentile(self, percent):
+    import math
+
+    if self.count == 0:
+      return None
+    rank = max(1, int(math.ceil(self.count * percent / 100.0)))
+    seen = 0
+    for bound, count in zip(self.bounds, self.counts):
+      seen += count
+      if seen >= rank:
+        return min(bound, self.max)
+    return self.max
+
+  def snapshot(self):
+    buckets = collections.OrderedDict()
+    for bound, count in zip(self.bounds, self.counts):
+      buckets[repr(bound)] = count
+    buckets['+Inf'] = self.counts[-1]
+    return {
+      'count': self.count,
+      'sum': self.sum,
+      'min': self.min,
+      'max': self.max,
+      'p50': self.percentile(50),
+      'p90': self.percentile(90),
+      'p99': self.percentile(99),
+      'buckets': buckets,
+    }
+
+# Keeps track of how every request a DSTK object makes performs, broken down by
+# endpoint. For each one it counts the requests, errors, items sent and bytes in
+# each direction, and keeps histograms of how long was spent encoding the request,
+# waiting on the network and decoding the response, along with the number of items
+# in each request. Lookups answered from the caches are counted too, when there are
+# any, and so are inputs that didn't need sending because they repeated an earlier
+# input in the same call. snapshot()
+# returns all of this as a dictionary of plain values, suitable for logging or
+# turning into JSON. Any callbacks that have been added with add_callback are called
+# after every request with the endpoint and a dictionary describing the request, so
+# the numbers can be fed into another monitoring system as they arrive.
+class ClientMetrics:
+
+  LATENCY_BOUNDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0, 30.0]
+  ITEM_BOUNDS = [1, 10, 100, 1000, 10000, 100000]
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.callbacks = []
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.endpoints = {}
+
+  def add_callback(self, callback):
+    self.callbacks.append(callback)
+
+  # Must be called with the lock held
+  def endpoint_stats(self, endpoint):
+    if endpoint not in self.endpoints:
+      self.endpoints[endpoint] = {
+        'requests': 0,
+        'errors': 0,
+        'items': 0,
+        'request_bytes': 0,
+        'response_bytes': 0,
+        'cache_hits': 0,
+        'cache_misses': 0,
+        'dedup_hits': 0,
+        'encode_seconds': Histogram(self.LATENCY_BOUNDS),
+        'network_seconds': Histogram(self.LATENCY_BOUNDS),
+        'decode_seconds': Histogram(self.LATENCY_BOUNDS),
+        'items_per_request': Histogram(self.ITEM_BOUNDS),
+      }
+    return self.endpoints[endpoint]
+
+  def record_request(self, endpoint, encode_seconds, network_seconds, decode_seconds,
+    request_bytes, response_bytes, items, error=None):
+    with self.lock:
+      stats = self.endpoint_stats(endpoint)
+      stats['requests'] += 1
+      stats['items'] += items
+      stats['request_bytes'] += request_bytes
+      stats['response_bytes'] += response_bytes
+      stats['encode_seconds'].add(encode_seconds)
+      stats['network_seconds'].add(network_seconds)
+      stats['decode_seconds'].add(decode_seconds)
+      stats['items_per_request'].add(items)
+      if error is not None:
+        stats['errors'] += 1
+
+    if len(self.callbacks) > 0:
+      sample = {
+        'encode_seconds': encode_seconds,
+        'network_seconds': network_seconds,
+        'decode_seconds': decode_seconds,
+        'request_bytes': request_bytes,
+        'response_bytes': response_bytes,
+        'items': items,
+        'error': error,
+      }
+      for callback in self.callbacks:
+        callback(endpoint, sample)
+
+  def record_cache(self, endpoint, hits, misses, dedup_hits=0):
+    with self.lock:
+      stats = self.endpoint_stats(endpoint)
+      stats['cache_hits'] += hits
+      stats['cache_misses'] += misses
+      stats['dedup_hits'] += dedup_hits
+
+  def snapshot(self):
+    result = {}
+    with self.lock:
+      for endpoint, stats in self.endpoints.items():
+        endpoint_result = {}
+        for key, value in stats.items():
+          if isinstance(value, Histogram):
+            endpoint_result[key] = value.snapshot()
+          else:
+            endpoint_result[key] = value
+        result[endpoint] = endpoint_result
+    return result
+
+# Works out how many requests to keep in flight to each endpoint, and how many
+# items to put in each one, from how the server has been responding. Both limits
+# are kept separately for every endpoint and follow the same additive increase,
+# multiplicative decrease rule that TCP uses. Every request that comes back within
+# target_latency seconds while its endpoint was at its concurrency limit raises
+# that limit by a fraction, adding up to one more request for each round of
+# requests. The batch size also grows by a quarter of its starting size whenever a
+# full batch comes back in less than half the target, so that batches stay well
+# inside it. A request that fails or takes longer than the target halves both, but
+# only once for each round, since the requests that were already in flight when the
+# server slowed down will be slow too.
+#
+# acquire() blocks until the endpoint is under its limit and returns the time the
+# request started, which must be passed to release() once it's finished. limits()
+# reports where every endpoint has settled.
+class ConcurrencyController:
+
+  def __init__(self, initial_concurrency=4, max_concurrency=32, initial_batch_size=100,
+    max_batch_size=10000, target_latency=2.0):
+    self.initial_concurrency = max(1, initial_concurrency)
+    self.max_concurrency = max(self.initial_concurrency, max_concurrency)
+    self.initial_batch_size = max(1, initial_batch_size)
+    self.max_batch_size = max(self.initial_batch_size, max_batch_size)
+    self.batch_increase = max(1, self.initial_batch_size // 4)
+    self.target_latency = target_latency
+    self.condition = threading.Condition()
+    self.endpoints = {}
+
+  # Must be called with the lock held
+  def endpoint_limits(self, endpoint):
+    if endpoint not in self.endpoints:
+      self.endpoints[endpoint] = {
+        'concurrency': float(self.initial_concurrency),
+        'batch_size': float(self.initial_batch_size),
+        'in_flight': 0,
+        'latency': None,
+        'increases': 0,
+        'decreases': 0,
+        'errors': 0,
+        'last_decrease': 0,
+      }
+    return self.endpoints[endpoint]
+
+  def batch_size(self, endpoint):
+    with self.condition:
+      return int(self.endpoint_limits(endpoint)['batch_size'])
+
+  def acquire(self, endpoint):
+    with self.condition:
+      limits = self.endpoint_limits(endpoint)
+      # Waiting with a timeout keeps the main thread responsive to Ctrl-C
+      while limits['in_flight'] >= int(limits['concurrency']):
+        self.condition.wait(1.0)
+      limits['in_flight'] += 1
+    return time.time()
+
+  # Hands back a slot that was acquired but never used for a request
+  def cancel(self, endpoint):
+    with self.condition:
+      self.endpoint_limits(endpoint)['in_flight'] -= 1
+      self.condition.notify_all()
+
+  # Records how a request that started at the given time went, and adjusts the
+  # limits to match. latency defaults to the time since it started.
+  def release(self, endpoint, started, items, failed=False, latency=None):
+    if latency is None:
+      latency = time.time()-started
+    with self.condition:
+      limits = self.endpoint_limits(endpoint)
+      was_full = (limits['in_flight'] >= int(limits['concurrency']))
+      limits['in_flight'] -= 1
+      if limits['latency'] is None:
+        limits['latency'] = latency
+      else:
+        limits['latency'] = (limits['latency'] * 0.8)+(latency * 0.2)
+      if failed:
+        limits['errors'] += 1
+      if failed or latency > self.target_latency:
+        if started >= limits['last_decrease']:
+          limits['concurrency'] = max(1.0, limits['concurrency'] / 2)
+          limits['batch_size'] = max(1.0, limits['batch_size'] / 2)
+          limits['decreases'] += 1
+          limits['last_decrease'] = time.time()
+      else:
+        increased = False
+        if was_full and limits['concurrency'] < self.max_concurrency:
+          limits['concurrency'] = min(self.max_concurrency,
+            limits['concurrency']+(1.0 / limits['concurrency']))
+          increased = True
+        if (items >= int(limits['batch_size']) and latency < (self.target_latency / 2) and
+          limits['batch_size'] < self.max_batch_size):
+          limits['batch_size'] = min(self.max_batch_size,
+            limits['batch_size']+self.batch_increase)
+          increased = True
+        if increased:
+          limits['increases'] += 1
+      self.condition.notify_all()
+
+  def limits(self):
+    result = {}
+    with self.condition:
+      for endpoint, limits in self.endpoints.items():
+        result[endpoint] = {
+          'concurrency': int(limits['concurrency']),
+          'batch_size': int(limits['batch_size']),
+          'in_flight': limits['in_flight'],
+          'latency': limits['latency'],
+          'increases': limits['increases'],
+          'decreases': limits['decreases'],
+          'errors': limits['errors'],
+        }
+    return result
+
+# Builds the cache key for one input. The api_base is included so that results from
+# different servers are never mixed up.
+def make_cache_key(endpoint, api_base, input):
+  key = endpoint+'\n'+api_base+'\n'+input
+  if isinstance(key, str):
+    try:
+      key = key.decode('utf-8')
+    except UnicodeDecodeError:
+      key = key.decode('latin-1')
+  return key
+
+# Answers ip2coordinates lookups from a local file rather than the server. The
+# file is built by compile_ip_database from the GeoLite City CSV files, the same
+# data the server's GeoIP database comes from. It holds three sorted arrays (the
+# first and last address of each range, and which location record the range
+# belongs to) followed by the location records themselves, packed as JSON.
+#
+# The file is memory-mapped, so it's only read from disk as it's used and several
+# processes can share one copy. If numpy is installed, whole lists of addresses
+# are searched in one vectorized pass, otherwise each is found with bisect.
+class IPRangeIndex:
+
+  MAGIC = 'DSTKIP01'
+  HEADER_FORMAT = '<8sII'
+
+  def __init__(self, file_name):
+    import mmap
+    import struct
+
+    self.file = open(file_name, 'rb')
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    header_size = struct.calcsize(self.HEADER_FORMAT)
+    magic, self.range_count, self.record_count = struct.unpack_from(self.HEADER_FORMAT,
+      self.data, 0)
+    if magic != self.MAGIC:
+      raise Exception('DSTK: "'+file_name+'" isn\'t a compiled IP database')
+
+    self.starts_offset = header_size
+    self.ends_offset = self.starts_offset+self.range_count*4
+    self.records_offset = self.ends_offset+self.range_count*4
+    self.record_offsets_offset = self.records_offset+self.range_count*4
+    self.blob_offset = self.record_offsets_offset+(self.record_count+1)*4
+
+    self.decoded_records = {}
+    self.lock = threading.Lock()
+
+    try:
+      import numpy
+    except ImportError:
+      numpy = None
+    self.numpy = numpy
+    if numpy is not None:
+      self.starts = numpy.frombuffer(self.data, numpy.dtype('<u4'), self.range_count,
+        self.starts_offset)
+      self.ends = numpy.frombuffer(self.data, numpy.dtype('<u4'), self.range_count,
+        self.ends_offset)
+      self.records = numpy.frombuffer(self.data, numpy.dtype('<u4'), self.range_count,
+        self.records_offset)
+    else:
+      self.starts = PackedUInt32Array(self.data, self.starts_offset, self.range_count)
+      self.ends = PackedUInt32Array(self.data, self.ends_offset, self.range_count)
+      self.records = PackedUInt32Array(self.data, self.records_offset, self.range_count)
+
+  # Returns a dictionary from each address to its location, in the same format as
+  # the server's ip2coordinates, with None for addresses that aren't found
+  def lookup_many(self, ips):
+
+    keys = []
+    numbers = []
+    for ip in ips:
+      key = ip_response_key(ip)
+      number = ip_to_number(key)
+      if number is not None:
+        keys.append(key)
+        numbers.append(number)
+
+    result = dict((ip_response_key(ip), None) for ip in ips)
+    for key, record_index in zip(keys, self.find_ranges(numbers)):
+      if record_index is not None:
+        result[key] = self.record(record_index)
+    return result
+
+  # Returns the record index for each address, or None if it isn't in any range
+  def find_ranges(self, numbers):
+    if len(numbers) == 0 or self.range_count == 0:
+      return [None] * len(numbers)
+
+    if self.numpy is not None:
+      numpy = self.numpy
+      values = numpy.array(numbers, dtype=numpy.uint32)
+      positions = numpy.searchsorted(self.starts, values, side='right')-1
+      clipped = numpy.maximum(positions, 0)
+      found = (positions >= 0) & (values <= self.ends[clipped])
+      record_indexes = self.records[clipped]
+      return [int(index) if hit else None for index, hit in zip(record_indexes, found)]
+
+    import bisect
+
+    result = []
+    for number in numbers:
+      position = bisect.bisect_right(self.starts, number, 0, self.range_count)-1
+      if position >= 0 and number <= self.ends[position]:
+        result.append(self.records[position])
+      else:
+        result.append(None)
+    return result
+
+  # Decodes a location record, keeping the results since the same few thousand
+  # cities cover most addresses. Each caller gets its own copy of the dictionary.
+  def record(self, index):
+    import struct
+
+    with self.lock:
+      info = self.decoded_records.get(index)
+    if info is None:
+      start, end = struct.unpack_from('<II', self.data, self.record_offsets_offset+index*4)
+      info = json.loads(self.data[self.blob_offset+start:self.blob_offset+end])
+      with self.lock:
+        self.decoded_records[index] = info
+    return dict(info)
+
+  def close(self):
+    self.starts = self.ends = self.records = None
+    self.data.close()
+    self.file.close()
+
+# Lets bisect search an array of little-endian unsigned 32-bit integers packed into
+# a buffer, without unpacking the whole thing
+class PackedUInt32Array:
+
+  def __init__(self, data, offset, count):
+    import struct
+
+    self.unpack_from = struct.Struct('<I').unpack_from
+    self.data = data
+    self.offset = offset
+    self.count = count
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    return self.unpack_from(self.data, self.offset+index*4)[0]
+
+# Converts a dotted IPv4 address into a number, or returns None if it isn't one
+def ip_to_number(ip):
+  parts = ip.split('.')
+  if len(parts) != 4:
+    return None
+  number = 0
+  for part in parts:
+    if not part.isdigit() or int(part) > 255:
+      return None
+    number = (number << 8)+int(part)
+  return number
+
+# Builds a file for IPRangeIndex from the legacy GeoLite City CSV files, which are
+# GeoLiteCity-Blocks.csv (startIpNum, endIpNum, locId) and GeoLiteCity-Location.csv
+# (locId, country, region, city, postalCode, latitude, longitude, metroCode,
+# areaCode). Those don't include the three-letter country codes or country names
+# that the server returns, so they're left as None unless you also pass a CSV file
+# with rows of (country_code, country_code3, country_name).
+def compile_ip_database(blocks_file_name, locations_file_name, output_file_name,
+  countries_file_name=None):
+  import csv
+  import struct
+
+  countries = {}
+  if countries_file_name is not None:
+    for row in csv.reader(open(countries_file_name, 'rb')):
+      if len(row) >= 3:
+        countries[row[0]] = (row[1], row[2].decode('latin-1'))
+
+  def integer_or_zero(value):
+    if value == '':
+      return 0
+    return int(value)
+
+  record_indexes = {}
+  records = []
+  for row in geolite_csv_rows(locations_file_name, 'locId'):
+    location_id, country, region, city, postal_code, latitude, longitude, metro_code, area_code = row[:9]
+    country_code3, country_name = countries.get(country, (None, None))
+    info = {
+      'country_code': country or None,
+      'country_code3': country_code3,
+      'country_name': country_name,
+      'region': region or None,
+      'locality': city.decode('latin-1') or None,
+      'latitude': float(latitude),
+      'longitude': float(longitude),
+      'dma_code': integer_or_zero(metro_code),
+      'area_code': integer_or_zero(area_code),
+      'postal_code': postal_code or None,
+    }
+    record_indexes[location_id] = len(records)
+    records.append(json.dumps(info, separators=(',', ':')))
+
+  ranges = []
+  for row in geolite_csv_rows(blocks_file_name, 'startIpNum'):
+    start, end, location_id = row[:3]
+    if location_id in record_indexes:
+      ranges.append((int(start), int(end), record_indexes[location_id]))
+  ranges.sort()
+
+  output = open(output_file_name+'.tmp', 'wb')
+  output.write(struct.pack(IPRangeIndex.HEADER_FORMAT, IPRangeIndex.MAGIC, len(ranges),
+    len(records)))
+  for column in range(3):
+    output.write(struct.pack('<'+str(len(ranges))+'I', *[item[column] for item in ranges]))
+  offset = 0
+  offsets = [0]
+  for record in records:
+    offset += len(record)
+    offsets.append(offset)
+  output.write(struct.pack('<'+str(len(offsets))+'I', *offsets))
+  for record in records:
+    output.write(record)
+  output.close()
+  os.rename(output_file_name+'.tmp', output_file_name)
+
+  return len(ranges)
+
+# Yields the rows of a GeoLite CSV file after its header, skipping the copyright
+# notice that comes before it
+def geolite_csv_rows(file_name, first_column):
+  import csv
+
+  in_header = True
+  for row in csv.reader(open(file_name, 'rb')):
+    if in_header:
+      if len(row) > 0 and row[0] == first_column:
+        in_header = False
+      continue
+    if len(row) > 0:
+      yield row
+
+# The friendly names the server gives to each type of political area
+POLITICS_FRIENDLY_TYPES = {
+  'admin2': 'country',
+  'admin4': 'state',
+  'admin6': 'county',
+  'admin5': 'city',
+  'admin8': 'city',
+}
+
+# Answers coordinates2politics lookups from boundary polygons held in memory,
+# instead of the server's PostGIS queries. The polygons are read once from GeoJSON
+# files, where each feature's properties give its 'name', 'code' and 'type' (such
+# as 'admin2' for countries or 'admin4' for states). Features without a type but
+# with a 'country_code', like the server's world_countries table, are treated as
+# countries.
+#
+# Each polygon's bounding box is worked out up front, and the polygons are filed
+# in a uniform grid of cell_size degree cells under every cell their box touches.
+# A batch of points is first matched to the polygons in its cells and boxes, and
+# then every point that might lie in a polygon is tested against all of its edges
+# at once, using numpy if it's installed.
+#
+# Like the server's ST_DWithin queries, points just outside a polygon still match
+# it if they're within TOLERANCES degrees of its boundary, which depends on the
+# type of area.
+class PoliticsIndex:
+
+  # Roughly how many point and edge comparisons to do in one numpy operation, to
+  # limit the size of the temporary arrays
+  MAX_COMPARISONS = 1000000
+
+  # The distances coordinates2politics.rb uses for countries and neighborhoods,
+  # and DEFAULT_TOLERANCE for every other kind of area
+  TOLERANCES = {'admin2': 0.1, 'neighborhood': 0.0001}
+  DEFAULT_TOLERANCE = 0.01
+
+  def __init__(self, file_names, cell_size=1.0):
+    try:
+      import numpy
+    except ImportError:
+      numpy = None
+    self.numpy = numpy
+
+    self.cell_size = cell_size
+    self.areas = []
+    self.boxes = []
+    self.edges = []
+    self.tolerances = []
+    self.grid = {}
+
+    if isinstance(file_names, basestring):
+      file_names = [file_names]
+    for file_name in file_names:
+      self.load_geojson(file_name)
+
+  def load_geojson(self, file_name):
+    data = json.load(open(file_name, 'rb'))
+    if data.get('type') == 'FeatureCollection':
+      features = data['features']
+    else:
+      features = [data]
+
+    for feature in features:
+      geometry = feature.get('geometry')
+      if geometry is None:
+        continue
+      if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+      elif geometry['type'] == 'MultiPolygon':
+        polygons = geometry['coordinates']
+      else:
+        continue
+
+      properties = feature.get('properties') or {}
+      area_type = properties.get('type')
+      code = properties.get('code')
+      if area_type is None and 'country_code' in properties:
+        area_type = 'admin2'
+        code = properties['country_code']
+      area = {
+        'name': properties.get('name'),
+        'code': (code or '').lower(),
+        'type': area_type,
+        'friendly_type': POLITICS_FRIENDLY_TYPES.get(area_type, area_type),
+      }
+
+      # Every part of a multi-polygon is indexed separately, but they all point
+      # back to the same area
+      for rings in polygons:
+        self.add_polygon(area, rings)
+
+  def add_polygon(self, area, rings):
+    x1 = []
+    y1 = []
+    x2 = []
+    y2 = []
+    for ring in rings:
+      for index in range(len(ring)):
+        start = ring[index-1]
+        end = ring[index]
+        x1.append(float(start[0]))
+        y1.append(float(start[1]))
+        x2.append(float(end[0]))
+        y2.append(float(end[1]))
+    if len(x1) == 0:
+      return
+
+    # The box is widened by the tolerance, so it covers every point that can match
+    tolerance = self.TOLERANCES.get(area['type'], self.DEFAULT_TOLERANCE)
+    box = (min(x1)-tolerance, min(y1)-tolerance, max(x1)+tolerance, max(y1)+tolerance)
+    if self.numpy is not None:
+      edges = tuple(self.numpy.array(values) for values in (x1, y1, x2, y2))
+    else:
+      edges = zip(x1, y1, x2, y2)
+
+    polygon_index = len(self.areas)
+    self.areas.append(area)
+    self.boxes.append(box)
+    self.edges.append(edges)
+    self.tolerances.append(tolerance)
+
+    min_x, min_y, max_x, max_y = [self.cell(value) for value in box]
+    for cell_x in range(min_x, max_x+1):
+      for cell_y in range(min_y, max_y+1):
+        self.grid.setdefault((cell_x, cell_y), []).append(polygon_index)
+
+  def cell(self, value):
+    import math
+
+    return int(math.floor(value / self.cell_size))
+
+  # Returns a list with a {location, politics} dictionary for each [latitude,
+  # longitude] pair, in the same format as the server's coordinates2politics
+  def lookup_many(self, coordinates):
+
+    locations = []
+    for pair in coordinates:
+      if isinstance(pair, basestring):
+        pair = pair.split(',')
+      locations.append({'latitude': float(pair[0]), 'longitude': float(pair[1])})
+
+    # Collect the points that fall inside each polygon's box, so that each polygon
+    # is only tested once per batch
+    candidates = {}
+    for point_index, location in enumerate(locations):
+      x = location['longitude']
+      y = location['latitude']
+      for polygon_index in self.grid.get((self.cell(x), self.cell(y)), ()):
+        min_x, min_y, max_x, max_y = self.boxes[polygon_index]
+        if min_x <= x <= max_x and min_y <= y <= max_y:
+          candidates.setdefault(polygon_index, []).append(point_index)
+
+    matches = [[] for location in locations]
+    for polygon_index in sorted(candidates.keys()):
+      point_indexes = candidates[polygon_index]
+      xs = [locations[point_index]['longitude'] for point_index in point_indexes]
+      ys = [locations[point_index]['latitude'] for point_index in point_indexes]
+      for point_index, inside in zip(point_indexes, self.contains(polygon_index, xs, ys)):
+        if inside:
+          matches[point_index].append(polygon_index)
+
+    result = []
+    for location, polygon_indexes in zip(locations, matches):
+      result.append({
+        'location': location,
+        'politics': self.politics(polygon_indexes),
+      })
+    return result
+
+  # Builds the list of areas for one point, countries first as the server does,
+  # and with each area listed once even if the point is in several of its parts
+  def politics(self, polygon_indexes):
+    if len(polygon_indexes) == 0:
+      return None
+    countries = []
+    others = []
+    seen = set()
+    for polygon_index in polygon_indexes:
+      area = self.areas[polygon_index]
+      if id(area) in seen:
+        continue
+      seen.add(id(area))
+      if area['type'] == 'admin2':
+        countries.append(dict(area))
+      else:
+        others.append(dict(area))
+    return countries+others
+
+  # Tests which of the points lie inside the polygon, by counting how many of its
+  # edges a ray from each point crosses, or within its tolerance of an edge. Holes
+  # are handled by including their edges in the count too.
+  def contains(self, polygon_index, xs, ys):
+    if self.numpy is None:
+      return [self.contains_point(polygon_index, x, y) for x, y in zip(xs, ys)]
+
+    numpy = self.numpy
+    x1, y1, x2, y2 = self.edges[polygon_index]
+    tolerance = self.tolerances[polygon_index]
+    edge_x = x2-x1
+    edge_y = y2-y1
+    edge_length_squared = edge_x * edge_x + edge_y * edge_y
+    result = []
+    step = max(1, self.MAX_COMPARISONS // len(x1))
+    for start in range(0, len(xs), step):
+      px = numpy.array(xs[start:start+step])[:, None]
+      py = numpy.array(ys[start:start+step])[:, None]
+      straddles = (y1 > py) != (y2 > py)
+      # Horizontal edges never straddle, and zero length edges are only as far
+      # away as their start, so the division by zero they cause is masked out.
+      # Comparing against the NaNs it leaves behind would warn too.
+      with numpy.errstate(divide='ignore', invalid='ignore'):
+        crossing_x = edge_x * (py-y1) / edge_y + x1
+        along = ((px-x1) * edge_x + (py-y1) * edge_y) / edge_length_squared
+        crossings = (straddles & (px < crossing_x)).sum(axis=1)
+      along = numpy.clip(numpy.nan_to_num(along), 0, 1)
+      nearest_x = x1+along * edge_x-px
+      nearest_y = y1+along * edge_y-py
+      near = (nearest_x * nearest_x + nearest_y * nearest_y).min(axis=1) <= tolerance * tolerance
+      result.extend(((crossings % 2 == 1) | near).tolist())
+    return result
+
+  def contains_point(self, polygon_index, x, y):
+    tolerance_squared = self.tolerances[polygon_index] ** 2
+    inside = False
+    near = False
+    for x1, y1, x2, y2 in self.edges[polygon_index]:
+      if (y1 > y) != (y2 > y):
+        if x < (x2-x1) * (y-y1) / (y2-y1) + x1:
+          inside = not inside
+      if not near:
+        near = (segment_distance_squared(x, y, x1, y1, x2, y2) <= tolerance_squared)
+    return inside or near
+
+# The square of the distance from a point to the nearest point on a line segment
+def segment_distance_squared(x, y, x1, y1, x2, y2):
+  edge_x = x2-x1
+  edge_y = y2-y1
+  length_squared = edge_x * edge_x + edge_y * edge_y
+  along = 0.0
+  if length_squared > 0:
+    along = min(1.0, max(0.0, ((x-x1) * edge_x + (y-y1) * edge_y) / length_squared))
+  nearest_x = x1+along * edge_x-x
+  nearest_y = y1+along * edge_y-y
+  return nearest_x * nearest_x + nearest_y * nearest_y
+
+# The statistics the server's coordinates2statistics knows about, from
+# AVAILABLE_STATISTICS in coordinates2statistics.rb. Each one is read from the
+# raster layer named by 'table', or by the statistic itself if there isn't one, and
+# statistics with a 'frequency' have that many monthly layers, named like
+# 'mean_temperature_01'. Values with 'divide_by' are reported as a proportion of
+# the other statistic at the same point.
+US_CENSUS_SOURCE = 'US Census and the CGIAR Consortium for Spatial Information'
+US_CENSUS_SOURCE_URL = 'http://sedac.ciesin.columbia.edu/data/collection/usgrid/sets/browse'
+
+AVAILABLE_STATISTICS = {
+  'population_density': {
+    'description': 'The number of inhabitants per square kilometer around this point.',
+    'source_name': u'NASA Socioeconomic Data and Applications Center (SEDAC) \u2013 Hosted by CIESIN at Columbia University',
+    'source_url': 'http://sedac.ciesin.columbia.edu/data/set/gpw-v3-population-density',
+  },
+  'land_cover': {
+    'description': 'What type of environment exists around this point - urban, water, vegetation, mountains, etc.',
+    'source_name': 'European Commission Land Resource Management Unit Global Land Cover 2000',
+    'source_url': 'http://bioval.jrc.ec.europa.eu/products/glc2000/products.php',
+    'translation_table': {
+      1: 'Tree Cover, broadleaved, evergreen',
+      2: 'Tree Cover, broadleaved, deciduous, closed',
+      3: 'Tree Cover, broadleaved, deciduous, open',
+      4: 'Tree Cover, needle-leaved, evergreen',
+      5: 'Tree Cover, needle-leaved, deciduous',
+      6: 'Tree Cover, mixed leaf type',
+      7: 'Tree Cover, regularly flooded, fresh',
+      8: 'Tree Cover, regularly flooded, saline, (daily variation)',
+      9: 'Mosaic: Tree cover / Other natural vegetation',
+      10: 'Tree Cover, burnt',
+      11: 'Shrub Cover, closed-open, evergreen',
+      12: 'Shrub Cover, closed-open, deciduous',
+      13: 'Herbaceous Cover, closed-open',
+      14: 'Sparse Herbaceous or sparse shrub cover',
+      15: 'Regularly flooded shrub and/or herbaceous cover',
+      16: 'Cultivated and managed areas',
+      17: 'Mosaic: Cropland / Tree Cover / Other Natural Vegetation',
+      18: 'Mosaic: Cropland / Shrub and/or Herbaceous cover',
+      19: 'Bare Areas',
+      20: 'Water Bodies',
+      21: 'Snow and Ice',
+      22: 'Artificial surfaces and associated areas',
+      23: 'No data',
+    },
+  },
+  'elevation': {
+    'description': 'The height of the surface above sea level at this point.',
+    'source_name': 'NASA and the CGIAR Consortium for Spatial Information',
+    'source_url': 'http://srtm.csi.cgiar.org/',
+    'units': 'meters',
+  },
+  'mean_temperature': {
+    'description': 'The mean monthly temperature at this point.',
+    'source_name': 'WorldClim',
+    'source_url': 'http://worldclim.org/',
+    'frequency': 12,
+    'units': 'degrees Celsius',
+    'scale': 0.1,
+  },
+  'precipitation': {
+    'description': 'The monthly average total precipitation at this point.',
+    'source_name': 'WorldClim',
+    'source_url': 'http://worldclim.org/',
+    'frequency': 12,
+    'units': 'millimeters',
+  },
+  'us_population_under_one_year_old': {
+    'description': 'The proportion of residents under one year of age.',
+    'table': 'usa100',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_one_to_four_years_olds': {
+    'description': 'The proportion of residents aged one to four years old.',
+    'table': 'usa200',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_five_to_seventeen_years_old': {
+    'description': 'The proportion of residents aged five to seventeen years old.',
+    'table': 'usa300',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_eighteen_to_twenty_four_years_old': {
+    'description': 'The proportion of residents aged eighteen to twenty four years old.',
+    'table': 'usa400',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_twenty_five_to_sixty_four_years_old': {
+    'description': 'The proportion of residents aged twenty five to sixty four years old.',
+    'table': 'usa500',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_sixty_five_to_seventy_nine_years_old': {
+    'description': 'The proportion of residents aged sixty five to seventy nine years old.',
+    'table': 'usa600',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_over_seventy_nine_years_old': {
+    'description': 'The proportion of residents over seventy nine years old.',
+    'table': 'usa700',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_sample_area': {
+    'description': 'The total area of the grid cell US Census samples were calculated on.',
+    'table': 'usarea00',
+    'units': 'square meters',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_asian': {
+    'description': 'The proportion of residents identifying as Asian.',
+    'table': 'usas00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_bachelors_degree': {
+    'description': 'The proportion of residents whose maximum educational attainment was a bachelor\'s degree.',
+    'table': 'usba00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_black_or_african_american': {
+    'description': 'The proportion of residents identifying as black or African American.',
+    'table': 'usbl00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_foreign_born': {
+    'description': 'The proportion of residents who were born in a different country.',
+    'table': 'usfb00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_households_single_mothers': {
+    'description': 'The proportion of households with a female householder, no husband, and one or more children under eighteen.',
+    'table': 'usfem00',
+    'divide_by': 'us_households',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_housing_units_after_1990': {
+    'description': 'The proportion of housing units built after 1990.',
+    'table': 'usha100',
+    'divide_by': 'us_housing_units',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_housing_units_1970_to_1989': {
+    'description': 'The proportion of housing units built between 1970 and 1989.',
+    'table': 'usha200',
+    'divide_by': 'us_housing_units',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_housing_units_1950_to_1969': {
+    'description': 'The proportion of housing units built between 1950 and 1969.',
+    'table': 'usha300',
+    'divide_by': 'us_housing_units',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_housing_units_before_1950': {
+    'description': 'The proportion of housing units built before 1950.',
+    'table': 'usha400',
+    'divide_by': 'us_housing_units',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_households': {
+    'description': 'The number of households in this area.',
+    'table': 'ushh00',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_hispanic_or_latino': {
+    'description': 'The proportion of residents who identify themselves as hispanic or latino.',
+    'table': 'ushi00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_housing_units': {
+    'description': 'The total number of housing units in this area',
+    'table': 'ushu00',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_housing_units_one_person': {
+    'description': 'The proportion of housing units containing only one person',
+    'table': 'ushu1p00',
+    'divide_by': 'us_housing_units',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_housing_units_no_vehicle': {
+    'description': 'The proportion of occupied housing units with no vehicle available.',
+    'table': 'ushunv00',
+    'divide_by': 'us_housing_units',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_households_linguistically_isolated': {
+    'description': 'The proportion of households in which no one aged 14 or older speaks English very well',
+    'table': 'usliso00',
+    'divide_by': 'us_households',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_low_income': {
+    'description': 'The proportion of residents who earn less than twice the poverty level',
+    'table': 'uslowi00',
+    'divide_by': 'us_population',
+  },
+  'us_population_black_or_african_american_not_hispanic': {
+    'description': 'The proportion of residents who didn\'t identify as hispanic or latino, just black or African American alone',
+    'table': 'usnhb00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_white_not_hispanic': {
+    'description': 'The proportion of residents who didn\'t identify as hispanic or latino, just white alone',
+    'table': 'usnhw00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_housing_units_occupied': {
+    'description': 'The proportion of housing units that are occupied.',
+    'table': 'usocc00',
+    'divide_by': 'us_housing_units',
+  },
+  'us_housing_units_owner_occupied': {
+    'description': 'The proportion of housing units that are occupied by their owners.',
+    'table': 'usown00',
+    'divide_by': 'us_housing_units',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_native_hawaiian_and_other_pacific_islander': {
+    'description': 'The proportion of residents who identify as Native Hawaiian or other Pacific islander.',
+    'table': 'uspi00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population': {
+    'description': 'The number of residents in this area',
+    'table': 'uspop00',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_poverty': {
+    'description': 'The proportion of residents whose income is below the poverty level',
+    'table': 'uspov00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_housing_units_vacation': {
+    'description': 'The number of vacant housing units that are used for seasonal, recreational, or occasional use.',
+    'table': 'ussea00',
+    'divide_by': 'us_housing_units',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_severe_poverty': {
+    'description': 'The proportion of residents whose income is below half the poverty level.',
+    'table': 'ussevp00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+  'us_population_white': {
+    'description': 'The proportion of residents who identify themselves as white.',
+    'table': 'uswh00',
+    'divide_by': 'us_population',
+    'source_name': US_CENSUS_SOURCE,
+    'source_url': US_CENSUS_SOURCE_URL,
+  },
+}
+
+# Answers coordinates2statistics from raster files on disk, instead of the
+# server's PostGIS queries. The directory holds one layer per table, in the ESRI
+# GridFloat format that 'gdal_translate -of EHdr -ot Float32' writes, so the
+# server's elevation layer is in 'elevation.flt' and 'elevation.hdr', and the
+# January mean temperature in 'mean_temperature_01.flt' and '.hdr'.
+#
+# Layers are memory-mapped when they're first needed, so only the pages holding
+# the sampled pixels are ever read, and statistics that aren't asked for cost
+# nothing. The pixel indexes for a whole batch of points are worked out once for
+# each layer geometry, and if numpy is installed every layer is then sampled with a
+# single vectorized gather, otherwise the pixels are unpacked one by one.
+#
+# As on the server, points outside a layer get no value from it, and pixels with
+# no data count as zero.
+class StatisticsIndex:
+
+  def __init__(self, directory):
+    try:
+      import numpy
+    except ImportError:
+      numpy = None
+    self.numpy = numpy
+
+    self.directory = directory
+    self.layers = {}
+    self.lock = threading.Lock()
+
+  # Returns the names of the statistics that have all their layers in the directory
+  def available_statistics(self):
+    result = []
+    for statistic in sorted(AVAILABLE_STATISTICS.keys()):
+      if all(os.path.exists(self.layer_file_name(table, '.hdr'))
+        for table in self.tables(statistic)):
+        result.append(statistic)
+    return result
+
+  def tables(self, statistic):
+    info = AVAILABLE_STATISTICS[statistic]
+    table = info.get('table', statistic)
+    if 'frequency' in info:
+      return [table+'_%02d' % (offset+1) for offset in range(info['frequency'])]
+    return [table]
+
+  def layer_file_name(self, table, extension):
+    return os.path.join(self.directory, table+extension)
+
+  def layer(self, table):
+    with self.lock:
+      layer = self.layers.get(table)
+      if layer is None:
+        if not os.path.exists(self.layer_file_name(table, '.hdr')):
+          raise Exception('DSTK: No raster layer for "'+table+'" found in "'+self.directory+'"')
+        layer = RasterLayer(self.layer_file_name(table, ''), self.numpy)
+        self.layers[table] = layer
+      return layer
+
+  # Returns a list with a {location, statistics} dictionary for each [latitude,
+  # longitude] pair, in the same format as the server's coordinates2statistics.
+  # The statistics can be a list of names, and default to every one that has its
+  # layers in the directory.
+  def lookup_many(self, coordinates, statistics=None):
+
+    if statistics is None:
+      statistics = self.available_statistics()
+    wanted = []
+    for statistic in statistics:
+      if statistic not in AVAILABLE_STATISTICS:
+        raise Exception('DSTK: coordinates2statistics - \''+statistic+'\' is not recognized, use one of '+
+          ', '.join(sorted(AVAILABLE_STATISTICS.keys())))
+      if statistic not in wanted:
+        wanted.append(statistic)
+    # Proportions need the totals they're divided by, which are returned too
+    for statistic in list(wanted):
+      dependency = AVAILABLE_STATISTICS[statistic].get('divide_by')
+      if dependency is not None and dependency not in wanted:
+        wanted.append(dependency)
+
+    locations = []
+    for pair in coordinates:
+      if isinstance(pair, basestring):
+        pair = pair.split(',')
+      locations.append({'latitude': float(pair[0]), 'longitude': float(pair[1])})
+    latitudes = [location['latitude'] for location in locations]
+    longitudes = [location['longitude'] for location in locations]
+
+    # Layers that cover the same grid share their pixel indexes
+    pixels = {}
+    samples = {}
+    for statistic in wanted:
+      for table in self.tables(statistic):
+        layer = self.layer(table)
+        if layer.geometry not in pixels:
+          pixels[layer.geometry] = layer.pixel_indexes(latitudes, longitudes)
+        samples[table] = layer.sample(*pixels[layer.geometry])
+
+    result = []
+    for point_index, location in enumerate(locations):
+      raw = {}
+      for statistic in wanted:
+        info = AVAILABLE_STATISTICS[statistic]
+        if 'frequency' in info:
+          value = [samples[table][point_index] for table in self.tables(statistic)]
+          value = [month for month in value if month is not None]
+        else:
+          value = samples[self.tables(statistic)[0]][point_index]
+          if value is None:
+            continue
+        raw[statistic] = value
+
+      point_statistics = {}
+      for statistic, value in raw.items():
+        info = AVAILABLE_STATISTICS[statistic]
+        output = {
+          'value': value,
+          'description': info['description'],
+          'source_name': info.get('source_name'),
+        }
+        if 'units' in info:
+          output['units'] = info['units']
+        if 'divide_by' in info:
+          dependency_value = raw.get(info['divide_by'])
+          if not dependency_value:
+            continue
+          output['value'] = value / float(dependency_value)
+          output['proportion_of'] = dependency_value
+        elif 'translation_table' in info:
+          output['value'] = info['translation_table'].get(value)
+          output['index'] = value
+        if 'scale' in info:
+          if isinstance(output['value'], list):
+            output['value'] = [month * info['scale'] for month in output['value']]
+          else:
+            output['value'] = output['value'] * info['scale']
+        point_statistics[statistic] = output
+
+      result.append({'location': location, 'statistics': point_statistics})
+    return result
+
+  def close(self):
+    with self.lock:
+      for layer in self.layers.values():
+        layer.close()
+      self.layers = {}
+
+# One raster layer in ESRI GridFloat format, a '.flt' file of 32-bit floats in rows
+# from north to south, described by a '.hdr' text file with ncols, nrows,
+# xllcorner, yllcorner, cellsize, nodata_value and byteorder lines.
+class RasterLayer:
+
+  def __init__(self, file_name_base, numpy=None):
+    import mmap
+
+    header = {}
+    for line in open(file_name_base+'.hdr', 'rb'):
+      parts = line.split()
+      if len(parts) >= 2:
+        header[parts[0].lower()] = parts[1]
+
+    self.columns = int(header['ncols'])
+    self.rows = int(header['nrows'])
+    self.cell_size = float(header['cellsize'])
+    if 'xllcenter' in header:
+      self.west = float(header['xllcenter'])-self.cell_size/2
+    else:
+      self.west = float(header['xllcorner'])
+    if 'yllcenter' in header:
+      south = float(header['yllcenter'])-self.cell_size/2
+    else:
+      south = float(header['yllcorner'])
+    self.north = south+self.rows*self.cell_size
+    if 'nodata_value' in header:
+      self.nodata = float(header['nodata_value'])
+    else:
+      self.nodata = None
+    if header.get('byteorder', 'LSBFIRST').upper() in ('MSBFIRST', 'M'):
+      self.byte_order = '>'
+    else:
+      self.byte_order = '<'
+    self.geometry = (self.west, self.north, self.cell_size, self.columns, self.rows)
+
+    self.file = open(file_name_base+'.flt', 'rb')
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(self.data) < self.columns*self.rows*4:
+      raise Exception('DSTK: "'+file_name_base+'.flt" is smaller than its header says')
+
+    self.numpy = numpy
+    if numpy is not None:
+      self.pixels = numpy.frombuffer(self.data, numpy.dtype(self.byte_order+'f4'),
+        self.columns*self.rows).reshape(self.rows, self.columns)
+
+  # Works out which pixel each point falls in. Returns the row and column of each
+  # point inside the layer, and the positions in the list of those points.
+  def pixel_indexes(self, latitudes, longitudes):
+    if self.numpy is not None:
+      numpy = self.numpy
+      rows = numpy.floor((self.north-numpy.array(latitudes, dtype=float)) / self.cell_size)
+      columns = numpy.floor((numpy.array(longitudes, dtype=float)-self.west) / self.cell_size)
+      inside = (rows >= 0) & (rows < self.rows) & (columns >= 0) & (columns < self.columns)
+      positions = numpy.nonzero(inside)[0]
+      return (rows[positions].astype(numpy.intp), columns[positions].astype(numpy.intp),
+        positions, len(latitudes))
+
+    import math
+
+    rows = []
+    columns = []
+    positions = []
+    for position, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+      row = int(math.floor((self.north-latitude) / self.cell_size))
+      column = int(math.floor((longitude-self.west) / self.cell_size))
+      if 0 <= row < self.rows and 0 <= column < self.columns:
+        rows.append(row)
+        columns.append(column)
+        positions.append(position)
+    return rows, columns, positions, len(latitudes)
+
+  # Returns the value of the pixel under each point, truncated to an integer as the
+  # server does, or None for points outside the layer
+  def sample(self, rows, columns, positions, count):
+    result = [None] * count
+    if len(positions) == 0:
+      return result
+
+    if self.numpy is not None:
+      numpy = self.numpy
+      values = self.pixels[rows, columns].astype(float)
+      missing = numpy.isnan(values)
+      if self.nodata is not None:
+        missing |= (values == self.nodata)
+      values[missing] = 0
+      for position, value in zip(positions.tolist(), numpy.trunc(values).astype(numpy.int64).tolist()):
+        result[position] = value
+      return result
+
+    import struct
+
+    unpack_from = struct.Struct(self.byte_order+'f').unpack_from
+    for row, column, position in zip(rows, columns, positions):
+      value = unpack_from(self.data, (row*self.columns+column)*4)[0]
+      if value != value or value == self.nodata:
+        value = 0
+      result[position] = int(value)
+    return result
+
+  def close(self):
+    self.pixels = None
+    self.data.close()
+    self.file.close()
+
+# Finds the places mentioned in text without contacting the server, following the
+# same rules as find_locations_in_text in geodict_lib.rb, so the results match the
+# server's text2places. The country, region, city and postal code dictionaries are
+# built by compile_places_database and held in memory, indexed by the last word of
+# each name and then by the whole name. Since no name can be longer than WORD_MAX
+# words, that two-level table does the job of a full word trie, and each document
+# is scanned in a single pass from the end, with every word looked up in memory
+# rather than with a database query.
+#
+# The text is handled as UTF-8 bytes, and only ASCII letters are case-folded, as
+# in the server, so the start_index and end_index values are byte offsets.
+class PlacesIndex:
+
+  WORD_MAX = 3
+  LOCATION_WORDS = frozenset(['at', 'in'])
+  WHITESPACE = frozenset(" \t'\",.-/\n\r<>!?")
+
+  # The patterns of location elements that give enough confidence that the words
+  # are really a place, in the order they appear in the text
+  TOKEN_SEQUENCES = [
+    ['POSTAL_CODE', 'REGION', 'COUNTRY'],
+    ['REGION', 'POSTAL_CODE', 'COUNTRY'],
+    ['POSTAL_CODE', 'CITY', 'COUNTRY'],
+    ['POSTAL_CODE', 'COUNTRY'],
+    ['CITY', 'COUNTRY'],
+    ['CITY', 'REGION'],
+    ['REGION', 'COUNTRY'],
+    ['COUNTRY'],
+    ['LOCATION_WORD', 'REGION'],
+    ['LOCATION_WORD', 'CITY'],
+  ]
+
+  def __init__(self, file_name):
+    import marshal
+
+    data = marshal.load(open(file_name, 'rb'))
+    self.countries = data['countries']
+    self.regions = data['regions']
+    self.cities = data['cities']
+    self.postal_codes = data['postal_codes']
+
+  # Returns the places found in the text, in the same format as the server's
+  # text2places
+  def text2places(self, text):
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+
+    output = []
+    for found_tokens in PlacesScan(self, text).find_locations():
+      start_index = found_tokens[0]['start_index']
+      end_index = found_tokens[-1]['end_index']
+      location = found_tokens[0]
+      output.append({
+        'type': location['type'],
+        'name': location['matched_string'].decode('utf-8', 'replace'),
+        'latitude': (location['lat'] or '').decode('utf-8'),
+        'longitude': (location['lon'] or '').decode('utf-8'),
+        'start_index': str(location['start_index']),
+        'end_index': str(location['end_index']),
+        'matched_string': text[start_index:end_index+1].decode('utf-8', 'replace'),
+        'code': (location.get('code') or '').decode('utf-8'),
+      })
+    return output
+
+# The state for scanning one piece of text. Each match function looks at the words
+# ending at a position in the text, and returns None if they don't match, or the
+# list of tokens found so far with its own token added at the front. As on the
+# server, those lists are shared and modified in place between the sequences that
+# are tried at each position.
+class PlacesScan:
+
+  def __init__(self, index, text):
+    self.index = index
+    self.text = text
+    self.tokenized_words = {}
+    self.match_functions = {
+      'COUNTRY': self.is_country,
+      'CITY': self.is_city,
+      'REGION': self.is_region,
+      'LOCATION_WORD': self.is_location_word,
+      'POSTAL_CODE': self.is_postal_code,
+    }
+
+  # Walks backwards through the text, since locations in English usually put the
+  # broadest part last, and returns the token lists for every location found
+  def find_locations(self):
+    text = self.text
+    index = self.index
+    current_index = len(text)-1
+    result = []
+
+    while current_index >= 0:
+
+      current_word, pulled_index, skipped = self.pull_word_from_end(current_index)
+      lower_word = current_word.lower()
+      if lower_word not in index.countries and lower_word not in index.regions:
+        current_index = pulled_index
+        continue
+
+      match_cache = {}
+      token_result = None
+      for token_sequence in PlacesIndex.TOKEN_SEQUENCES:
+        token_result = None
+        token_index = current_index
+        for token_position, token_name in enumerate(reversed(token_sequence)):
+          if token_position == 0 and token_name in match_cache:
+            token_result = match_cache[token_name]
+          else:
+            token_result = self.match_functions[token_name](token_index, token_result)
+            if token_position == 0:
+              match_cache[token_name] = token_result
+          if token_result is None:
+            break
+          token_index = token_result[0]['start_index']-1
+
+        if token_result is not None:
+          current_word, current_index, skipped = self.pull_word_from_end(current_index)
+          break
+
+      if token_result is None:
+        ignored, current_index, skipped = self.pull_word_from_end(current_index)
+      else:
+        result.append(token_result)
+        current_index = token_result[0]['start_index']-1
+
+    result.reverse()
+    return result
+
+  # Pulls out the run of non-whitespace characters that ends at or before index,
+  # and returns it along with the index just before it and how many whitespace
+  # characters were skipped at the end
+  def pull_word_from_end(self, index):
+    if index in self.tokenized_words:
+      return self.tokenized_words[index]
+
+    text = self.text
+    whitespace = PlacesIndex.WHITESPACE
+    current_index = index
+    end_skipped = 0
+    while current_index >= 0 and text[current_index] in whitespace:
+      current_index -= 1
+      end_skipped += 1
+    word_end = current_index
+    while current_index >= 0 and text[current_index] not in whitespace:
+      current_index -= 1
+
+    result = (text[current_index+1:word_end+1], current_index, end_skipped)
+    self.tokenized_words[index] = result
+    return result
+
+  # Pulls up to WORD_MAX words back from the starting index, and returns the first
+  # run of words that names_function finds, along with where it starts and ends.
+  # names_function is called once with the last word and returns a dictionary of
+  # the lower-case names that could match.
+  def match_words(self, text_starting_index, names_function):
+    current_word = ''
+    current_index = text_starting_index
+    word_end_index = None
+    name_map = None
+    pulled_word_count = 0
+    while pulled_word_count < PlacesIndex.WORD_MAX:
+      pulled_word, current_index, end_skipped = self.pull_word_from_end(current_index)
+      pulled_word_count += 1
+      if current_word == '':
+        current_word = pulled_word
+        word_end_index = text_starting_index-end_skipped
+        name_map = names_function(pulled_word)
+        if name_map is None:
+          return None
+      else:
+        current_word = pulled_word+' '+current_word
+
+      if current_word == '':
+        return None
+
+      # Names starting with a lower-case letter are skipped, to avoid mistaking
+      # ordinary words for places
+      if 'a' <= current_word[0] <= 'z':
+        continue
+
+      found = name_map.get(current_word.lower())
+      if found is not None:
+        return found, current_word, current_index+1, word_end_index
+
+      if current_index < 0:
+        return None
+
+    return None
+
+  def previous_code(self, previous_result, token_type):
+    code = None
+    if previous_result is not None:
+      for found_token in previous_result:
+        if found_token['type'] == token_type:
+          code = found_token['code']
+    return code
+
+  def add_token(self, previous_result, token):
+    if previous_result is None:
+      previous_result = []
+    previous_result.insert(0, token)
+    return previous_result
+
+  def is_country(self, text_starting_index, previous_result):
+    match = self.match_words(text_starting_index,
+      lambda word: self.index.countries.get(word.lower()))
+    if match is None:
+      return None
+    row, matched_string, start_index, end_index = match
+    country, country_code, lat, lon = row
+    return self.add_token(previous_result, {
+      'type': 'COUNTRY',
+      'code': country_code,
+      'lat': lat,
+      'lon': lon,
+      'matched_string': matched_string,
+      'start_index': start_index,
+      'end_index': end_index,
+    })
+
+  def is_city(self, text_starting_index, previous_result):
+    country_code = None
+    region_code = None
+    if previous_result is not None:
+      for found_token in previous_result:
+        if found_token['type'] == 'COUNTRY':
+          country_code = found_token['code']
+        elif found_token['type'] == 'REGION':
+          region_code = found_token['code']
+
+    # The cities for each last word are sorted by population, so where several
+    # have the same name the largest one wins
+    def city_names(last_word):
+      name_map = {}
+      for row in self.index.cities.get(last_word.lower(), ()):
+        city, country, city_region_code, lat, lon = row
+        if country_code is not None and country.rstrip() != country_code.lower().rstrip():
+          continue
+        if region_code is not None and city_region_code.rstrip() != region_code.upper().strip():
+          continue
+        name_map[city.lower()] = row
+      return name_map
+
+    match = self.match_words(text_starting_index, city_names)
+    if match is None:
+      return None
+    row, matched_string, start_index, end_index = match
+    city, country, city_region_code, lat, lon = row
+    return self.add_token(previous_result, {
+      'type': 'CITY',
+      'lat': lat,
+      'lon': lon,
+      'country_code': country.lower(),
+      'matched_string': matched_string,
+      'start_index': start_index,
+      'end_index': end_index,
+    })
+
+  def is_region(self, text_starting_index, previous_result):
+    country_code = self.previous_code(previous_result, 'COUNTRY')
+
+    def region_names(last_word):
+      rows = self.index.regions.get(last_word.lower())
+      if rows is None:
+        return None
+      name_map = {}
+      for row in rows:
+        region, region_code, region_country_code, lat, lon = row
+        if country_code is not None and region_country_code.lower() != country_code.lower():
+          continue
+        name_map[region.lower()] = row
+      return name_map
+
+    match = self.match_words(text_starting_index, region_names)
+    if match is None:
+      return None
+    row, matched_string, start_index, end_index = match
+    region, region_code, region_country_code, lat, lon = row
+    return self.add_token(previous_result, {
+      'type': 'REGION',
+      'code': region_code,
+      'lat': lat,
+      'lon': lon,
+      'country_code': region_country_code.lower(),
+      'matched_string': matched_string,
+      'start_index': start_index,
+      'end_index': end_index,
+    })
+
+  # Looks for 'at' or 'in' before a location, which makes it much more likely that
+  # a common word really is a place. Think 'the New York Times' vs 'in New York'.
+  def is_location_word(self, text_starting_index, previous_result):
+    current_word, current_index, end_skipped = self.pull_word_from_end(text_starting_index)
+    if current_word == '':
+      return None
+    if current_word.lower() not in PlacesIndex.LOCATION_WORDS:
+      return None
+    return previous_result
+
+  def is_postal_code(self, text_starting_index, previous_result):
+    country_code = self.previous_code(previous_result, 'COUNTRY')
+
+    # This mirrors the server's query, which finds codes whose last word matches in
+    # lower case from any country, or in upper case from the country found so far
+    def postal_code_names(last_word):
+      rows = list(self.index.postal_codes.get(last_word.lower(), ()))
+      if last_word.upper() != last_word.lower():
+        for row in self.index.postal_codes.get(last_word.upper(), ()):
+          if country_code is None or row[1].rstrip() == country_code.upper().rstrip():
+            rows.append(row)
+      name_map = {}
+      for row in rows:
+        name_map.setdefault(row[0].lower(), []).append(row)
+      return name_map
+
+    match = self.match_words(text_starting_index, postal_code_names)
+    if match is None:
+      return None
+    found_rows, current_word, start_index, end_index = match
+
+    # The postal code has to belong to the country that follows it
+    found_row = None
+    if country_code is not None:
+      for row in found_rows:
+        if row[1] == country_code:
+          found_row = row
+          break
+    if found_row is None:
+      return None
+    postal_code, postal_country_code, postal_region_code, lat, lon = found_row
+
+    # Also take in the region before it, if it's the one the code belongs to
+    region_result = self.is_region(start_index-1, None)
+    if region_result is not None:
+      region_token = region_result[0]
+      if postal_region_code == region_token['code']:
+        start_index = region_token['start_index']
+        current_word = region_token['matched_string']+' '+current_word
+
+    return self.add_token(previous_result, {
+      'type': 'POSTAL_CODE',
+      'code': postal_code.lower(),
+      'lat': lat,
+      'lon': lon,
+      'region_code': postal_region_code.lower(),
+      'country_code': postal_country_code.lower(),
+      'matched_string': current_word,
+      'start_index': start_index,
+      'end_index': end_index,
+    })
+
+# Builds a file for PlacesIndex from CSV exports of the server's countries,
+# regions, cities and postal_codes tables, each with a header row naming the
+# columns. The postal codes are optional. The file is written with marshal, so it
+# has to be read by the same version of Python that wrote it.
+def compile_places_database(countries_file_name, regions_file_name, cities_file_name,
+  postal_codes_file_name, output_file_name):
+  import csv
+  import marshal
+
+  def read_rows(file_name):
+    return csv.DictReader(open(file_name, 'rb'))
+
+  def number_or_none(value):
+    if value is None or value.strip() == '':
+      return None
+    return float(value)
+
+  # Countries are looked up by their last word in any case, and later rows with
+  # the same name replace earlier ones, as in the server's cache
+  countries = {}
+  for row in read_rows(countries_file_name):
+    names = countries.setdefault(row['last_word'].lower(), {})
+    names[row['country'].lower()] = (row['country'], row['country_code'], row['lat'], row['lon'])
+
+  regions = {}
+  for row in read_rows(regions_file_name):
+    regions.setdefault(row['last_word'].lower(), []).append((row['region'],
+      row['region_code'], row['country_code'], row['lat'], row['lon']))
+
+  # The server asks for cities in increasing order of population and keeps the
+  # last one with each name, and Postgres puts unknown populations after all the
+  # others, so the same order is used here
+  cities = {}
+  for row in read_rows(cities_file_name):
+    population = number_or_none(row.get('population'))
+    cities.setdefault(row['last_word'], []).append(((population is None, population),
+      (row['city'], row['country'], row['region_code'], row['lat'], row['lon'])))
+  for last_word, rows in cities.items():
+    rows.sort(key=lambda item: item[0])
+    cities[last_word] = [row for order, row in rows]
+
+  postal_codes = {}
+  if postal_codes_file_name is not None:
+    for row in read_rows(postal_codes_file_name):
+      postal_codes.setdefault(row['last_word'], []).append((row['postal_code'],
+        row['country_code'], row['region_code'], row['lat'], row['lon']))
+
+  output = open(output_file_name+'.tmp', 'wb')
+  marshal.dump({
+    'countries': countries,
+    'regions': regions,
+    'cities': cities,
+    'postal_codes': postal_codes,
+  }, output)
+  output.close()
+  os.rename(output_file_name+'.tmp', output_file_name)
+
+# Answers text2people from a file built by compile_people_database, instead of the
+# server's per-name database queries. The server guesses a first name's gender with
+# the weighted name lists in genderfromname.rb, at a looseness of 1 so only the
+# exact-match rules apply, and then fills in the rest from the first_names table.
+# Both steps depend only on the name, so they're worked out once when the file is
+# built, and a single record holds everything the server returns for that name.
+# Surnames have their own records with the ethnicity breakdown already calculated.
+#
+# The records are kept in an open-addressing hash table in the file, which is
+# memory-mapped, so loading it costs almost nothing and several processes can
+# share one copy. Finding a name is a hash and usually a single probe.
+#
+# The text is handled as bytes, as in the server, so the start_index and end_index
+# values are byte offsets into the UTF-8 text.
+class PeopleIndex:
+
+  MAGIC = 'DSTKPN01'
+  HEADER_FORMAT = '<8sI'
+  ENTRY_FORMAT = '<HI'
+  EMPTY = 0xffffffff
+
+  TWO_WORDS = re.compile(r"^([A-Z][a-z]*)\.?\s([A-Z]('[A-Z])?[a-z]+)", re.MULTILINE)
+  THREE_WORDS = re.compile(r"^([A-Z][a-z]*)\.?\s([A-Z][a-z]*)\.?\s([A-Z]('[A-Z])?[a-z]+)",
+    re.MULTILINE)
+  FOUR_WORDS = re.compile(r"^([A-Z][a-z]*)\.?\s([A-Z][a-z]*)\.?\s([A-Z][a-z]*)\.?\s([A-Z]('[A-Z])?[a-z]+)",
+    re.MULTILINE)
+
+  TITLES = {
+    'mr': 'm',
+    'mrs': 'f',
+    'miss': 'f',
+    'ms': 'f',
+    'dr': 'u',
+    'doctor': 'u',
+    'reverend': 'u',
+    'bishop': 'u',
+    'archbishop': 'u',
+    'lord': 'm',
+    'sir': 'm',
+    'lady': 'f',
+    'madame': 'f',
+    'professor': 'u',
+    'colonel': 'u',
+    'major': 'u',
+    'lieutenant': 'u',
+    'private': 'u',
+    'admiral': 'u',
+    'president': 'u',
+    'ceo': 'u',
+    'cfo': 'u',
+    'cto': 'u',
+    'king': 'm',
+    'prince': 'm',
+    'princess': 'f',
+  }
+
+  # A bit arbitrary, but these names show up in headlines a lot
+  FIRST_NAME_BLACKLIST = frozenset(['Will', 'Asia'])
+
+  def __init__(self, file_name):
+    import mmap
+    import struct
+
+    self.file = open(file_name, 'rb')
+    self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, self.bucket_count = struct.unpack_from(self.HEADER_FORMAT, self.data, 0)
+    if magic != self.MAGIC:
+      raise Exception('DSTK: "'+file_name+'" isn\'t a compiled people database')
+
+    self.buckets = PackedUInt32Array(self.data, struct.calcsize(self.HEADER_FORMAT),
+      self.bucket_count)
+    self.entries_offset = self.buckets.offset+self.bucket_count*4
+    self.unpack_entry = struct.Struct(self.ENTRY_FORMAT).unpack_from
+    self.entry_header_size = struct.calcsize(self.ENTRY_FORMAT)
+
+    self.decoded_records = {}
+    self.lock = threading.Lock()
+
+  # Returns the decoded record stored under the key, or None if there isn't one
+  def lookup(self, key):
+    import zlib
+
+    with self.lock:
+      record = self.decoded_records.get(key)
+    if record is not None:
+      return record
+
+    if self.bucket_count > 0:
+      bucket = (zlib.crc32(key) & 0xffffffff) % self.bucket_count
+      while True:
+        offset = self.buckets[bucket]
+        if offset == self.EMPTY:
+          break
+        start = self.entries_offset+offset
+        key_length, value_length = self.unpack_entry(self.data, start)
+        start += self.entry_header_size
+        if self.data[start:start+key_length] == key:
+          start += key_length
+          record = json.loads(self.data[start:start+value_length])
+          break
+        bucket = (bucket+1) % self.bucket_count
+
+    # Only names that are found are kept, so the cache can't grow beyond the file
+    if record is not None:
+      with self.lock:
+        self.decoded_records[key] = record
+    return record
+
+  # Returns the people found in the text, in the same format as the server's
+  # text2people
+  def text2people(self, text):
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+
+    current_year = time.localtime().tm_year
+
+    text_length = len(text)
+    offset = 0
+    result = []
+    while offset < text_length:
+      current_char = text[offset]
+      if current_char < 'A' or current_char > 'Z':
+        offset += 1
+        continue
+
+      # As in the server, each pattern can match at the start of any line in the
+      # next 300 characters, not just at the current position
+      current_text = text[offset:offset+301]
+      full_match = None
+      for pattern, word_count in ((self.FOUR_WORDS, 4), (self.THREE_WORDS, 3), (self.TWO_WORDS, 2)):
+        full_match = pattern.search(current_text)
+        if full_match is not None:
+          break
+      if full_match is None:
+        offset += 1
+        continue
+
+      first_word = full_match.group(1)
+      remaining_words = [full_match.group(index) for index in range(2, word_count+1)]
+
+      title_match = self.TITLES.get(first_word.lower())
+      first_name_match = self.match_first_name(first_word)
+
+      if title_match is None and first_name_match is None:
+        offset += len(first_word)+1
+        continue
+
+      if title_match is not None:
+        gender = title_match
+        title = first_word.lower()
+        if len(remaining_words) == 1:
+          first_name = ''
+          surnames = remaining_words[0]
+        else:
+          first_name = remaining_words[0]
+          surnames = ' '.join(remaining_words[1:])
+      else:
+        gender = first_name_match['gender']
+        title = ''
+        first_name = first_word
+        surnames = ' '.join(remaining_words)
+
+      likely_age = None
+      year_percentages = None
+      year_percentages_start_year = None
+      male_percentage = None
+      if first_name_match is not None and 'male_percentage' in first_name_match:
+        likely_age = current_year-first_name_match['most_popular_year']
+        year_percentages = list(first_name_match['year_percentages'])
+        year_percentages_start_year = 1880
+        male_percentage = first_name_match['male_percentage']
+
+      ethnicity = self.lookup('s'+surnames.split(' ')[-1].upper())
+      if ethnicity is not None:
+        ethnicity = dict(ethnicity)
+
+      matched_string = full_match.group(0)
+      start_index = offset
+      end_index = offset+len(matched_string)
+
+      offset = end_index
+
+      result.append({
+        'gender': gender,
+        'male_percentage': male_percentage,
+        'title': title,
+        'first_name': first_name,
+        'surnames': surnames,
+        'matched_string': matched_string,
+        'start_index': start_index,
+        'end_index': end_index,
+        'ethnicity': ethnicity,
+        'likely_age': likely_age,
+        'year_percentages': year_percentages,
+        'year_percentages_start_year': year_percentages_start_year,
+      })
+
+    return result
+
+  def match_first_name(self, word):
+    if len(word) < 2 or word in self.FIRST_NAME_BLACKLIST:
+      return None
+    return self.lookup('f'+word.lower())
+
+  def close(self):
+    self.buckets = None
+    self.data.close()
+    self.file.close()
+
+# Builds a file for PeopleIndex. The gender weights are read from the $Males and
+# $Females lists in the server's genderfromname.rb, and the other files are CSV
+# exports of the first_names and ethnicity_of_surnames tables, with their columns
+# in the order sql/loadnames.sql loads them (a header row is skipped if there is
+# one). Returns the number of names written.
+def compile_people_database(gender_names_file_name, first_names_file_name,
+  surnames_file_name, output_file_name):
+  import csv
+  import struct
+  import zlib
+
+  def number_or_zero(value):
+    try:
+      return float(value)
+    except ValueError:
+      return 0.0
+
+  def data_rows(file_name):
+    for row in csv.reader(open(file_name, 'rb')):
+      if len(row) > 0 and row[0] != 'name':
+        yield row
+
+  weights = {'Males': {}, 'Females': {}}
+  current_list = None
+  for line in open(gender_names_file_name, 'rb'):
+    list_match = re.match(r'\$(Males|Females)\s*=\s*\{', line)
+    if list_match:
+      current_list = weights[list_match.group(1)]
+      continue
+    if current_list is None:
+      continue
+    if line.strip().startswith('}'):
+      current_list = None
+      continue
+    name_match = re.match(r"\s*'([^']*)'\s*=>\s*([-0-9.eE]+)", line)
+    if name_match:
+      current_list[name_match.group(1)] = float(name_match.group(2))
+  males = weights['Males']
+  females = weights['Females']
+
+  # The same result gender_from_name(name, 1) gives, from the one_only and then the
+  # either_weight rules
+  records = {}
+  for name in set(males) | set(females):
+    male_weight = males.get(name, 0)
+    female_weight = females.get(name, 0)
+    if name in females and name not in males:
+      gender = 'f'
+    elif name in males and name not in females:
+      gender = 'm'
+    elif female_weight > 0 or male_weight > 0:
+      gender = 'f' if female_weight > male_weight else 'm'
+    else:
+      continue
+    records['f'+name] = {'gender': gender}
+
+  for row in data_rows(first_names_file_name):
+    name, count, male_percentage, most_popular_year = row[:4]
+    year_percentages = row[6]
+    record = records.setdefault('f'+name.strip().lower(), {})
+    male_percentage = number_or_zero(male_percentage)
+    if 'gender' not in record:
+      record['gender'] = 'm' if male_percentage > 0.5 else 'f'
+    record['male_percentage'] = male_percentage
+    record['most_popular_year'] = int(number_or_zero(most_popular_year))
+    record['year_percentages'] = [number_or_zero(value) for value in year_percentages.split('_')]
+
+  for row in data_rows(surnames_file_name):
+    name, rank, count, prop100k, cum_prop100k, pctwhite, pctblack, pctapi, pctaian, pct2prace, pcthispanic = row[:11]
+    records['s'+name.strip().upper()] = {
+      'rank': int(number_or_zero(rank)),
+      'percentage_of_total': number_or_zero(prop100k)/1000.0,
+      'percentage_white': number_or_zero(pctwhite),
+      'percentage_black': number_or_zero(pctblack),
+      'percentage_asian_or_pacific_islander': number_or_zero(pctapi),
+      'percentage_american_indian_or_alaska_native': number_or_zero(pctaian),
+      'percentage_two_or_more': number_or_zero(pct2prace),
+      'percentage_hispanic': number_or_zero(pcthispanic),
+    }
+
+  # Keeping the table at most half full means most lookups find their name in the
+  # first bucket they try
+  bucket_count = max(1, len(records)*2)
+  buckets = [PeopleIndex.EMPTY] * bucket_count
+  entries = []
+  offset = 0
+  for key in sorted(records):
+    value = json.dumps(records[key], separators=(',', ':'))
+    bucket = (zlib.crc32(key) & 0xffffffff) % bucket_count
+    while buckets[bucket] != PeopleIndex.EMPTY:
+      bucket = (bucket+1) % bucket_count
+    buckets[bucket] = offset
+    entry = struct.pack(PeopleIndex.ENTRY_FORMAT, len(key), len(value))+key+value
+    entries.append(entry)
+    offset += len(entry)
+
+  output = open(output_file_name+'.tmp', 'wb')
+  output.write(struct.pack(PeopleIndex.HEADER_FORMAT, PeopleIndex.MAGIC, bucket_count))
+  output.write(struct.pack('<'+str(bucket_count)+'I', *buckets))
+  for entry in entries:
+    output.write(entry)
+  output.close()
+  os.rename(output_file_name+'.tmp', output_file_name)
+
+  return len(records)
+
+def close_response(response):
+  response.close()
+
+# Decodes a JSON object or array from a response as it's read, yielding each key
+# and value of an object, or each index and value of an array, as soon as it's
+# complete. Only the unparsed part of the response is kept in memory.
+def iter_json_items(response, encoding='utf-8'):
+  reader = JSONStreamReader(response, encoding)
+  opening = reader.next_character()
+  if opening == '{':
+    closing = '}'
+  elif opening == '[':
+    closing = ']'
+  else:
+    raise ValueError('Expected a JSON object or array but found "'+opening+'"')
+
+  index = 0
+  if reader.peek_character() == closing:
+    reader.next_character()
+    return
+  while True:
+    if opening == '{':
+      key = reader.next_value()
+      if reader.next_character() != ':':
+        raise ValueError('Expected ":" after key in JSON object')
+    else:
+      key = index
+    yield key, reader.next_value()
+    index += 1
+    separator = reader.next_character()
+    if separator == closing:
+      return
+    if separator != ',':
+      raise ValueError('Expected "," or "'+closing+'" in JSON but found "'+separator+'"')
+
+# Holds the part of a streamed JSON document that hasn't been parsed yet
+class JSONStreamReader:
+
+  CHUNK_SIZE = 64*1024
+
+  def __init__(self, response, encoding):
+    import codecs
+
+    self.response = response
+    self.text_decoder = codecs.getincrementaldecoder(encoding)()
+    self.json_decoder = json.JSONDecoder()
+    self.buffer = u''
+    self.position = 0
+    self.finished = False
+
+  # Appends the next chunk of the response to the buffer, returning False at the end
+  def read_more(self):
+    if self.finished:
+      return False
+    if self.position > 0:
+      self.buffer = self.buffer[self.position:]
+      self.position = 0
+    chunk = self.response.read(self.CHUNK_SIZE)
+    if not chunk:
+      self.finished = True
+      self.buffer += self.text_decoder.decode('', True)
+      return False
+    self.buffer += self.text_decoder.decode(chunk)
+    return True
+
+  def skip_whitespace(self):
+    while True:
+      while self.position < len(self.buffer) and self.buffer[self.position] in u' \t\r\n':
+        self.position += 1
+      if self.position < len(self.buffer) or not self.read_more():
+        return
+
+  def peek_character(self):
+    self.skip_whitespace()
+    if self.position >= len(self.buffer):
+      raise ValueError('Unexpected end of JSON data')
+    return self.buffer[self.position]
+
+  def next_character(self):
+    character = self.peek_character()
+    self.position += 1
+    return character
+
+  def next_value(self):
+    self.skip_whitespace()
+    while True:
+      try:
+        value, end = self.json_decoder.raw_decode(self.buffer, self.position)
+        # A number that isn't followed by a delimiter might continue in the next
+        # chunk, for example if we've only seen the '1.' of '1.5' so far
+        is_number = isinstance(value, (int, long, float)) and not isinstance(value, bool)
+        if self.finished or (end < len(self.buffer) and
+          (not is_number or self.buffer[end] in u' \t\r\n,]}')):
+          self.position = end
+          return value
+      except ValueError:
+        if self.finished:
+          raise
+      if not self.read_more() and self.position >= len(self.buffer):
+        raise ValueError('Unexpected end of JSON data')
+
+# The time that each server address last passed a version check in this process,
+# and the version it reported, as a [time, version] pair
+checked_versions = {}
+
+# The newest API version this client knows how to use
+LATEST_API_VERSION = 52
+
+# The first API version where /text2sentiment takes a batch parameter
+BATCH_SENTIMENT_VERSION = 52
+
+# Reads the times that servers last passed a version check from the cache file,
+# along with their versions. Any problems reading it are ignored, since the check
+# can always be run again, and so are entries from older clients, which only
+# recorded the time.
+def load_checked_versions(file_name):
+  try:
+    checked = json.loads(open(file_name).read())
+  except (IOError, OSError, ValueError):
+    return {}
+  if not isinstance(checked, dict):
+    return {}
+  result = {}
+  for api_base, entry in checked.items():
+    if isinstance(entry, list) and len(entry) == 2:
+      result[api_base] = entry
+  return result
+
+# Records a successful version check in the cache file. It's written to a temporary
+# file that's renamed into place, so that concurrent processes never see half a file.
+def save_checked_version(file_name, api_base, version):
+  checked = load_checked_versions(file_name)
+  checked[api_base] = [time.time(), version]
+  temp_file_name = file_name+'.'+str(os.getpid())
+  try:
+    temp_file = open(temp_file_name, 'w')
+    temp_file.write(json.dumps(checked))
+    temp_file.close()
+    os.rename(temp_file_name, file_name)
+  except (IOError, OSError):
+    pass
+
+# Marks a result that the server didn't return, as opposed to one that came back
+# as null
+MISSING = object()
 
 # This is the main interface class. You can see an example of it in use
 # below, implementing a command-line tool, but you basically just instantiate
@@ -37,6 +2987,70 @@ import csv
 # and then call the method you want
 # coordinates = dstk.ip2coordinates('12.34.56.78')
 # The full documentation is at http://www.datasciencetoolkit.org/developerdocs
+#
+# Every call goes through a pool of kept-alive connections owned by the instance,
+# so reuse a single DSTK object rather than creating one per request. The pool can
+# be tuned with the 'poolSize', 'poolMaxPerHost' and 'poolIdleTimeout' options.
+#
+# The methods that take lists (ip2coordinates, street2coordinates,
+# coordinates2politics and coordinates2statistics) can split large inputs into
+# several requests if you set the 'batchSize' option to the most items you want
+# in each one. Up to 'batchConcurrency' of those requests are sent at once.
+#
+# Alternatively, setting 'adaptiveConcurrency' to True leaves both numbers to a
+# ConcurrencyController, which starts from 'batchConcurrency' and 'batchSize' (or
+# 100 items) and adjusts them for each endpoint as it goes, up to 'maxConcurrency'
+# requests and 'maxBatchSize' items, backing off whenever requests fail or take
+# longer than 'targetLatency' seconds. dstk.concurrency.limits() shows where they
+# are.
+#
+# Geocoding results from ip2coordinates and street2coordinates can be kept in a
+# local SQLite file by setting the 'cacheFile' option, so that repeated lookups
+# don't go back to the server. 'cacheTTL' controls how many seconds results are
+# kept for, and 'cacheMaxEntries' how many are kept before the least recently used
+# are thrown away.
+#
+# Results for all of the list-taking methods can also be remembered in memory, by
+# setting 'memoryCacheSize' to how many to keep. Repeated inputs within a single
+# call are always only sent to the server once, with the result copied
+# back to every position they appeared in. For street2coordinates, addresses that
+# only differ in the ways normalize_address ignores count as repeats, unless the
+# 'normalizeAddresses' option is set to False.
+#
+# Setting 'spatialCachePrecision' to a geohash length turns on a SpatialCache for
+# coordinates2politics and coordinates2statistics, which answers points in cells
+# the server has shown to be inside a single area without sending them. Cells are
+# checked once 'spatialCacheProbeThreshold' points have landed in them. Call
+# dstk.spatial_cache.stats() to see how well it's doing.
+#
+# The server's version is checked when the first request is made rather than when
+# the object is created, on every server in 'apiBase'. A successful check of each
+# one is remembered for the rest of the process, and for 'versionCacheTTL' seconds.
+# Short-lived scripts can set 'versionCacheFile' to the name of a file to keep the
+# results in, so that they don't have to repeat the check every time they start.
+# The command line client uses ~/.dstk_version_cache.
+#
+# The metrics member is a ClientMetrics object that records timings, sizes, item
+# counts, errors and cache hits for each endpoint. Call dstk.metrics.snapshot() to
+# read them, or pass a function as the 'metricsCallback' option to have it called
+# after every request.
+#
+# If you run several DSTK servers, 'apiBase' can be a list of their addresses (or
+# DSTK_API_BASE a comma-separated list), and requests will be spread across them
+# by a ReplicaSet. Set 'hedgePercentile' to send a duplicate request to another
+# server when one is slower than that percentile of recent requests, and 'deadline'
+# to give up on requests that the server hasn't started answering within that many
+# seconds. Once a response has started, its body is always read in full.
+#
+# Setting 'ipDatabaseFile' to a file built by compile_ip_database makes
+# ip2coordinates answer from that file, without contacting the server at all.
+# Similarly, 'politicsFiles' can name GeoJSON files of boundaries, which are loaded
+# into a PoliticsIndex the first time coordinates2politics is called, and used to
+# answer it locally. 'placesDatabaseFile' does the same for text2places, with a
+# file built by compile_places_database, and 'peopleDatabaseFile' for text2people,
+# with a file from compile_people_database. 'statisticsDirectory' can name a
+# directory of raster layers to answer coordinates2statistics from, as described
+# for StatisticsIndex.
 class DSTK:
 
   api_base = None
@@ -47,7 +3061,36 @@ class DSTK:
     
     defaultOptions = {
       'apiBase': 'http://www.datasciencetoolkit.org',
-      'checkVersion': True
+      'checkVersion': True,
+      'poolSize': 10,
+      'poolMaxPerHost': 4,
+      'poolIdleTimeout': 30,
+      'batchSize': None,
+      'batchConcurrency': 4,
+      'cacheFile': None,
+      'cacheTTL': 30*24*60*60,
+      'cacheMaxEntries': 1000000,
+      'memoryCacheSize': 0,
+      'versionCacheFile': None,
+      'versionCacheTTL': 24*60*60,
+      'metricsCallback': None,
+      'hedgePercentile': None,
+      'hedgeMinSamples': 20,
+      'deadline': None,
+      'replicaRetryInterval': 30,
+      'ipDatabaseFile': None,
+      'politicsFiles': None,
+      'placesDatabaseFile': None,
+      'peopleDatabaseFile': None,
+      'statisticsDirectory': None,
+      'normalizeAddresses': True,
+      'spatialCachePrecision': None,
+      'spatialCacheMaxCells': 1000000,
+      'spatialCacheProbeThreshold': 10,
+      'adaptiveConcurrency': False,
+      'maxConcurrency': 32,
+      'maxBatchSize': 10000,
+      'targetLatency': 2.0,
     }
 
     if 'DSTK_API_BASE' in os.environ:
@@ -57,223 +3100,1350 @@ class DSTK:
       if key not in options:
         options[key] = value
         
-    self.api_base = options['apiBase']
+    api_bases = options['apiBase']
+    if isinstance(api_bases, basestring):
+      api_bases = api_bases.split(',')
+    self.api_bases = [api_base.strip() for api_base in api_bases]
+    self.api_base = self.api_bases[0]
+    self.replicas = ReplicaSet(self.api_bases, options['hedgePercentile'],
+      options['hedgeMinSamples'], options['deadline'], options['replicaRetryInterval'])
+    self.batch_size = options['batchSize']
+    self.normalize_addresses = options['normalizeAddresses']
+    self.batch_concurrency = options['batchConcurrency']
+
+    pool_size = options['poolSize']
+    pool_max_per_host = options['poolMaxPerHost']
+    if options['adaptiveConcurrency']:
+      self.concurrency = ConcurrencyController(self.batch_concurrency,
+        options['maxConcurrency'], self.batch_size or 100, options['maxBatchSize'],
+        options['targetLatency'])
+      # Otherwise requests would queue for connections, and that wait would look
+      # like the server slowing down
+      pool_size = max(pool_size, options['maxConcurrency'])
+      pool_max_per_host = max(pool_max_per_host, options['maxConcurrency'])
+    else:
+      self.concurrency = None
+
+    self.pool = ConnectionPool(pool_size, pool_max_per_host, options['poolIdleTimeout'])
+
+    if options['cacheFile'] is not None:
+      self.cache = ResponseCache(options['cacheFile'], options['cacheTTL'],
+        options['cacheMaxEntries'])
+    else:
+      self.cache = None
+
+    if options['memoryCacheSize']:
+      self.memory_cache = LRUCache(options['memoryCacheSize'])
+    else:
+      self.memory_cache = None
+
+    if options['spatialCachePrecision']:
+      self.spatial_cache = SpatialCache(options['spatialCachePrecision'],
+        options['spatialCacheMaxCells'], options['spatialCacheProbeThreshold'])
+    else:
+      self.spatial_cache = None
+
+    self.version_cache_file = options['versionCacheFile']
+    self.version_cache_ttl = options['versionCacheTTL']
+    self.version_lock = threading.Lock()
+    self.server_version = None
+    self.version_check_enabled = options['checkVersion']
+    self.version_check_pending = options['checkVersion']
+
+    self.metrics = ClientMetrics()
+    if options['metricsCallback'] is not None:
+      self.metrics.add_callback(options['metricsCallback'])
+
+    if options['ipDatabaseFile'] is not None:
+      self.ip_index = IPRangeIndex(options['ipDatabaseFile'])
+    else:
+      self.ip_index = None
+
+    self.politics_files = options['politicsFiles']
+    self.politics_index = None
+    self.politics_lock = threading.Lock()
+
+    self.places_database_file = options['placesDatabaseFile']
+    self.places_index = None
+    self.places_lock = threading.Lock()
 
-    if options['checkVersion']:
-      self.check_version()
+    if options['peopleDatabaseFile'] is not None:
+      self.people_index = PeopleIndex(options['peopleDatabaseFile'])
+    else:
+      self.people_index = None
+
+    if options['statisticsDirectory'] is not None:
+      self.statistics_index = StatisticsIndex(options['statisticsDirectory'])
+    else:
+      self.statistics_index = None
       
   def check_version(self):
+    self.check_versions(self.api_bases, [])
+
+  # Asks one server which version of the API it implements, and records it if it's
+  # recent enough. Returns None if the server can't be reached, so that the others
+  # can still be used.
+  def fetch_version(self, api_base):
   
     required_version = 50
     
-    api_url = self.api_base+'/info'
+    api_url = api_base+'/info'
     
     try:    
-      response_string = urllib.urlopen(api_url).read()
+      status, response_string = self.pool.request('GET', api_url)
       response = json.loads(response_string)
+      actual_version = response['version']
     except:
-      raise Exception('The server at "'+self.api_base+'" doesn\'t seem to be running DSTK, no version information found.')
+      return None
 
-    actual_version = response['version']
     if actual_version < required_version:
       raise Exception('DSTK: Version '+str(actual_version)+' found at "'+api_url+'" but '+str(required_version)+' is required')
 
-  def ip2coordinates(self, ips):
+    checked_versions[api_base] = [time.time(), actual_version]
+    if self.version_cache_file:
+      save_checked_version(self.version_cache_file, api_base, actual_version)
+    return actual_version
+
+  # Checks each of the servers, adding their versions to the ones already known.
+  # Requests may go to any of them, so the oldest version is the one we can rely on.
+  def check_versions(self, api_bases, versions):
+    for api_base in api_bases:
+      version = self.fetch_version(api_base)
+      if version is not None:
+        versions.append(version)
+    if len(versions) == 0:
+      raise Exception('The server at "'+api_bases[0]+'" doesn\'t seem to be running DSTK, no version information found.')
+    self.server_version = min(versions)
+
+  # Returns the version of the API the server implements. That's normally known
+  # from the version check, cached or not, so it doesn't cost another request. With
+  # 'checkVersion' turned off the server is assumed to be up to date.
+  def api_version(self):
+    if not self.version_check_enabled:
+      return LATEST_API_VERSION
+    self.check_version_if_needed()
+    return self.server_version
+
+  # Runs the version check before the first real request, on the servers that
+  # haven't already passed one recently, either in this process or in the cache file
+  def check_version_if_needed(self):
+    with self.version_lock:
+      if not self.version_check_pending:
+        return
+      cutoff = time.time()-self.version_cache_ttl
+      on_file = None
+      versions = []
+      to_check = []
+      for api_base in self.api_bases:
+        checked = checked_versions.get(api_base)
+        if checked is None or checked[0] < cutoff:
+          if on_file is None:
+            on_file = {}
+            if self.version_cache_file:
+              on_file = load_checked_versions(self.version_cache_file)
+          checked = on_file.get(api_base)
+          if checked is None or checked[0] < cutoff:
+            to_check.append(api_base)
+            continue
+          checked_versions[api_base] = checked
+        versions.append(checked[1])
+      if len(to_check) > 0:
+        self.check_versions(to_check, versions)
+      else:
+        self.server_version = min(versions)
+      self.version_check_pending = False
+
+  # Loading the boundaries takes a while, so it's only done when they're needed
+  def local_politics_index(self):
+    with self.politics_lock:
+      if self.politics_index is None:
+        self.politics_index = PoliticsIndex(self.politics_files)
+      return self.politics_index
+
+  def local_places_index(self):
+    with self.places_lock:
+      if self.places_index is None:
+        self.places_index = PlacesIndex(self.places_database_file)
+      return self.places_index
+
+  # Closes any connections the pool is keeping open, and the cache file
+  def close(self):
+    self.pool.close()
+    if self.cache is not None:
+      self.cache.close()
+    if self.ip_index is not None:
+      self.ip_index.close()
+    if self.people_index is not None:
+      self.people_index.close()
+    if self.statistics_index is not None:
+      self.statistics_index.close()
+
+  # Sends a request to the given endpoint over one of the pooled connections, and
+  # returns the raw body of the response. With no body this is a GET, otherwise a
+  # POST, sent with the same content type urllib would use.
+  def api_request(self, endpoint, body=None, content_type=None):
+
+    response = self.api_open(endpoint, body, content_type)
+    try:
+      response_string = response.read()
+    finally:
+      response.close()
+
+    return response_string
+
+  # Like api_request, but returns the PooledResponse so the body can be read
+  # incrementally. The caller must close it when they're done.
+  def api_open(self, endpoint, body=None, content_type=None):
+
+    if self.version_check_pending and endpoint != '/info':
+      self.check_version_if_needed()
+
+    headers = {}
+    if body is None:
+      method = 'GET'
+    else:
+      method = 'POST'
+      if isinstance(body, unicode):
+        body = body.encode('utf-8')
+      if content_type is None:
+        content_type = 'application/x-www-form-urlencoded'
+      headers['Content-Type'] = content_type
+      if not isinstance(body, basestring):
+        headers['Content-Length'] = str(len(body))
+
+    def open_on_replica(api_base, handle):
+      return self.pool.urlopen(method, api_base+endpoint, body, headers, handle)
+
+    # Streamed bodies can't be read by two requests at once, so they're never hedged
+    can_hedge = (body is None or isinstance(body, basestring))
+
+    return self.replicas.run(open_on_replica, can_hedge, close_response)
+
+  # Posts the body to an endpoint that returns JSON, and decodes the result. If the
+  # body is a list rather than a string, it's encoded as JSON first. The time spent
+  # on each stage is recorded in the metrics.
+  def api_call(self, endpoint, body, encoding=None):
+
+    started = time.time()
+    items = 1
+    if isinstance(body, (list, tuple)):
+      items = len(body)
+      body = json.dumps(body)
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+    encoded = time.time()
+    received = encoded
+    response_string = ''
+
+    try:
+      response_string = self.api_request(endpoint, body)
+      received = time.time()
+      if encoding is not None:
+        response_string = unicode(response_string, encoding)
+      response = json.loads(response_string)
+    
+      if 'error' in response:
+        raise Exception(response['error'])
+    except Exception, e:
+      self.metrics.record_request(endpoint, encoded-started, received-encoded,
+        time.time()-received, len(body), len(response_string), items, str(e))
+      raise
+
+    self.metrics.record_request(endpoint, encoded-started, received-encoded,
+      time.time()-received, len(body), len(response_string), items)
     
+    return response
+
+  # Sends a list of inputs to an endpoint that takes JSON arrays. If batching is
+  # switched on and there are more than 'batchSize' items, the list is split into
+  # chunks that are sent concurrently, and the responses are merged back together
+  # in input order. Endpoints that key their results by input return dictionaries,
+  # which are combined, and the rest return a list with one entry per input, which
+  # are concatenated.
+  def batch_call(self, endpoint, items, encoding=None):
+
+    if self.concurrency is not None:
+      return self.adaptive_batch_call(endpoint, items, encoding)
+
+    batch_size = self.batch_size
+    if not batch_size or len(items) <= batch_size:
+      return self.api_call(endpoint, list(items), encoding)
+
+    chunks = []
+    for start in range(0, len(items), batch_size):
+      chunks.append(list(items[start:start+batch_size]))
+
+    def call_chunk(chunk):
+      return self.api_call(endpoint, chunk, encoding)
+
+    responses = map_concurrently(call_chunk, chunks, self.batch_concurrency)
+
+    return merge_responses(responses)
+
+  # Like batch_call, but the ConcurrencyController decides how big each chunk is
+  # and how many are sent at once. Each chunk is cut at the batch size in force
+  # when a slot for it becomes free, so the limits can change part way through a
+  # long list.
+  def adaptive_batch_call(self, endpoint, items, encoding=None):
+
+    controller = self.concurrency
+    responses = {}
+    errors = []
+    lock = threading.Lock()
+    next_index = [0]
+
+    def call_chunk(chunk):
+      started = controller.acquire(endpoint)
+      try:
+        response = self.api_call(endpoint, chunk, encoding)
+      except Exception:
+        controller.release(endpoint, started, len(chunk), True)
+        raise
+      controller.release(endpoint, started, len(chunk))
+      return response
+
+    if len(items) <= controller.batch_size(endpoint):
+      return call_chunk(list(items))
+
+    def worker():
+      while True:
+        started = controller.acquire(endpoint)
+        with lock:
+          if errors or next_index[0] >= len(items):
+            controller.cancel(endpoint)
+            return
+          start = next_index[0]
+          next_index[0] = start+controller.batch_size(endpoint)
+        chunk = list(items[start:next_index[0]])
+        try:
+          responses[start] = self.api_call(endpoint, chunk, encoding)
+        except Exception:
+          controller.release(endpoint, started, len(chunk), True)
+          with lock:
+            errors.append(sys.exc_info())
+          return
+        controller.release(endpoint, started, len(chunk))
+
+    threads = []
+    for i in range(min(controller.max_concurrency, len(items))):
+      thread = threading.Thread(target=worker)
+      thread.daemon = True
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join()
+
+    if errors:
+      error_type, error_value, error_traceback = errors[0]
+      raise error_type, error_value, error_traceback
+
+    return merge_responses([responses[start] for start in sorted(responses)])
+
+  # Finds results for a list of inputs, doing as little work on the server as
+  # possible. Inputs with the same lookup key, as returned by item_key, are only
+  # looked up once. Results come from the in-memory cache first, then from the disk
+  # cache if persistent is true, and whatever's left is passed to fetch, which must
+  # return a list of results for the inputs it's given, in order. The return value
+  # is a list of results in the same order as items, with MISSING for any the server
+  # didn't answer.
+  def lookup_items(self, endpoint, items, item_key, fetch, persistent=False):
+
+    indices_by_key = {}
+    keys = []
+    for index, item in enumerate(items):
+      key = make_cache_key(endpoint, self.api_base, item_key(item))
+      if key not in indices_by_key:
+        indices_by_key[key] = []
+        keys.append(key)
+      indices_by_key[key].append(index)
+
+    values = {}
+    remaining = keys
+    if self.memory_cache is not None:
+      values.update(self.memory_cache.get_many(remaining))
+      remaining = [key for key in remaining if key not in values]
+
+    use_cache = persistent and self.cache is not None
+    if use_cache and len(remaining) > 0:
+      found = self.cache.get_many(remaining)
+      if self.memory_cache is not None:
+        self.memory_cache.set_many(found)
+      values.update(found)
+      remaining = [key for key in remaining if key not in values]
+
+    if self.memory_cache is not None or use_cache:
+      self.metrics.record_cache(endpoint, len(keys)-len(remaining), len(remaining),
+        len(items)-len(keys))
+    else:
+      self.metrics.record_cache(endpoint, 0, 0, len(items)-len(keys))
+
+    if len(remaining) > 0:
+      to_send = [items[indices_by_key[key][0]] for key in remaining]
+      new_values = {}
+      for key, value in zip(remaining, fetch(to_send)):
+        if value is not MISSING:
+          new_values[key] = value
+      if self.memory_cache is not None:
+        self.memory_cache.set_many(new_values)
+      if use_cache:
+        self.cache.set_many(new_values)
+      values.update(new_values)
+
+    # Repeated inputs each get their own copy of the result
+    results = [MISSING] * len(items)
+    for key, indices in indices_by_key.items():
+      if key in values:
+        results[indices[0]] = values[key]
+        for index in indices[1:]:
+          results[index] = copy.deepcopy(values[key])
+
+    return results
+
+  # Looks up a list of inputs for an endpoint that returns a dictionary keyed by
+  # input. Inputs with the same item_key are only sent once, and share a cache
+  # entry, and by default that's inputs that only differ by whitespace.
+  # response_key converts an input into the key the server will use for it in the
+  # response.
+  def keyed_call(self, endpoint, items, encoding=None, response_key=None, item_key=None):
+
+    if response_key is None:
+      response_key = lambda item: item
+
+    if item_key is None:
+      item_key = lambda item: ' '.join(item.split())
+
+    # Anything in a response that can't be matched to an input is passed through
+    # under the server's own key, rather than being dropped
+    unmatched = {}
+
+    def fetch(to_send):
+      response = self.batch_call(endpoint, to_send, encoding)
+      values = []
+      used = set()
+      for item in to_send:
+        value = MISSING
+        for key in response_key_candidates(response_key(item), item):
+          if key in response:
+            value = response[key]
+            used.add(key)
+            break
+        values.append(value)
+      for key, value in response.items():
+        if key not in used:
+          unmatched[key] = value
+      return values
+
+    results = self.lookup_items(endpoint, items, item_key, fetch, True)
+
+    output = dict(unmatched)
+    for item, result in zip(items, results):
+      if result is not MISSING:
+        output[response_key(item)] = result
+
+    return output
+
+  # Looks up a list of coordinate pairs through the SpatialCache. Any cells that
+  # are ready to be checked are sampled first, so that the rest of the points in
+  # them can be answered from the cache straight away, and then the server is only
+  # sent the points that still have no answer.
+  def spatial_call(self, endpoint, coordinates):
+
+    cache = self.spatial_cache
+    results = [MISSING] * len(coordinates)
+    cells = [cache.cell(pair) for pair in coordinates]
+
+    waiting = {}
+    for position, cell in enumerate(cells):
+      if cell is not None:
+        waiting.setdefault(cell, []).append(position)
+    probe_cells = []
+    for cell, positions in waiting.items():
+      if cache.start_probe(endpoint, cell, len(positions)):
+        probe_cells.append(cell)
+
+    probe_count = 0
+    if len(probe_cells) > 0:
+      to_probe = []
+      ranges = []
+      for cell in probe_cells:
+        start = len(to_probe)
+        to_probe.extend(cache.probe_points(cell))
+        ranges.append((cell, start, len(to_probe)))
+      probe_count = len(to_probe)
+      try:
+        responses = self.positional_call(endpoint, to_probe)
+      except:
+        cache.cancel_probes(endpoint, probe_cells)
+        raise
+      for cell, start, end in ranges:
+        cache.settle(endpoint, cell, responses[start:end])
+
+    to_send = []
+    positions = []
+    for position, (pair, cell) in enumerate(zip(coordinates, cells)):
+      if cell is not None:
+        result = cache.get(endpoint, cell, pair)
+        if result is not None:
+          results[position] = result
+          continue
+      to_send.append(pair)
+      positions.append(position)
+
+    cache.record(len(coordinates)-len(to_send), len(to_send), probe_count)
+
+    if len(to_send) > 0:
+      for position, response in zip(positions, self.positional_call(endpoint, to_send)):
+        results[position] = response
+
+    return results
+
+  # Looks up a list of coordinate pairs for an endpoint that returns a list with
+  # one result for each input
+  def positional_call(self, endpoint, coordinates):
+
+    def fetch(to_send):
+      response = self.batch_call(endpoint, to_send)
+      if len(response) != len(to_send):
+        raise Exception('DSTK: Expected '+str(len(to_send))+' results from '+endpoint+
+          ' but found '+str(len(response)))
+      return response
+
+    return self.lookup_items(endpoint, coordinates, coordinates_key, fetch)
+
+  # Sends the inputs to the endpoint, one batch after another, and yields each
+  # batch along with the keys and values from its response as they're decoded, so
+  # that the whole response never has to be held in memory. The caches aren't used.
+  def iter_batches(self, endpoint, items, encoding='utf-8'):
+
+    controller = self.concurrency
+    start = 0
+    while start < len(items):
+      if controller is not None:
+        batch_size = controller.batch_size(endpoint)
+      else:
+        batch_size = self.batch_size or len(items)
+      chunk = items[start:start+batch_size]
+      start += batch_size
+      started = time.time()
+      body = json.dumps(chunk)
+      encoded = time.time()
+      if controller is not None:
+        request_started = controller.acquire(endpoint)
+      try:
+        response = self.api_open(endpoint, body)
+      except Exception:
+        if controller is not None:
+          controller.release(endpoint, request_started, len(chunk), True)
+        raise
+      received = time.time()
+      # Only the wait for the server counts, not the time the caller spends on
+      # the results as they're streamed
+      if controller is not None:
+        controller.release(endpoint, request_started, len(chunk), response.status != 200)
+      # Only the time spent parsing counts as decoding, not the time the caller
+      # spends on each item in between
+      decode_seconds = 0
+      error = None
+      try:
+        if response.status != 200:
+          response_string = unicode(response.read(), encoding)
+          try:
+            error = json.loads(response_string)['error']
+          except (ValueError, KeyError, TypeError):
+            error = 'DSTK: '+endpoint+' returned status '+str(response.status)
+          raise Exception(error)
+        decoded_items = iter_json_items(response, encoding)
+        while True:
+          decode_started = time.time()
+          try:
+            key, value = decoded_items.next()
+          except StopIteration:
+            break
+          finally:
+            decode_seconds += time.time()-decode_started
+          yield chunk, key, value
+      except Exception, e:
+        error = str(e)
+        raise
+      finally:
+        response.close()
+        self.metrics.record_request(endpoint, encoded-started, received-encoded,
+          decode_seconds, len(body), response.bytes_read, len(chunk), error)
+
+  # The iter_ versions of the list-taking methods yield (input, result) pairs as
+  # they're decoded from the server's response, instead of building the whole
+  # result in memory, so they can handle very large lists. The results are the same
+  # as the ones the normal methods return for each input.
+  def iter_ip2coordinates(self, ips):
+
     if not isinstance(ips, (list, tuple)):
       ips = [ips]
-  
-    api_url = self.api_base+'/ip2coordinates'
-    api_body = json.dumps(ips)
-    response_string = urllib.urlopen(api_url, api_body).read()
-    
-    response = json.loads(response_string)
-    
-    if 'error' in response:
-      raise Exception(response['error'])
+
+    if self.ip_index is not None:
+      batch_size = self.batch_size or 10000
+      for start in range(0, len(ips), batch_size):
+        for ip, info in self.ip_index.lookup_many(ips[start:start+batch_size]).items():
+          yield ip, info
+      return
+
+    for chunk, ip, info in self.iter_batches('/ip2coordinates', ips):
+      yield ip, info
+
+  def iter_street2coordinates(self, addresses):
+
+    if not isinstance(addresses, (list, tuple)):
+      addresses = [addresses]
+
+    for chunk, address, info in self.iter_batches('/street2coordinates', addresses, 'latin-1'):
+      yield address, info
+
+  def iter_coordinates2politics(self, coordinates):
+
+    if not is_coordinates_list(coordinates):
+      coordinates = [coordinates]
+    coordinates = split_coordinate_strings(coordinates)
+
+    if self.politics_files is not None:
+      batch_size = self.batch_size or 10000
+      for start in range(0, len(coordinates), batch_size):
+        chunk = coordinates[start:start+batch_size]
+        for pair, info in zip(chunk, self.local_politics_index().lookup_many(chunk)):
+          yield pair, info
+      return
+
+    for chunk, index, info in self.iter_batches('/coordinates2politics', coordinates):
+      yield chunk[index], info
+
+  # The _columns versions of ip2coordinates and street2coordinates return their
+  # results as columns instead of a dictionary of dictionaries. The result is a
+  # dictionary from each of the fields asked for to a sequence holding that field
+  # for every input, in the same order as the inputs, which can be handed straight
+  # to pandas.DataFrame. If numpy is installed the columns are numpy arrays, with
+  # numeric fields as floats and NaN where there's no result, otherwise they're
+  # array.array('d') for numbers and lists for everything else.
+  #
+  # The responses are decoded one item at a time as they arrive, as with the iter_
+  # methods, and each result is dropped as soon as its fields are copied out, so
+  # only the columns themselves are kept in memory.
+  def ip2coordinates_columns(self, ips, fields=('latitude', 'longitude')):
+
+    ips = list(ips)
+    columns = ResultColumns(len(ips), fields)
+
+    if self.ip_index is not None:
+      batch_size = self.batch_size or 10000
+      for start in range(0, len(ips), batch_size):
+        chunk = ips[start:start+batch_size]
+        results = self.ip_index.lookup_many(chunk)
+        for position, ip in enumerate(chunk):
+          columns.set(start+position, results.get(ip_response_key(ip)))
+      return columns.finish()
+
+    self.fill_keyed_columns(columns, '/ip2coordinates', ips, ip_response_key)
+    return columns.finish()
+
+  def street2coordinates_columns(self, addresses,
+    fields=('latitude', 'longitude', 'confidence')):
+
+    addresses = list(addresses)
+    columns = ResultColumns(len(addresses), fields)
+    self.fill_keyed_columns(columns, '/street2coordinates', addresses, lambda address: address,
+      'latin-1')
+    return columns.finish()
+
+  # Copies each result from a keyed endpoint into the columns, at the positions of
+  # every input it belongs to. Inputs are only matched against the responses from
+  # their own batch, so the lookup table never holds more than one batch.
+  def fill_keyed_columns(self, columns, endpoint, items, item_key, encoding='utf-8'):
+    current_chunk = None
+    start = 0
+    positions = {}
+    for chunk, key, info in self.iter_batches(endpoint, items, encoding):
+      if chunk is not current_chunk:
+        if current_chunk is not None:
+          start += len(current_chunk)
+        current_chunk = chunk
+        positions = {}
+        for position, item in enumerate(chunk):
+          positions.setdefault(item_key(item), []).append(start+position)
+      for position in positions.get(key, ()):
+        columns.set(position, info)
+
+  def iter_coordinates2statistics(self, coordinates, statistics=None):
+
+    if not is_coordinates_list(coordinates):
+      coordinates = [coordinates]
+    coordinates = split_coordinate_strings(coordinates)
+
+    if isinstance(statistics, basestring):
+      statistics = statistics.split(',')
+
+    if self.statistics_index is not None:
+      batch_size = self.batch_size or 10000
+      for start in range(0, len(coordinates), batch_size):
+        chunk = coordinates[start:start+batch_size]
+        for pair, info in zip(chunk, self.statistics_index.lookup_many(chunk, statistics)):
+          yield pair, info
+      return
+
+    endpoint = statistics_endpoint(statistics)
+    for chunk, index, info in self.iter_batches(endpoint, coordinates):
+      yield chunk[index], info
+
+  # With compact set, ip2coordinates and street2coordinates return each location
+  # as an IPLocation or StreetLocation record, which take a fraction of the memory
+  # of a dictionary when a lot of results are being held
+  def ip2coordinates(self, ips, compact=False):
     
-    return response
+    if not isinstance(ips, (list, tuple)):
+      ips = [ips]
+
+    if self.ip_index is not None:
+      result = self.ip_index.lookup_many(ips)
+    else:
+      result = self.keyed_call('/ip2coordinates', ips, None, ip_response_key)
 
-  def street2coordinates(self, addresses):
+    if compact:
+      result = compact_results(result, IPLocation)
+    return result
+
+  def street2coordinates(self, addresses, compact=False):
     
     if not isinstance(addresses, (list, tuple)):
       addresses = [addresses]
   
-    api_url = self.api_base+'/street2coordinates'
-    api_body = json.dumps(addresses)
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response_string = unicode(response_string, 'latin-1')
-    response = json.loads(response_string)
-    
-    if 'error' in response:
-      raise Exception(response['error'])
-    
-    return response
+    item_key = None
+    if self.normalize_addresses:
+      item_key = normalize_address
+    result = self.keyed_call('/street2coordinates', addresses, 'latin-1', None, item_key)
+
+    if compact:
+      result = compact_results(result, StreetLocation)
+    return result
     
   def coordinates2politics(self, coordinates):
+
+    if self.politics_files is not None:
+      if not is_coordinates_list(coordinates):
+        coordinates = [coordinates]
+      return self.local_politics_index().lookup_many(coordinates)
     
-    api_url = self.api_base+'/coordinates2politics'
-    api_body = json.dumps(coordinates)
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response = json.loads(response_string)
-    
-    if 'error' in response:
-      raise Exception(response['error'])
-    
-    return response
+    if not is_coordinates_list(coordinates):
+      return self.api_call('/coordinates2politics', json.dumps(coordinates))
+    coordinates = split_coordinate_strings(coordinates)
+
+    if self.spatial_cache is not None:
+      return self.spatial_call('/coordinates2politics', coordinates)
+
+    return self.positional_call('/coordinates2politics', coordinates)
 
   def text2places(self, text):
+
+    if self.places_database_file is not None:
+      return self.local_places_index().text2places(text)
     
-    api_url = self.api_base+'/text2places'
-    api_body = text
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response = json.loads(response_string)
-    
-    if 'error' in response:
-      raise Exception(response['error'])
-    
-    return response
+    return self.api_call('/text2places', text)
 
-  def file2text(self, file_name, file_data):
+  # The file can be passed in as a string holding its contents, or as an open file
+  # object, or if file_data is left out, file_name is opened and read from disk.
+  # Files are streamed to the server in chunks rather than being read into memory.
+  def file2text(self, file_name, file_data=None):
 
-    host = self.api_base.replace('http://', '')
+    opened_file = None
+    if file_data is None:
+      opened_file = open(file_name, 'rb')
+      file_data = opened_file
 
-    response = post_multipart(host,
-      '/file2text',[],[('inputfile', file_name, file_data)])
-  
-    return response
+    try:
+      started = time.time()
+      body = MultipartBody([], [('inputfile', file_name, file_data)])
+      encoded = time.time()
+      response_string = ''
+      error = None
+      try:
+        response_string = self.api_request('/file2text', body, body.content_type)
+      except Exception, e:
+        error = str(e)
+        raise
+      finally:
+        self.metrics.record_request('/file2text', encoded-started, time.time()-encoded,
+          0, len(body), len(response_string), 1, error)
+      return response_string
+    finally:
+      if opened_file is not None:
+        opened_file.close()
 
   def text2sentences(self, text):
     
-    api_url = self.api_base+'/text2sentences'
-    api_body = text
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response = json.loads(response_string)
+    return self.api_call('/text2sentences', text)
+
+  def html2text(self, html):
     
-    if 'error' in response:
-      raise Exception(response['error'])
+    return self.api_call('/html2text', html)
+
+  def html2story(self, html):
     
-    return response
+    return self.api_call('/html2story', html)
 
-  def html2text(self, html):
+  def text2people(self, text):
+
+    if self.people_index is not None:
+      return self.people_index.text2people(text)
     
-    api_url = self.api_base+'/html2text'
-    api_body = html
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response = json.loads(response_string)
+    return self.api_call('/text2people', text)
+
+  def text2times(self, text):
     
-    if 'error' in response:
-      raise Exception(response['error'])
+    return self.api_call('/text2times', text)
+
+  def text2sentiment(self, text):
     
-    return response
+    return self.api_call('/text2sentiment', text)
+
+  # Scores a whole list of texts with as few requests as possible, and returns a
+  # list with a result for each, in the same form text2sentiment returns. Servers
+  # older than BATCH_SENTIMENT_VERSION don't understand batches, so for them each
+  # text is sent with its own text2sentiment call instead.
+  def text2sentiment_batch(self, texts):
+
+    if self.api_version() < BATCH_SENTIMENT_VERSION:
+      def fetch_each(to_send):
+        return map_concurrently(self.text2sentiment, to_send, self.batch_concurrency)
+      return self.lookup_items('/text2sentiment', list(texts), lambda text: text,
+        fetch_each)
+
+    def fetch(to_send):
+      response = self.batch_call('/text2sentiment?batch=true', to_send)
+      if len(response) != len(to_send):
+        raise Exception('DSTK: Expected '+str(len(to_send))+' results from '+
+          '/text2sentiment but found '+str(len(response)))
+      return response
+
+    return self.lookup_items('/text2sentiment?batch=true', list(texts),
+      lambda text: text, fetch)
+
+  # The statistics can be a list of names, or a comma-separated string, to only
+  # look those up rather than every one the server knows about
+  def coordinates2statistics(self, coordinates, statistics=None):
+
+    if isinstance(statistics, basestring):
+      statistics = statistics.split(',')
+
+    if self.statistics_index is not None:
+      if not is_coordinates_list(coordinates):
+        coordinates = [coordinates]
+      return self.statistics_index.lookup_many(split_coordinate_strings(coordinates),
+        statistics)
+
+    endpoint = statistics_endpoint(statistics)
+    
+    if not is_coordinates_list(coordinates):
+      return self.api_call(endpoint, json.dumps(coordinates))
+    coordinates = split_coordinate_strings(coordinates)
+
+    if self.spatial_cache is not None:
+      return self.spatial_call(endpoint, coordinates)
+
+    return self.positional_call(endpoint, coordinates)
+
+# Asks the server for only the statistics wanted, if they're given
+def statistics_endpoint(statistics):
+  if statistics is None:
+    return '/coordinates2statistics'
+  return '/coordinates2statistics?statistics='+','.join(statistics)
+
+# The words in addresses that are written in more than one way, mapped to the
+# abbreviation normalize_address uses for them
+ADDRESS_ABBREVIATIONS = {
+  'alley': 'aly',
+  'apartment': 'apt',
+  'av': 'ave',
+  'avenue': 'ave',
+  'boulevard': 'blvd',
+  'building': 'bldg',
+  'circle': 'cir',
+  'court': 'ct',
+  'crescent': 'cres',
+  'drive': 'dr',
+  'expressway': 'expy',
+  'floor': 'fl',
+  'freeway': 'fwy',
+  'highway': 'hwy',
+  'lane': 'ln',
+  'mount': 'mt',
+  'parkway': 'pkwy',
+  'place': 'pl',
+  'road': 'rd',
+  'route': 'rte',
+  'rw': 'row',
+  'square': 'sq',
+  'street': 'st',
+  'suite': 'ste',
+  'terrace': 'ter',
+  'trail': 'trl',
+}
+
+US_STATE_ABBREVIATIONS = {
+  'alabama': 'al', 'alaska': 'ak', 'arizona': 'az', 'arkansas': 'ar',
+  'california': 'ca', 'colorado': 'co', 'connecticut': 'ct', 'delaware': 'de',
+  'florida': 'fl', 'georgia': 'ga', 'hawaii': 'hi', 'idaho': 'id', 'illinois': 'il',
+  'indiana': 'in', 'iowa': 'ia', 'kansas': 'ks', 'kentucky': 'ky', 'louisiana': 'la',
+  'maine': 'me', 'maryland': 'md', 'massachusetts': 'ma', 'michigan': 'mi',
+  'minnesota': 'mn', 'mississippi': 'ms', 'missouri': 'mo', 'montana': 'mt',
+  'nebraska': 'ne', 'nevada': 'nv', 'ohio': 'oh', 'oklahoma': 'ok', 'oregon': 'or',
+  'pennsylvania': 'pa', 'tennessee': 'tn', 'texas': 'tx', 'utah': 'ut',
+  'vermont': 'vt', 'virginia': 'va', 'wisconsin': 'wi', 'wyoming': 'wy',
+}
+
+ADDRESS_WORD_PATTERN = re.compile(r'[^\s,.;:#]+|#')
+ZIP_CODE_PATTERN = re.compile(r'^\d{5}(-\d{4})?$')
+
+# Turns an address into a key that's the same for the ways people commonly write
+# it differently, so that street2coordinates only sends each address once. Case,
+# spacing and punctuation other than commas are ignored, and street types are
+# replaced by their usual abbreviations ('Road' and 'Rd' are both 'rd'). A state
+# name is only abbreviated where a state goes, as the word just before a ZIP code,
+# or else the last word after a comma, and street types are left alone there, so
+# that 'Court' and 'Connecticut' or 'Mount' and 'Montana' can't be confused. The
+# commas are kept in the key for the same reason. Directions are left alone, since
+# 'E Street' and 'East Street' can be different places, as is Washington, which
+# is as likely to be the city as the state. The key is only used to match inputs
+# up, and the server is always sent one of the originals.
+def normalize_address(address):
+  segments = []
+  for segment in address.lower().replace("'", '').split(','):
+    words = ADDRESS_WORD_PATTERN.findall(segment)
+    if len(words) > 0:
+      segments.append(words)
+  if len(segments) == 0:
+    return ''
+
+  # A ZIP code after its own comma is treated as part of the segment before it
+  if len(segments) > 1 and len(segments[-1]) == 1 and ZIP_CODE_PATTERN.match(segments[-1][0]):
+    segments[-2].extend(segments.pop())
+
+  # Find the word where a state would be, in the last segment
+  state_segment = len(segments)-1
+  if len(segments[-1]) > 1 and ZIP_CODE_PATTERN.match(segments[-1][-1]):
+    state_index = len(segments[-1])-2
+  elif len(segments) > 1:
+    state_index = len(segments[-1])-1
+  else:
+    state_index = None
+
+  for segment_index, words in enumerate(segments):
+    for index, word in enumerate(words):
+      if segment_index == state_segment and index == state_index:
+        words[index] = US_STATE_ABBREVIATIONS.get(word, word)
+      else:
+        words[index] = ADDRESS_ABBREVIATIONS.get(word, word)
+  return ', '.join([' '.join(words) for words in segments])
+
+# The server strips quotes, brackets and spaces from the IP addresses it's given, so
+# this does the same to work out which key in the response belongs to an input
+def ip_response_key(ip):
+  return re.sub(r'["\[\] ]', '', ip)
+
+# Yields the keys the server might have used for an input in its response. Byte
+# strings come back decoded, and a response that's decoded as latin-1 turns any
+# UTF-8 the server sent into one character per byte, so all of those are tried.
+def response_key_candidates(key, item):
+  candidates = [key, item]
+  for value in (key, item):
+    if isinstance(value, str):
+      for encoding in ('utf-8', 'latin-1'):
+        try:
+          candidates.append(value.decode(encoding))
+        except UnicodeDecodeError:
+          pass
+    elif isinstance(value, unicode):
+      candidates.append(value.encode('utf-8').decode('latin-1'))
+  for candidate in candidates:
+    yield candidate
+
+# Turns a coordinate pair into a string that's the same for any equivalent pair,
+# whether the numbers were given as strings or floats
+def coordinates_key(coordinates):
+  try:
+    return repr(float(coordinates[0]))+','+repr(float(coordinates[1]))
+  except (ValueError, TypeError, IndexError):
+    return json.dumps(coordinates)
+
+# Returns true if the argument is a list of coordinate pairs or 'latitude,longitude'
+# strings, rather than a single [latitude, longitude] pair or a string, which the
+# server also accepts. As on the server, a two item list is only taken to be a
+# single pair if it starts with a number.
+def is_coordinates_list(coordinates):
+  if not isinstance(coordinates, (list, tuple)):
+    return False
+  if len(coordinates) == 2 and isinstance(coordinates[0], (int, long, float)):
+    return False
+  return True
+
+# Splits any 'latitude,longitude' strings in a list of coordinates into pairs, since
+# the server only understands a list of pairs
+def split_coordinate_strings(coordinates):
+  result = []
+  for pair in coordinates:
+    if isinstance(pair, basestring):
+      pair = pair.split(',')
+    result.append(pair)
+  return result
+
+# Calls the function on every item, using up to max_workers threads, and returns
+# the results in the same order as the items. If any call raises an exception, no
+# more are started and the first exception is re-raised once the others finish.
+def map_concurrently(function, items, max_workers):
+
+  items = list(items)
+  if max_workers <= 1 or len(items) <= 1:
+    return [function(item) for item in items]
+
+  results = [None] * len(items)
+  errors = []
+  lock = threading.Lock()
+  next_index = [0]
+
+  def worker():
+    while True:
+      with lock:
+        if errors or next_index[0] >= len(items):
+          return
+        index = next_index[0]
+        next_index[0] += 1
+      try:
+        results[index] = function(items[index])
+      except Exception:
+        with lock:
+          errors.append(sys.exc_info())
+        return
+
+  threads = []
+  for i in range(min(max_workers, len(items))):
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+  for thread in threads:
+    thread.join()
+
+  if errors:
+    error_type, error_value, error_traceback = errors[0]
+    raise error_type, error_value, error_traceback
+
+  return results
+
+# Like map_concurrently, but takes the items from an iterator as they're needed and
+# yields the results as they become available, in the same order as the items. No
+# more than a few items per worker are pulled from the iterator ahead of the results
+# being consumed, so memory stays bounded however many items there are.
+def imap_concurrently(function, items, max_workers):
+
+  if not max_workers or max_workers <= 1:
+    for item in items:
+      yield function(item)
+    return
+
+  tasks = Queue.Queue()
+
+  def worker():
+    while True:
+      task = tasks.get()
+      if task is None:
+        return
+      task.run(function)
+
+  threads = []
+  for i in range(max_workers):
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+
+  pending = collections.deque()
+  try:
+    for item in items:
+      task = ConcurrentTask(item)
+      pending.append(task)
+      tasks.put(task)
+      if len(pending) >= (max_workers * 2):
+        yield pending.popleft().result()
+    while len(pending) > 0:
+      yield pending.popleft().result()
+  finally:
+    for task in pending:
+      task.cancelled = True
+    for thread in threads:
+      tasks.put(None)
+    for thread in threads:
+      thread.join()
+
+# One call that's been queued up by imap_concurrently
+class ConcurrentTask:
+
+  def __init__(self, item):
+    self.item = item
+    self.cancelled = False
+    self.value = None
+    self.error = None
+    self.done = threading.Event()
+
+  def run(self, function):
+    if not self.cancelled:
+      try:
+        self.value = function(self.item)
+      except Exception:
+        self.error = sys.exc_info()
+    self.done.set()
+
+  def result(self):
+    # Waiting with a timeout keeps the main thread responsive to Ctrl-C
+    while not self.done.wait(1.0):
+      pass
+    if self.error is not None:
+      error_type, error_value, error_traceback = self.error
+      raise error_type, error_value, error_traceback
+    return self.value
+
+# A geocoding result stored in slots rather than a dictionary. The coordinates
+# are always floats, and the handful of country and region names that repeat
+# across many results share a single copy of each string, taken from the shared
+# dictionary passed in, which compact_results makes fresh for every call. Records
+# can be read like the dictionaries the server returns, with record['latitude'] or
+# record.get(), and to_dict() turns one back into exactly that dictionary. Fields
+# the server left out are left unset, and any fields the class doesn't know about
+# are kept in a dictionary of their own.
+class CompactLocation(object):
+
+  __slots__ = ('extra',)
+
+  FIELDS = ()
+  FLOAT_FIELDS = frozenset(['latitude', 'longitude', 'confidence'])
+  SHARED_FIELDS = frozenset()
+
+  def __init__(self, info, shared=None):
+    for field in self.FIELDS:
+      if field not in info:
+        continue
+      value = info[field]
+      if value is not None:
+        if field in self.FLOAT_FIELDS:
+          value = float(value)
+        elif field in self.SHARED_FIELDS and shared is not None:
+          value = shared.setdefault(value, value)
+      setattr(self, field, value)
+    extra = None
+    for key, value in info.items():
+      if key not in self.FIELDS:
+        if extra is None:
+          extra = {}
+        extra[key] = value
+    self.extra = extra
+
+  def __getitem__(self, key):
+    if key in self.FIELDS:
+      try:
+        return getattr(self, key)
+      except AttributeError:
+        raise KeyError(key)
+    if self.extra is not None and key in self.extra:
+      return self.extra[key]
+    raise KeyError(key)
+
+  def __contains__(self, key):
+    if key in self.FIELDS:
+      return hasattr(self, key)
+    return self.extra is not None and key in self.extra
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def to_dict(self):
+    result = {}
+    for field in self.FIELDS:
+      if hasattr(self, field):
+        result[field] = getattr(self, field)
+    if self.extra is not None:
+      result.update(self.extra)
+    return result
+
+  def __eq__(self, other):
+    if isinstance(other, CompactLocation):
+      other = other.to_dict()
+    return self.to_dict() == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return self.__class__.__name__+'('+repr(self.to_dict())+')'
+
+class IPLocation(CompactLocation):
+
+  FIELDS = ('country_code', 'country_code3', 'country_name', 'region', 'locality',
+    'latitude', 'longitude', 'dma_code', 'area_code', 'postal_code')
+  SHARED_FIELDS = frozenset(['country_code', 'country_code3', 'country_name', 'region'])
+
+  __slots__ = FIELDS
+
+class StreetLocation(CompactLocation):
+
+  FIELDS = ('latitude', 'longitude', 'country_code', 'country_code3', 'country_name',
+    'region', 'locality', 'street_address', 'street_number', 'street_name', 'confidence',
+    'fips_county')
+  SHARED_FIELDS = frozenset(['country_code', 'country_code3', 'country_name', 'region'])
+
+  __slots__ = FIELDS
+
+# Replaces each result in a keyed response with a compact record, leaving the
+# inputs that weren't found as None. The records share strings through a table
+# that only lives as long as the results, so it never grows across calls. The
+# built-in intern() isn't used because it only takes byte strings, whereas the
+# decoded JSON is unicode.
+def compact_results(result, record_class):
+  shared = {}
+  compacted = {}
+  for key, info in result.items():
+    if info is not None:
+      info = record_class(info, shared)
+    compacted[key] = info
+  return compacted
+
+# Holds the columns being filled in for the _columns methods. Numbers are stored
+# in array.array('d') as they arrive, which numpy can then wrap without copying.
+class ResultColumns:
+
+  NUMERIC_FIELDS = frozenset(['latitude', 'longitude', 'confidence'])
+
+  def __init__(self, count, fields):
+    import array
+
+    self.fields = list(fields)
+    self.columns = {}
+    for field in self.fields:
+      if field in self.NUMERIC_FIELDS:
+        self.columns[field] = array.array('d', [float('nan')]) * count
+      else:
+        self.columns[field] = [None] * count
+
+  def set(self, position, info):
+    if info is None:
+      return
+    for field in self.fields:
+      value = info.get(field)
+      if value is None:
+        continue
+      if field in self.NUMERIC_FIELDS:
+        value = float(value)
+      self.columns[field][position] = value
 
-  def html2story(self, html):
-    
-    api_url = self.api_base+'/html2story'
-    api_body = html
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response = json.loads(response_string)
-    
-    if 'error' in response:
-      raise Exception(response['error'])
-    
-    return response
+  def finish(self):
+    try:
+      import numpy
+    except ImportError:
+      return self.columns
 
-  def text2people(self, text):
-    
-    api_url = self.api_base+'/text2people'
-    api_body = text
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response = json.loads(response_string)
-    
-    if 'error' in response:
-      raise Exception(response['error'])
-    
-    return response
+    result = {}
+    for field, column in self.columns.items():
+      if field in self.NUMERIC_FIELDS:
+        result[field] = numpy.frombuffer(column, dtype=numpy.float64)
+      else:
+        result[field] = numpy.array(column, dtype=object)
+    return result
 
-  def text2times(self, text):
-    
-    api_url = self.api_base+'/text2times'
-    api_body = text
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response = json.loads(response_string)
-    
-    if 'error' in response:
-      raise Exception(response['error'])
-    
-    return response
+# Combines the responses from a batched call, in order
+def merge_responses(responses):
+  if len(responses) > 0 and isinstance(responses[0], dict):
+    result = {}
+    for response in responses:
+      result.update(response)
+  else:
+    result = []
+    for response in responses:
+      result.extend(response)
+  return result
 
-  def text2sentiment(self, text):
-    
-    api_url = self.api_base+'/text2sentiment'
-    api_body = text
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response = json.loads(response_string)
-    
-    if 'error' in response:
-      raise Exception(response['error'])
-    
-    return response
+# A multipart/form-data body that's sent in chunks, so that large files never need
+# to be held in memory. The file values can be strings or open file objects, which
+# are read from their current position to the end. len() gives the total size of
+# the body for the Content-Length header, and iterating over it yields the chunks.
+# It can be iterated over more than once, as long as the files are seekable.
+class MultipartBody:
 
-  def coordinates2statistics(self, coordinates):
-    
-    api_url = self.api_base+'/coordinates2statistics'
-    api_body = json.dumps(coordinates)
-    response_string = urllib.urlopen(api_url, api_body).read()
-    response = json.loads(response_string)
-    
-    if 'error' in response:
-      raise Exception(response['error'])
-    
-    return response
+  BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+  CRLF = '\r\n'
+  CHUNK_SIZE = 64*1024
 
-# We need to post files as multipart form data, and Python has no native function for
-# that, so these utility functions implement what we need.
-# See http://code.activestate.com/recipes/146306/ 
-def post_multipart(host, selector, fields, files):
-    """
-    Post fields and files to an http host as multipart/form-data.
-    fields is a sequence of (name, value) elements for regular form fields.
-    files is a sequence of (name, filename, value) elements for data to be uploaded as files
-    Return the server's response page.
-    """
-    content_type, body = encode_multipart_formdata(fields, files)
-    h = httplib.HTTP(host)
-    h.putrequest('POST', selector)
-    h.putheader('content-type', content_type)
-    h.putheader('content-length', str(len(body)))
-    h.endheaders()
-    h.send(body)
-    errcode, errmsg, headers = h.getreply()
-    return h.file.read()
-
-def encode_multipart_formdata(fields, files):
-    """
-    fields is a sequence of (name, value) elements for regular form fields.
-    files is a sequence of (name, filename, value) elements for data to be uploaded as files
-    Return (content_type, body) ready for httplib.HTTP instance
-    """
-    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
-    CRLF = '\r\n'
-    L = []
+  def __init__(self, fields, files):
+    self.content_type = 'multipart/form-data; boundary=%s' % self.BOUNDARY
+    self.parts = []
     for (key, value) in fields:
-        L.append('--' + BOUNDARY)
-        L.append('Content-Disposition: form-data; name="%s"' % key)
-        L.append('')
-        L.append(value)
+      self.parts.append(self.CRLF.join(['--' + self.BOUNDARY,
+        'Content-Disposition: form-data; name="%s"' % key,
+        '',
+        value]) + self.CRLF)
     for (key, filename, value) in files:
-        L.append('--' + BOUNDARY)
-        L.append('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename))
-        L.append('Content-Type: %s' % guess_content_type(filename))
-        L.append('')
-        L.append(value)
-    L.append('--' + BOUNDARY + '--')
-    L.append('')
-    body = CRLF.join(L)
-    content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
-    return content_type, body
+      self.parts.append(self.CRLF.join(['--' + self.BOUNDARY,
+        'Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename),
+        'Content-Type: %s' % guess_content_type(filename),
+        '',
+        '']))
+      if isinstance(value, basestring):
+        self.parts.append(value)
+      else:
+        self.parts.append(FilePart(value))
+      self.parts.append(self.CRLF)
+    self.parts.append('--' + self.BOUNDARY + '--' + self.CRLF)
+
+  def __len__(self):
+    length = 0
+    for part in self.parts:
+      length += len(part)
+    return length
+
+  def __iter__(self):
+    for part in self.parts:
+      if isinstance(part, basestring):
+        yield part
+      else:
+        for chunk in part.iter_chunks(self.CHUNK_SIZE):
+          yield chunk
+
+# The contents of an open file as part of a MultipartBody
+class FilePart:
+
+  def __init__(self, file):
+    self.file = file
+    try:
+      self.start = file.tell()
+      self.length = os.fstat(file.fileno()).st_size - self.start
+    except (AttributeError, IOError, OSError):
+      # Not a real file, so we have no choice but to read it all in to find its size
+      self.file = None
+      self.data = file.read()
+      self.length = len(self.data)
+
+  def __len__(self):
+    return self.length
+
+  def iter_chunks(self, chunk_size):
+    if self.file is None:
+      yield self.data
+      return
+    self.file.seek(self.start)
+    remaining = self.length
+    while remaining > 0:
+      chunk = self.file.read(min(chunk_size, remaining))
+      if not chunk:
+        raise IOError('File was shorter than expected when uploading')
+      remaining -= len(chunk)
+      yield chunk
 
 def guess_content_type(filename):
+    import mimetypes
     return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
 
 # End of the interface. The rest of this file is an example implementation of a
@@ -281,74 +4451,159 @@ def guess_content_type(filename):
 
 def ip2coordinates_cli(dstk, options, inputs, output):
 
-  writer = csv.writer(sys.stdout)
+  import csv
+
+  writer = csv.writer(output)
   
-  input_ips = []
-  for input_line in inputs:
-    ip_match = re.match(r'[12]?\d?\d\.[12]?\d?\d\.[12]?\d?\d\.[12]?\d?\d', input_line)
-    if ip_match is not None:
-      input_ips.append(ip_match.group(0))
-    else:
-      print 'No match'
+  for window in iter_windows(inputs, options.get('windowSize'), options.get('checkpoint')):
 
-  result = dstk.ip2coordinates(input_ips)
+    input_ips = []
+    for input_line in window:
+      ip_match = re.match(r'[12]?\d?\d\.[12]?\d?\d\.[12]?\d?\d\.[12]?\d?\d', input_line)
+      if ip_match is not None:
+        input_ips.append(ip_match.group(0))
+      else:
+        output.write('No match\n')
+
+    if len(input_ips) < 1:
+      continue
+
+    if options.get('fields'):
+      write_columns(dstk.ip2coordinates_columns(input_ips, options['fields']), 'ip_address',
+        input_ips, options, writer)
+      output.flush()
+      continue
+
+    result = dstk.ip2coordinates(input_ips)
   
-  if options['showHeaders']:
+    if options['showHeaders']:
+      for ip, info in result.items():
+        if info is None:
+          continue
+        row = ['ip_address']
+        for key, value in info.items():
+          row.append(str(key))
+        writer.writerow(row)
+        options['showHeaders'] = False
+        break
+      
     for ip, info in result.items():
+
       if info is None:
-        continue
-      row = ['ip_address']
-      for key, value in info.items():
-        row.append(str(key))
-      writer.writerow(row)
-      break
-      
-  for ip, info in result.items():
+        info = {}
 
-    if info is None:
-      info = {}
+      row = [ip]
+      for key, value in info.items():
+        row.append(str(value))
 
-    row = [ip]
-    for key, value in info.items():
-      row.append(str(value))
+      writer.writerow(row)
 
-    writer.writerow(row)
+    output.flush()
     
   return
     
 def street2coordinates_cli(dstk, options, inputs, output):
 
-  writer = csv.writer(sys.stdout)
+  import csv
+
+  writer = csv.writer(output)
+
+  for window in iter_windows(inputs, options.get('windowSize'), options.get('checkpoint')):
+
+    if options.get('fields'):
+      write_columns(dstk.street2coordinates_columns(window, options['fields']), 'address',
+        window, options, writer)
+      output.flush()
+      continue
 
-  result = dstk.street2coordinates(inputs)
+    result = dstk.street2coordinates(window)
   
-  if options['showHeaders']:
+    if options['showHeaders']:
+      for ip, info in result.items():
+        if info is None:
+          continue
+        row = ['address']
+        for key, value in info.items():
+          row.append(str(key))
+        writer.writerow(row)
+        options['showHeaders'] = False
+        break
+
     for ip, info in result.items():
+
       if info is None:
-        continue
-      row = ['address']
+        info = {}
+
+      row = [ip]
       for key, value in info.items():
-        row.append(str(key))
+        row.append(str(value))
+
       writer.writerow(row)
-      break
 
-  for ip, info in result.items():
+    output.flush()
+    
+  return
 
-    if info is None:
-      info = {}
+# Writes a row for each input with the fields chosen by --fields, in that order,
+# leaving fields without a value empty
+def write_columns(columns, input_name, inputs, options, writer):
 
-    row = [ip]
-    for key, value in info.items():
-      row.append(str(value))
+  fields = options['fields']
+  if options['showHeaders']:
+    writer.writerow([input_name]+fields)
+    options['showHeaders'] = False
 
+  for position, input in enumerate(inputs):
+    row = [input.strip()]
+    for field in fields:
+      value = columns[field][position]
+      if value is None or value != value:
+        value = ''
+      row.append(value)
     writer.writerow(row)
-    
-  return
 
 def coordinates2politics_cli(dstk, options, inputs, output):
 
+  import csv
+
   writer = csv.writer(output)
 
+  if options['showHeaders']:
+    row = ['latitude', 'longitude', 'name', 'code', 'type', 'friendly_type']
+    writer.writerow(row)
+
+  for window in iter_windows(inputs, options.get('windowSize'), options.get('checkpoint')):
+
+    coordinates_list = parse_coordinates_inputs(window, output)
+
+    result = dstk.coordinates2politics(coordinates_list)
+  
+    for info in result:
+
+      location = info['location']
+      politics = info['politics']
+
+      # Points that aren't in any known country have no politics at all
+      if politics is None:
+        continue
+
+      for politic in politics:
+        row = [location['latitude'], 
+          location['longitude'], 
+          politic['name'],
+          politic['code'],
+          politic['type'],
+          politic['friendly_type'],
+        ]
+        writer.writerow(row)
+
+    output.flush()
+    
+  return
+
+# Turns lines like '37.76,-122.42' into a list of coordinate pairs, exiting with
+# an error message if any of them aren't in that form
+def parse_coordinates_inputs(inputs, output):
   coordinates_list = []
   for input in inputs:
     coordinates = input.split(',')
@@ -356,50 +4611,26 @@ def coordinates2politics_cli(dstk, options, inputs, output):
       output.write('You must enter coordinates as a series of comma-separated pairs, eg 37.76,-122.42')
       exit(-1)
     coordinates_list.append([coordinates[0], coordinates[1]])
-
-  result = dstk.coordinates2politics(coordinates_list)
-  
-  if options['showHeaders']:
-    row = ['latitude', 'longitude', 'name', 'code', 'type', 'friendly_type']
-    writer.writerow(row)
-      
-  for info in result:
-
-    location = info['location']
-    politics = info['politics']
-
-    for politic in politics:
-      row = [location['latitude'], 
-        location['longitude'], 
-        politic['name'],
-        politic['code'],
-        politic['type'],
-        politic['friendly_type'],
-      ]
-      writer.writerow(row)
-    
-  return
+  return coordinates_list
 
 def file2text_cli(dstk, options, inputs, output):
   
-  for file_name in inputs:
-    if os.path.isdir(file_name):
-      children = os.listdir(file_name)
-      full_children = []
-      for child in children:
-        full_children.append(os.path.join(file_name, child))
-      file2text_cli(dstk, options, full_children)
+  def convert_file(file_name):
+    if re.match(r'http://', file_name):
+      return dstk.file2text(file_name, get_file_or_url_contents(file_name))
     else:
-      file_data = get_file_or_url_contents(file_name)
-      if options['showHeaders']:
-        output.write('--File--: '+file_name+"\n")
-      result = dstk.file2text(file_name, file_data)
-      
-      print result
+      return dstk.file2text(file_name)
+
+  for file_name, result in process_files(options, inputs, convert_file):
+    if options['showHeaders']:
+      output.write('--File--: '+file_name+"\n")
+    print result
   return
 
 def text2places_cli(dstk, options, inputs, output):
 
+  import csv
+
   writer = csv.writer(output)
   
   if options['showHeaders']:
@@ -412,17 +4643,12 @@ def text2places_cli(dstk, options, inputs, output):
     text2places_format(result, 'stdin', writer)
     return
 
-  for file_name in inputs:
-    if os.path.isdir(file_name):
-      children = os.listdir(file_name)
-      full_children = []
-      for child in children:
-        full_children.append(os.path.join(file_name, child))
-      text2places_cli(dstk, options, full_children, output)
-    else:
-      file_data = get_file_or_url_contents(file_name)
-      result = dstk.text2places(file_data)
-      text2places_format(result, file_name, writer)
+  def convert_file(file_name):
+    file_data = get_file_or_url_contents(file_name)
+    return dstk.text2places(file_data)
+
+  for file_name, result in process_files(options, inputs, convert_file):
+    text2places_format(result, file_name, writer)
 
   return
 
@@ -448,19 +4674,14 @@ def html2text_cli(dstk, options, inputs, output):
     print result['text']
     return
 
-  for file_name in inputs:
-    if os.path.isdir(file_name):
-      children = os.listdir(file_name)
-      full_children = []
-      for child in children:
-        full_children.append(os.path.join(file_name, child))
-      html2text_cli(dstk, options, full_children, output)
-    else:
-      file_data = get_file_or_url_contents(file_name)
-      if options['showHeaders']:
-        output.write('--File--: '+file_name+"\n")
-      result = dstk.html2text(file_data)
-      print result['text']
+  def convert_file(file_name):
+    file_data = get_file_or_url_contents(file_name)
+    return dstk.html2text(file_data)
+
+  for file_name, result in process_files(options, inputs, convert_file):
+    if options['showHeaders']:
+      output.write('--File--: '+file_name+"\n")
+    print result['text']
   return
 
 def text2sentences_cli(dstk, options, inputs, output):
@@ -470,19 +4691,14 @@ def text2sentences_cli(dstk, options, inputs, output):
     print result['sentences']
     return
 
-  for file_name in inputs:
-    if os.path.isdir(file_name):
-      children = os.listdir(file_name)
-      full_children = []
-      for child in children:
-        full_children.append(os.path.join(file_name, child))
-      text2sentences_cli(dstk, options, full_children, output)
-    else:
-      file_data = get_file_or_url_contents(file_name)
-      if options['showHeaders']:
-        output.write('--File--: '+file_name+"\n")
-      result = dstk.text2sentences(file_data)
-      print result['sentences']
+  def convert_file(file_name):
+    file_data = get_file_or_url_contents(file_name)
+    return dstk.text2sentences(file_data)
+
+  for file_name, result in process_files(options, inputs, convert_file):
+    if options['showHeaders']:
+      output.write('--File--: '+file_name+"\n")
+    print result['sentences']
 
   return
 
@@ -493,25 +4709,22 @@ def html2story_cli(dstk, options, inputs, output):
     print result['story']
     return
 
-  for file_name in inputs:
-    if os.path.isdir(file_name):
-      children = os.listdir(file_name)
-      full_children = []
-      for child in children:
-        full_children.append(os.path.join(file_name, child))
-      html2story_cli(dstk, options, full_children, output)
-    else:
-      file_data = get_file_or_url_contents(file_name)
-      if options['showHeaders']:
-        output.write('--File--: '+file_name+"\n")
-      result = dstk.html2story(file_data)
-      print result['story']
+  def convert_file(file_name):
+    file_data = get_file_or_url_contents(file_name)
+    return dstk.html2story(file_data)
+
+  for file_name, result in process_files(options, inputs, convert_file):
+    if options['showHeaders']:
+      output.write('--File--: '+file_name+"\n")
+    print result['story']
   
   return
 
 def text2people_cli(dstk, options, inputs, output):
 
-  writer = csv.writer(sys.stdout)
+  import csv
+
+  writer = csv.writer(output)
 
   if options['showHeaders']:
     row = ['matched_string', 'first_name', 'surnames', 'title', 'gender', 'start_index', 'end_index', 'file_name']
@@ -523,17 +4736,12 @@ def text2people_cli(dstk, options, inputs, output):
     text2people_format(result, 'stdin', writer)
     return
 
-  for file_name in inputs:
-    if os.path.isdir(file_name):
-      children = os.listdir(file_name)
-      full_children = []
-      for child in children:
-        full_children.append(os.path.join(file_name, child))
-      text2places_cli(dstk, options, full_children, output)
-    else:
-      file_data = get_file_or_url_contents(file_name)
-      result = dstk.text2people(file_data)
-      text2people_format(result, file_name, writer)
+  def convert_file(file_name):
+    file_data = get_file_or_url_contents(file_name)
+    return dstk.text2people(file_data)
+
+  for file_name, result in process_files(options, inputs, convert_file):
+    text2people_format(result, file_name, writer)
 
   return
 
@@ -555,7 +4763,9 @@ def text2people_format(result, file_name, writer):
 
 def text2times_cli(dstk, options, inputs, output):
 
-  writer = csv.writer(sys.stdout)
+  import csv
+
+  writer = csv.writer(output)
 
   if options['showHeaders']:
     row = ['matched_string', 'time_string', 'time_seconds', 'is_relative', 'start_index', 'end_index', 'file_name']
@@ -567,17 +4777,12 @@ def text2times_cli(dstk, options, inputs, output):
     text2times_format(result, 'stdin', writer)
     return
 
-  for file_name in inputs:
-    if os.path.isdir(file_name):
-      children = os.listdir(file_name)
-      full_children = []
-      for child in children:
-        full_children.append(os.path.join(file_name, child))
-      text2times_cli(dstk, options, full_children, output)
-    else:
-      file_data = get_file_or_url_contents(file_name)
-      result = dstk.text2times(file_data)
-      text2times_format(result, file_name, writer)
+  def convert_file(file_name):
+    file_data = get_file_or_url_contents(file_name)
+    return dstk.text2times(file_data)
+
+  for file_name, result in process_files(options, inputs, convert_file):
+    text2times_format(result, file_name, writer)
 
   return
 
@@ -597,32 +4802,34 @@ def text2times_format(result, file_name, writer):
   return
 
 def text2sentiment_cli(dstk, options, inputs, output):
-  writer = csv.writer(sys.stdout)
+  import csv
+
+  writer = csv.writer(output)
 
   if options['showHeaders']:
     row = ['sentiment', 'sentence', 'file_name']
     writer.writerow(row)
   options['showHeaders'] = False
 
+  chunk_size = options.get('windowSize') or 1000
+
   if options['from_stdin']:
-    result = []
-    for sentence in inputs:
-      result = dstk.text2sentiment(sentence)
-      text2sentiment_format(result, sentence, 'stdin', writer)
+    for sentences in iter_windows(inputs, chunk_size):
+      results = dstk.text2sentiment_batch(sentences)
+      for result, sentence in zip(results, sentences):
+        text2sentiment_format(result, sentence, 'stdin', writer)
     return
 
-  for file_name in inputs:
-    if os.path.isdir(file_name):
-      children = os.listdir(file_name)
-      full_children = []
-      for child in children:
-        full_children.append(os.path.join(file_name, child))
-      text2sentiment_cli(dstk, options, full_children, output)
-    else:
-      file_data = get_file_or_url_contents(file_name)
-      for sentence in file_data.split("\n"):
-        result = dstk.text2sentiment(sentence)
-        text2sentiment_format(result, sentence, 'stdin', writer)
+  def convert_file(file_name):
+    file_data = get_file_or_url_contents(file_name)
+    results = []
+    for sentences in iter_windows(file_data.split("\n"), chunk_size):
+      results.extend(zip(dstk.text2sentiment_batch(sentences), sentences))
+    return results
+
+  for file_name, results in process_files(options, inputs, convert_file):
+    for result, sentence in results:
+      text2sentiment_format(result, sentence, file_name, writer)
 
   return
 
@@ -635,44 +4842,258 @@ def text2sentiment_format(result, sentence, file_name, writer):
   writer.writerow(row)
   return
 
-def coordinates2statistics_cli(dstk, options, inputs, output):
+# Runs the function over every file named in the inputs, and yields each file name
+# along with its result, in the same order the files were found. Directories are
+# walked recursively as we go, rather than all up front. With the 'jobs' option,
+# up to that many files are processed at once. With the 'processedLog' option,
+# files that haven't been modified since they were last processed are skipped, and
+# each file is recorded in the log once its results have been handled.
+def process_files(options, inputs, function):
 
-  writer = csv.writer(output)
+  file_names = iter_input_files(inputs)
 
-  coordinates_list = []
-  for input in inputs:
-    coordinates = input.split(',')
-    if len(coordinates)!=2:
-      output.write('You must enter coordinates as a series of comma-separated pairs, eg 37.76,-122.42')
-      exit(-1)
-    coordinates_list.append([coordinates[0], coordinates[1]])
+  processed_log = None
+  if options.get('processedLog'):
+    processed_log = ProcessedLog(options['processedLog'])
+    file_names = processed_log.filter_unchanged(file_names)
+
+  def process_file(file_name):
+    return file_name, function(file_name)
+
+  try:
+    for file_name, result in imap_concurrently(process_file, file_names, options.get('jobs', 1)):
+      yield file_name, result
+      if processed_log is not None:
+        processed_log.record(file_name)
+  finally:
+    if processed_log is not None:
+      processed_log.close()
 
-  results = dstk.coordinates2statistics(coordinates_list)
+# Yields the names of all the files in the inputs, descending into directories.
+# URLs are passed through untouched.
+def iter_input_files(inputs):
+  for file_name in inputs:
+    if os.path.isdir(file_name):
+      for directory, child_directories, children in os.walk(file_name):
+        child_directories.sort()
+        for child in sorted(children):
+          yield os.path.join(directory, child)
+    else:
+      yield file_name
+
+# Keeps track of which files have already been processed, and when they were last
+# modified at that point, in an append-only log file with a line per file
+class ProcessedLog:
+
+  def __init__(self, file_name):
+    self.modified_times = {}
+    if os.path.exists(file_name):
+      for line in open(file_name):
+        parts = line.rstrip('\n').split('\t', 1)
+        if len(parts) == 2:
+          self.modified_times[parts[1]] = float(parts[0])
+    self.log_file = open(file_name, 'a')
+
+  def modified_time(self, file_name):
+    if re.match(r'http://', file_name):
+      return None
+    return os.path.getmtime(file_name)
+
+  def filter_unchanged(self, file_names):
+    for file_name in file_names:
+      modified_time = self.modified_time(file_name)
+      if modified_time is None or self.modified_times.get(file_name) != modified_time:
+        yield file_name
+
+  def record(self, file_name):
+    modified_time = self.modified_time(file_name)
+    if modified_time is None:
+      return
+    self.modified_times[file_name] = modified_time
+    self.log_file.write(repr(modified_time)+'\t'+file_name+'\n')
+    self.log_file.flush()
+
+  def close(self):
+    self.log_file.close()
+
+def coordinates2statistics_cli(dstk, options, inputs, output):
+
+  import csv
+
+  writer = csv.writer(output)
 
   if options['showHeaders']:
     row = ['latitude', 'longitude', 'statistic', 'value', 'description']
     writer.writerow(row)
 
-  for result in results:
+  for window in iter_windows(inputs, options.get('windowSize'), options.get('checkpoint')):
 
-    location = result['location']
-    statistics = result['statistics']
+    coordinates_list = parse_coordinates_inputs(window, output)
 
-    for statistic, info in statistics.items():
+    results = dstk.coordinates2statistics(coordinates_list, options.get('statistics'))
 
-      value = info['value']
-      description = info['description']
-      row = [location['latitude'],
-        location['longitude'], 
-        statistic,
-        value,
-        description,
-      ]
-      writer.writerow(row)
+    for result in results:
+
+      location = result['location']
+      statistics = result['statistics']
+
+      for statistic, info in statistics.items():
+
+        value = info['value']
+        description = info['description']
+        row = [location['latitude'],
+          location['longitude'], 
+          statistic,
+          value,
+          description,
+        ]
+        writer.writerow(row)
+
+    output.flush()
 
   return
 
+# Splits the inputs into lists of at most window_size items. The inputs are read
+# lazily, so a stream like standard input is never held in memory all at once. With
+# no window_size, all of the inputs are returned as a single list. If a
+# CheckpointJournal is passed in, windows it already holds are skipped.
+def iter_windows(inputs, window_size, checkpoint=None):
+  if checkpoint is not None:
+    for window in checkpoint.iter_windows(iter_windows(inputs, window_size)):
+      yield window
+    return
+  if not window_size:
+    yield list(inputs)
+    return
+  window = []
+  for input in inputs:
+    window.append(input)
+    if len(window) >= window_size:
+      yield window
+      window = []
+  if len(window) > 0:
+    yield window
+
+# Lets a bulk command line job pick up where it left off. Every window of inputs
+# that's finished is appended to the journal file as a line of JSON, holding the
+# offsets of its first and last inputs, a digest of them, and everything that was
+# written to the output while it was being processed. When a job is run again
+# with the same journal, the output of the finished windows is written out again
+# from the file and those windows are skipped, so an interruption only loses the
+# window that was in progress. A line that was cut off part way through by a crash
+# is ignored. Running with different inputs is an error, rather than silently
+# mixing the results of two jobs.
+class CheckpointJournal:
+
+  def __init__(self, file_name, output):
+    self.file_name = file_name
+    self.completed = {}
+    good_length = 0
+    if os.path.exists(file_name):
+      for line in open(file_name, 'rb'):
+        try:
+          record = json.loads(line)
+        except ValueError:
+          break
+        if not line.endswith('\n'):
+          break
+        self.completed[record['start']] = record
+        good_length += len(line)
+    self.journal_file = open(file_name, 'ab')
+    self.journal_file.truncate(good_length)
+    self.output = CheckpointOutput(output)
+
+  def iter_windows(self, windows):
+    start = 0
+    for window in windows:
+      end = start+len(window)
+      digest = window_digest(window)
+      record = self.completed.get(start)
+      if record is not None:
+        if record['end'] != end or record['digest'] != digest:
+          raise Exception('DSTK: The inputs from line '+str(start+1)+' on don\'t match the ones in checkpoint "'+self.file_name+'"')
+        self.output.replay(record['output'].encode('latin-1'))
+      else:
+        yield window
+        self.journal_file.write(json.dumps({
+          'start': start,
+          'end': end,
+          'digest': digest,
+          'output': self.output.take().decode('latin-1'),
+        })+'\n')
+        self.journal_file.flush()
+        os.fsync(self.journal_file.fileno())
+      start = end
+
+  def close(self):
+    self.journal_file.close()
+
+# Passes everything written to it on to the real output, and keeps a copy of what's
+# been written since it was last taken, for the CheckpointJournal to store
+class CheckpointOutput:
+
+  def __init__(self, output):
+    self.output = output
+    self.written = []
+
+  def write(self, data):
+    if isinstance(data, unicode):
+      data = data.encode('utf-8')
+    self.written.append(data)
+    self.output.write(data)
+
+  def flush(self):
+    self.output.flush()
+
+  def take(self):
+    data = ''.join(self.written)
+    self.written = []
+    return data
+
+  def replay(self, data):
+    self.output.write(data)
+    # Anything written before the window, like headers, is already in the replay
+    self.written = []
+
+def window_digest(window):
+  import hashlib
+
+  digest = hashlib.sha1()
+  for input in window:
+    if isinstance(input, unicode):
+      input = input.encode('utf-8')
+    digest.update(str(len(input))+':'+input)
+  return digest.hexdigest()
+
+def compile_ip_database_cli(dstk, options, inputs, output):
+
+  if len(inputs) not in (3, 4):
+    print_usage('compile_ip_database needs a blocks CSV, a locations CSV and an output file name')
+
+  range_count = compile_ip_database(*inputs)
+  output.write('Wrote '+str(range_count)+' address ranges to '+inputs[2]+'\n')
+
+def compile_places_database_cli(dstk, options, inputs, output):
+
+  if len(inputs) == 4:
+    inputs = inputs[:3]+[None]+inputs[3:]
+  elif len(inputs) != 5:
+    print_usage('compile_places_database needs countries, regions and cities CSVs, optionally postal codes, and an output file name')
+
+  compile_places_database(*inputs)
+  output.write('Wrote '+inputs[4]+'\n')
+
+def compile_people_database_cli(dstk, options, inputs, output):
+
+  if len(inputs) != 4:
+    print_usage('compile_people_database needs genderfromname.rb, first names and surnames CSVs, and an output file name')
+
+  name_count = compile_people_database(*inputs)
+  output.write('Wrote '+str(name_count)+' names to '+inputs[3]+'\n')
+
 def get_file_or_url_contents(file_name):
+  import urllib
+
   if re.match(r'http://', file_name):
     file_data = urllib.urlopen(file_name).read()
   else:
@@ -683,7 +5104,11 @@ def print_usage(message=''):
 
   print message
   print "Usage:"
-  print "python dstk.py <command> [-a/--api_base 'http://yourhost.com'] [-h/--show_headers] <inputs>"
+  print "python dstk.py <command> [-a/--api_base 'http://yourhost.com'] [-h/--show_headers] [-w/--window_size N]"
+  print "  [-b/--batch_size N] [-j/--jobs N] [--processed_log FILE] [--ip_database FILE] [--politics_files FILE,FILE...]"
+  print "  [--places_database FILE] [--people_database FILE] [--statistics NAME,NAME...]"
+  print "  [--statistics_directory DIR] [--fields NAME,NAME...] [--spatial_cache PRECISION]"
+  print "  [--checkpoint FILE] [--adaptive] <inputs>"
   print "Where <command> is one of:"
   print "  ip2coordinates          (lat/lons for IP addresses)"
   print "  street2coordinates      (lat/lons for postal addresses)"
@@ -697,7 +5122,34 @@ def print_usage(message=''):
   print "  text2times              (times and dates mentioned in unstructured text)"
   print "  text2sentiment          (estimates the positive or negative sentiment of each line of text)"
   print "  coordinates2statistics  (population/climate/elevation/etc for lat/lon)"
+  print "  compile_ip_database     (builds a local --ip_database from GeoLite City blocks and"
+  print "                          locations CSVs: <blocks.csv> <locations.csv> <output> [countries.csv])"
+  print "  compile_places_database (builds a local --places_database from CSV exports of the server's tables:"
+  print "                          <countries.csv> <regions.csv> <cities.csv> [postal_codes.csv] <output>)"
+  print "  compile_people_database (builds a local --people_database from the server's name data:"
+  print "                          <genderfromname.rb> <first_names.csv> <surnames.csv> <output>)"
   print "If no inputs are specified, then standard input will be read and used"
+  print "With --window_size, standard input is read and processed N lines at a time, and"
+  print "the results for each window are written out as soon as they're ready"
+  print "With --batch_size, list lookups are sent to the server at most N inputs per request, with"
+  print "several requests in flight at once (without it, each window goes in a single request)"
+  print "Directories are processed recursively, and --jobs sets how many files are sent at once"
+  print "With --processed_log, files that haven't changed since they were last processed are skipped"
+  print "With --ip_database, ip2coordinates looks addresses up in that file instead of on the server"
+  print "With --politics_files, coordinates2politics uses the boundaries in those GeoJSON files"
+  print "With --places_database, text2places finds places using that file instead of the server"
+  print "With --people_database, text2people finds names using that file instead of the server"
+  print "With --statistics, coordinates2statistics only looks up the statistics named"
+  print "With --statistics_directory, coordinates2statistics reads the raster layers in that directory"
+  print "With --fields, ip2coordinates and street2coordinates write just those fields, one row per input"
+  print "With --spatial_cache, coordinates2politics and coordinates2statistics answer points in geohash"
+  print "cells of that precision locally once the server has shown the cell has a single answer, and"
+  print "print how many points that saved to standard error at the end"
+  print "With --checkpoint, ip2coordinates, street2coordinates, coordinates2politics and"
+  print "coordinates2statistics record each finished window in that file, and running the same job"
+  print "again with it skips them, repeating their output from the file (windows default to 1000 lines)"
+  print "With --adaptive, the number of requests sent at once and the items in each are tuned to how"
+  print "quickly the server is answering, and the limits reached are printed to standard error at the end"
   print "See http://www.datasciencetoolkit.org/developerdocs for more details"
   print "Examples:"
   print "python dstk.py ip2coordinates 67.169.73.113" 
@@ -711,9 +5163,9 @@ if __name__ == '__main__':
   import sys
 
   commands = {
-    'ip2coordinates': { 'handler': ip2coordinates_cli },
-    'street2coordinates': { 'handler': street2coordinates_cli },
-    'coordinates2politics': { 'handler': coordinates2politics_cli },
+    'ip2coordinates': { 'handler': ip2coordinates_cli, 'checkpoint': True },
+    'street2coordinates': { 'handler': street2coordinates_cli, 'checkpoint': True },
+    'coordinates2politics': { 'handler': coordinates2politics_cli, 'checkpoint': True },
     'text2places': { 'handler': text2places_cli },
     'file2text': { 'handler': file2text_cli },
     'text2sentences': { 'handler': text2sentences_cli },
@@ -722,11 +5174,28 @@ if __name__ == '__main__':
     'text2people': { 'handler': text2people_cli },
     'text2times': { 'handler': text2times_cli },
     'text2sentiment': { 'handler': text2sentiment_cli },
-    'coordinates2statistics': { 'handler': coordinates2statistics_cli },
+    'coordinates2statistics': { 'handler': coordinates2statistics_cli, 'checkpoint': True },
+    'compile_ip_database': { 'handler': compile_ip_database_cli },
+    'compile_places_database': { 'handler': compile_places_database_cli },
+    'compile_people_database': { 'handler': compile_people_database_cli },
   }
   switches = {
     'api_base': True,
-    'show_headers': True
+    'show_headers': True,
+    'window_size': True,
+    'batch_size': True,
+    'jobs': True,
+    'processed_log': True,
+    'ip_database': True,
+    'politics_files': True,
+    'places_database': True,
+    'people_database': True,
+    'statistics': True,
+    'statistics_directory': True,
+    'fields': True,
+    'spatial_cache': True,
+    'checkpoint': True,
+    'adaptive': True,
   }
   
   command = None
@@ -746,6 +5215,14 @@ if __name__ == '__main__':
           option = 'api_base'
         elif letter == 'h':
           option = 'show_headers'
+        elif letter == 'w':
+          option = 'window_size'
+        elif letter == 'b':
+          option = 'batch_size'
+        elif letter == 'j':
+          option = 'jobs'
+        else:
+          option = letter
       else:
         option = arg[2:]
 
@@ -759,6 +5236,73 @@ if __name__ == '__main__':
         ignore_next = True
       elif option == 'show_headers':
         options['showHeaders'] = True
+      elif option == 'window_size':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['windowSize'] = int(sys.argv[index+2])
+        ignore_next = True
+      elif option == 'batch_size':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['batchSize'] = int(sys.argv[index+2])
+        ignore_next = True
+      elif option == 'jobs':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['jobs'] = int(sys.argv[index+2])
+        ignore_next = True
+      elif option == 'processed_log':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['processedLog'] = sys.argv[index+2]
+        ignore_next = True
+      elif option == 'ip_database':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['ipDatabaseFile'] = sys.argv[index+2]
+        ignore_next = True
+      elif option == 'politics_files':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['politicsFiles'] = sys.argv[index+2].split(',')
+        ignore_next = True
+      elif option == 'places_database':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['placesDatabaseFile'] = sys.argv[index+2]
+        ignore_next = True
+      elif option == 'people_database':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['peopleDatabaseFile'] = sys.argv[index+2]
+        ignore_next = True
+      elif option == 'statistics':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['statistics'] = sys.argv[index+2].split(',')
+        ignore_next = True
+      elif option == 'statistics_directory':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['statisticsDirectory'] = sys.argv[index+2]
+        ignore_next = True
+      elif option == 'fields':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['fields'] = sys.argv[index+2].split(',')
+        ignore_next = True
+      elif option == 'spatial_cache':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['spatialCachePrecision'] = int(sys.argv[index+2])
+        ignore_next = True
+      elif option == 'adaptive':
+        options['adaptiveConcurrency'] = True
+      elif option == 'checkpoint':
+        if (index+2) >= len(sys.argv):
+          print_usage('Missing argument for option "'+arg+'"')
+        options['checkpointFile'] = sys.argv[index+2]
+        ignore_next = True
     
     else:
       if command is None:
@@ -770,15 +5314,53 @@ if __name__ == '__main__':
 
   if command is None:
     print_usage('No command specified')
+
+  command_info = commands[command]
+
+  if options.get('checkpointFile') and not command_info.get('checkpoint'):
+    print_usage('--checkpoint can\'t be used with '+command)
+
+  # Checkpoints are kept per window, so there have to be several of them
+  if options.get('checkpointFile') and not options.get('windowSize'):
+    options['windowSize'] = 1000
         
   if len(inputs)<1:
     options['from_stdin'] = True
-    inputs = sys.stdin.readlines()
+    if options.get('windowSize'):
+      inputs = iter(sys.stdin.readline, '')
+    else:
+      inputs = sys.stdin.readlines()
   else:
     options['from_stdin'] = False    
   
-  command_info = commands[command]
+  # Make sure every job can have its own connection to the server
+  if options.get('jobs', 1) > 4:
+    options['poolMaxPerHost'] = options['jobs']
+    options['poolSize'] = max(10, options['jobs'])
   
+  # Each run is short, so remember the version check between them
+  if 'versionCacheFile' not in options:
+    options['versionCacheFile'] = os.path.join(os.path.expanduser('~'),
+      '.dstk_version_cache')
+
   dstk = DSTK(options)
+
+  output = sys.stdout
+  if options.get('checkpointFile'):
+    checkpoint = CheckpointJournal(options['checkpointFile'], sys.stdout)
+    options['checkpoint'] = checkpoint
+    output = checkpoint.output
+    # The headers were written out along with the first window
+    if len(checkpoint.completed) > 0:
+      options['showHeaders'] = False
   
-  command_info['handler'](dstk, options, inputs, sys.stdout)
+  command_info['handler'](dstk, options, inputs, output)
+
+  if options.get('checkpoint') is not None:
+    options['checkpoint'].close()
+
+  if dstk.concurrency is not None:
+    sys.stderr.write('Adaptive limits: '+json.dumps(dstk.concurrency.limits(), sort_keys=True)+'\n')
+
+  if dstk.spatial_cache is not None:
+    sys.stderr.write('Spatial cache: '+json.dumps(dstk.spatial_cache.stats(), sort_keys=True)+'\n')
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# Asynchronous Python interface to the Data Science Toolkit
+# version: 1.50 (2013-05-14)
+#
+# See http://www.datasciencetoolkit.org/developerdocs#python for full details
+#
+# All code (C) Pete Warden, 2011
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import mimetypes
+import os
+import time
+import urllib.parse
+
+
+# This mirrors the DSTK class in dstk.py, but every endpoint method is a coroutine,
+# so a single event loop can keep many requests in flight at once. It needs Python
+# 3.5 or later. You use it like this:
+# dstk = AsyncDSTK()
+# coordinates = await dstk.ip2coordinates('12.34.56.78')
+# or, to fan out a lot of calls at once:
+# results = await asyncio.gather(*[dstk.text2places(text) for text in texts])
+#
+# At most 'maxInFlight' requests are sent at once, and the rest wait their turn.
+# Every call takes an optional timeout in seconds, defaulting to the 'timeout'
+# option, and raises asyncio.TimeoutError if it's exceeded. Cancelling the task
+# that's awaiting a call abandons the request and closes its connection. Idle
+# connections are kept alive and reused, as with the DSTK class. No more than
+# 'poolSize' connections are open at once, or 'poolMaxPerHost' to any one server,
+# and close() shuts them all down. Responses with an error status raise an
+# exception holding the server's error message.
+class AsyncDSTK:
+
+  api_base = None
+
+  def __init__(self, options=None):
+    if options is None:
+      options = {}
+
+    defaultOptions = {
+      'apiBase': 'http://www.datasciencetoolkit.org',
+      'maxInFlight': 100,
+      'poolSize': 100,
+      'poolMaxPerHost': 100,
+      'poolIdleTimeout': 30,
+      'timeout': None,
+    }
+
+    if 'DSTK_API_BASE' in os.environ:
+      defaultOptions['apiBase'] = os.environ['DSTK_API_BASE']
+
+    for key, value in defaultOptions.items():
+      if key not in options:
+        options[key] = value
+
+    self.api_base = options['apiBase']
+    self.timeout = options['timeout']
+    self.max_in_flight = options['maxInFlight']
+    self.pool = AsyncConnectionPool(options['poolSize'], options['poolIdleTimeout'],
+      options['poolMaxPerHost'])
+    self.in_flight = None
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+
+  async def close(self):
+    await self.pool.close()
+
+  async def check_version(self, timeout=None):
+
+    required_version = 50
+
+    api_url = self.api_base+'/info'
+
+    try:
+      response_string = await self.api_request('/info', timeout=timeout)
+      response = json.loads(response_string.decode('utf-8'))
+    except (OSError, ValueError, asyncio.TimeoutError):
+      raise Exception('The server at "'+self.api_base+'" doesn\'t seem to be running DSTK, no version information found.')
+
+    actual_version = response['version']
+    if actual_version < required_version:
+      raise Exception('DSTK: Version '+str(actual_version)+' found at "'+api_url+'" but '+str(required_version)+' is required')
+
+  # Sends a request to the endpoint and returns the raw bytes of the response. With
+  # no body this is a GET, otherwise a POST.
+  async def api_request(self, endpoint, body=None, content_type=None, timeout=None):
+
+    if timeout is None:
+      timeout = self.timeout
+
+    # The semaphore has to be created inside the running loop on older Pythons
+    if self.in_flight is None:
+      self.in_flight = asyncio.Semaphore(self.max_in_flight)
+
+    headers = {}
+    if body is None:
+      method = 'GET'
+    else:
+      method = 'POST'
+      if isinstance(body, str):
+        body = body.encode('utf-8')
+      if content_type is None:
+        content_type = 'application/x-www-form-urlencoded'
+      headers['Content-Type'] = content_type
+
+    async with self.in_flight:
+      request = self.pool.request(method, self.api_base+endpoint, body, headers)
+      if timeout is None:
+        status, response_string = await request
+      else:
+        status, response_string = await asyncio.wait_for(request, timeout)
+
+    if status < 200 or status >= 300:
+      try:
+        error = json.loads(response_string.decode('utf-8'))['error']
+      except (ValueError, KeyError, TypeError):
+        error = 'DSTK: '+endpoint+' returned status '+str(status)
+      raise Exception(error)
+
+    return response_string
+
+  # Posts the body to an endpoint that returns JSON, and decodes the result
+  async def api_call(self, endpoint, body, encoding='utf-8', timeout=None):
+
+    response_string = await self.api_request(endpoint, body, timeout=timeout)
+    response = json.loads(response_string.decode(encoding))
+
+    if 'error' in response:
+      raise Exception(response['error'])
+
+    return response
+
+  async def ip2coordinates(self, ips, timeout=None):
+
+    if not isinstance(ips, (list, tuple)):
+      ips = [ips]
+
+    return await self.api_call('/ip2coordinates', json.dumps(ips), timeout=timeout)
+
+  async def street2coordinates(self, addresses, timeout=None):
+
+    if not isinstance(addresses, (list, tuple)):
+      addresses = [addresses]
+
+    return await self.api_call('/street2coordinates', json.dumps(addresses),
+      'latin-1', timeout)
+
+  async def coordinates2politics(self, coordinates, timeout=None):
+
+    return await self.api_call('/coordinates2politics', json.dumps(coordinates),
+      timeout=timeout)
+
+  async def text2places(self, text, timeout=None):
+
+    return await self.api_call('/text2places', text, timeout=timeout)
+
+  async def file2text(self, file_name, file_data, timeout=None):
+
+    if isinstance(file_data, str):
+      file_data = file_data.encode('utf-8')
+
+    content_type, body = encode_multipart_formdata([],
+      [('inputfile', file_name, file_data)])
+
+    response_string = await self.api_request('/file2text', body, content_type, timeout)
+
+    return response_string.decode('utf-8', 'replace')
+
+  async def text2sentences(self, text, timeout=None):
+
+    return await self.api_call('/text2sentences', text, timeout=timeout)
+
+  async def html2text(self, html, timeout=None):
+
+    return await self.api_call('/html2text', html, timeout=timeout)
+
+  async def html2story(self, html, timeout=None):
+
+    return await self.api_call('/html2story', html, timeout=timeout)
+
+  async def text2people(self, text, timeout=None):
+
+    return await self.api_call('/text2people', text, timeout=timeout)
+
+  async def text2times(self, text, timeout=None):
+
+    return await self.api_call('/text2times', text, timeout=timeout)
+
+  async def text2sentiment(self, text, timeout=None):
+
+    return await self.api_call('/text2sentiment', text, timeout=timeout)
+
+  async def coordinates2statistics(self, coordinates, timeout=None):
+
+    return await self.api_call('/coordinates2statistics', json.dumps(coordinates),
+      timeout=timeout)
+
+# Keeps HTTP/1.1 connections open between requests, so they can be reused without
+# another TCP handshake. No more than max_size connections are open at once, idle
+# ones included, and the oldest idle connection is closed to make room for a new
+# one if needed. Any that haven't been used for idle_timeout seconds are closed
+# instead of being reused. Requests wait their turn once max_per_host connections
+# to a server, or max_size in all, are in use.
+class AsyncConnectionPool:
+
+  def __init__(self, max_size=100, idle_timeout=30, max_per_host=100):
+    self.max_size = max(1, max_size)
+    self.idle_timeout = idle_timeout
+    self.max_per_host = max(1, min(max_per_host, self.max_size))
+    self.idle_connections = {}
+    self.host_slots = {}
+    self.slots = None
+    self.open_count = 0
+
+  async def request(self, method, url, body, headers):
+
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.hostname, parts.port)
+    # The semaphores have to be created inside the running loop on older Pythons
+    if self.slots is None:
+      self.slots = asyncio.Semaphore(self.max_size)
+    if key not in self.host_slots:
+      self.host_slots[key] = asyncio.Semaphore(self.max_per_host)
+
+    # Waiting for the host first means a busy server doesn't hold on to slots that
+    # requests to other servers could be using
+    async with self.host_slots[key]:
+      async with self.slots:
+        return await self.request_on_host(key, parts, method, body, headers)
+
+  async def request_on_host(self, key, parts, method, body, headers):
+
+    selector = parts.path or '/'
+    if parts.query:
+      selector += '?'+parts.query
+
+    request_lines = [method+' '+selector+' HTTP/1.1', 'Host: '+parts.netloc]
+    for name, value in headers.items():
+      request_lines.append(name+': '+value)
+    if body is not None:
+      request_lines.append('Content-Length: '+str(len(body)))
+    request_data = ('\r\n'.join(request_lines)+'\r\n\r\n').encode('latin-1')
+    if body is not None:
+      request_data += body
+
+    # A kept-alive connection may have been closed by the server while it was idle,
+    # so if a reused one fails before we see a response we retry on a new one.
+    reader, writer, reused = await self.acquire(key)
+    try:
+      status, response_headers, response_string, will_close = await send_request(
+        reader, writer, request_data)
+    except (ConnectionError, asyncio.IncompleteReadError):
+      self.close_connection(writer)
+      if not reused:
+        raise
+      reader, writer, reused = await self.acquire(key, True)
+      try:
+        status, response_headers, response_string, will_close = await send_request(
+          reader, writer, request_data)
+      except BaseException:
+        self.close_connection(writer)
+        raise
+    except BaseException:
+      # This includes cancellation and timeouts, which leave the connection in an
+      # unknown state, so it can't be reused
+      self.close_connection(writer)
+      raise
+
+    if will_close:
+      self.close_connection(writer)
+    else:
+      self.release(key, reader, writer)
+
+    return status, response_string
+
+  async def acquire(self, key, fresh=False):
+    idle = self.idle_connections.get(key, [])
+    cutoff = time.time()-self.idle_timeout
+    while idle and not fresh:
+      reader, writer, last_used = idle.pop()
+      if last_used >= cutoff and not reader.at_eof():
+        return reader, writer, True
+      self.close_connection(writer)
+
+    # Every connection that's in use holds a slot, so if we're at the limit at
+    # least one of the open connections must be idle
+    if self.open_count >= self.max_size:
+      self.close_oldest_idle()
+
+    scheme, host, port = key
+    self.open_count += 1
+    try:
+      if scheme == 'https':
+        reader, writer = await asyncio.open_connection(host, port or 443, ssl=True)
+      else:
+        reader, writer = await asyncio.open_connection(host, port or 80)
+    except BaseException:
+      self.open_count -= 1
+      raise
+    return reader, writer, False
+
+  def release(self, key, reader, writer):
+    self.idle_connections.setdefault(key, []).append((reader, writer, time.time()))
+
+  def close_oldest_idle(self):
+    oldest_key = None
+    oldest_time = None
+    for key, idle in self.idle_connections.items():
+      if idle and (oldest_time is None or idle[0][2] < oldest_time):
+        oldest_key = key
+        oldest_time = idle[0][2]
+    if oldest_key is not None:
+      reader, writer, last_used = self.idle_connections[oldest_key].pop(0)
+      self.close_connection(writer)
+
+  def close_connection(self, writer):
+    self.open_count -= 1
+    writer.close()
+
+  async def close(self):
+    for key, idle in self.idle_connections.items():
+      for reader, writer, last_used in idle:
+        self.close_connection(writer)
+    self.idle_connections = {}
+
+# Writes a complete request to the connection and reads back the response
+async def send_request(reader, writer, request_data):
+
+  writer.write(request_data)
+  await writer.drain()
+
+  status_line = await reader.readline()
+  if not status_line:
+    raise ConnectionError('The server closed the connection')
+  status_parts = status_line.decode('latin-1').split(None, 2)
+  version = status_parts[0]
+  status = int(status_parts[1])
+
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b'\n', b''):
+      break
+    name, value = line.decode('latin-1').split(':', 1)
+    headers[name.strip().lower()] = value.strip()
+
+  connection_header = headers.get('connection', '').lower()
+  will_close = (connection_header == 'close' or
+    (version == 'HTTP/1.0' and connection_header != 'keep-alive'))
+
+  if headers.get('transfer-encoding', '').lower() == 'chunked':
+    chunks = []
+    while True:
+      size_line = await reader.readline()
+      size = int(size_line.split(b';')[0].strip(), 16)
+      if size == 0:
+        # Skip any trailers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+          pass
+        break
+      chunks.append(await reader.readexactly(size))
+      await reader.readexactly(2)
+    body = b''.join(chunks)
+  elif 'content-length' in headers:
+    body = await reader.readexactly(int(headers['content-length']))
+  else:
+    body = await reader.read()
+    will_close = True
+
+  return status, headers, body, will_close
+
+# The same multipart encoding as dstk.py's MultipartBody, but built in memory
+def encode_multipart_formdata(fields, files):
+    """
+    fields is a sequence of (name, value) elements for regular form fields.
+    files is a sequence of (name, filename, value) elements for data to be uploaded as files
+    Return (content_type, body) ready to be posted
+    """
+    BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
+    CRLF = b'\r\n'
+    L = []
+    for (key, value) in fields:
+        L.append(('--' + BOUNDARY).encode('latin-1'))
+        L.append(('Content-Disposition: form-data; name="%s"' % key).encode('utf-8'))
+        L.append(b'')
+        L.append(value.encode('utf-8') if isinstance(value, str) else value)
+    for (key, filename, value) in files:
+        L.append(('--' + BOUNDARY).encode('latin-1'))
+        L.append(('Content-Disposition: form-data; name="%s"; filename="%s"' % (key, filename)).encode('utf-8'))
+        L.append(('Content-Type: %s' % guess_content_type(filename)).encode('latin-1'))
+        L.append(b'')
+        L.append(value)
+    L.append(('--' + BOUNDARY + '--').encode('latin-1'))
+    L.append(b'')
+    body = CRLF.join(L)
+    content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
+    return content_type, body
+
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
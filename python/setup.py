@@ -1,7 +1,14 @@
+import sys
 from distutils.core import setup
+
+# dstk_async uses async/await, so it can only be installed on Python 3.5 or later
+py_modules = ['dstk']
+if sys.version_info >= (3, 5):
+  py_modules.append('dstk_async')
+
 setup(name='dstk',
       version='0.50',
-      py_modules=['dstk'],
+      py_modules=py_modules,
       author='Pete Warden',
       author_email='pete@petewarden.com',
       url='http://www.datasciencetoolkit.org/'
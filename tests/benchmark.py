@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+#
+# Measures the throughput of the Python client, so that changes to it can be
+# checked for speed regressions.
+#
+# Every DSTK method and command-line handler is driven with the inputs in
+# tests/data, at several batch sizes and concurrency levels. By default the
+# requests go to the stand-in server in fake_server.py, which is started on a free
+# local port, so the numbers measure the client rather than the server or the
+# network. Use -a to point it at a real server instead.
+#
+# For each scenario it prints requests/sec, items/sec, the 50th and 99th percentile
+# request latencies, and the peak memory use of the process that ran it. Each
+# scenario runs in its own process so that the memory figures are independent.
+#
+# python benchmark.py [options] [scenario name filters]
+#
+# --save_baseline FILE   Write the results to a JSON file
+# --baseline FILE        Compare against saved results, and exit with an error if
+#                        any scenario is more than --tolerance slower
+#
+# You can also import dstk from somewhere else by setting PYTHONPATH, otherwise the
+# copy in ../python is used.
+
+import json
+import optparse
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import urllib2
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(TESTS_DIR, 'data')
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+
+BATCH_SIZES = [1, 10, 100]
+CONCURRENCY_LEVELS = [1, 4, 16]
+
+def read_lines(file_name):
+  lines = []
+  for line in open(os.path.join(DATA_DIR, file_name)):
+    line = line.strip()
+    if line != '':
+      lines.append(line)
+  return lines
+
+# The client removes duplicates before sending anything, so to make the server do
+# the same amount of work at every batch size, each of the inputs is made unique
+def make_ips(count):
+  ips = read_lines('ip2coordinates.txt')
+  result = []
+  for index in range(count):
+    parts = ips[index % len(ips)].split('.')
+    parts[2] = str((int(parts[2]) + index // 256) % 256)
+    parts[3] = str((int(parts[3]) + index) % 256)
+    result.append('.'.join(parts))
+  return result
+
+def make_addresses(count):
+  addresses = read_lines('street2coordinates.txt')
+  result = []
+  for index in range(count):
+    result.append('Unit '+str(index)+', '+addresses[index % len(addresses)])
+  return result
+
+def make_coordinates(count):
+  coordinates = []
+  for line in read_lines('coordinates2politics.csv'):
+    latitude, longitude = line.split(',')
+    coordinates.append((float(latitude), float(longitude)))
+  result = []
+  for index in range(count):
+    latitude, longitude = coordinates[index % len(coordinates)]
+    result.append([latitude + index * 0.000001, longitude])
+  return result
+
+def make_texts(count):
+  texts = read_lines('text2times.txt')
+  result = []
+  for index in range(count):
+    result.append(texts[index % len(texts)]+' '+str(index))
+  return result
+
+def text_file_names():
+  return [os.path.join(DATA_DIR, name) for name in ('text2times.txt', 'hungarian.html')]
+
+def document_file_names():
+  names = []
+  for name in sorted(os.listdir(DATA_DIR)):
+    if os.path.splitext(name)[1] in ('.pdf', '.doc', '.xls', '.xlsx', '.html'):
+      names.append(os.path.join(DATA_DIR, name))
+  return names
+
+# Each scenario is a function that takes the client, a batch size, a concurrency
+# level and a number of items to process, and returns how many items it handled
+def batch_method(method_name, make_inputs):
+  def run(client, batch_size, concurrency, count):
+    inputs = make_inputs(count)
+    getattr(client, method_name)(inputs)
+    return len(inputs)
+  return run
+
+def text_method(method_name, make_inputs):
+  def run(client, batch_size, concurrency, count):
+    inputs = make_inputs(count)
+    dstk.map_concurrently(getattr(client, method_name), inputs, concurrency)
+    return len(inputs)
+  return run
+
+def file2text_method(client, batch_size, concurrency, count):
+  file_names = document_file_names()
+  inputs = [file_names[index % len(file_names)] for index in range(count)]
+  dstk.map_concurrently(client.file2text, inputs, concurrency)
+  return len(inputs)
+
+def html_method(method_name):
+  html = open(os.path.join(DATA_DIR, 'hungarian.html')).read()
+  def run(client, batch_size, concurrency, count):
+    inputs = [html+'<!-- '+str(index)+' -->' for index in range(count)]
+    dstk.map_concurrently(getattr(client, method_name), inputs, concurrency)
+    return len(inputs)
+  return run
+
+def line_cli(handler, make_inputs, format_input=str):
+  def run(client, batch_size, concurrency, count):
+    inputs = [format_input(item)+'\n' for item in make_inputs(count)]
+    options = {'showHeaders': True, 'windowSize': batch_size, 'from_stdin': True}
+    handler(client, options, inputs, NullOutput())
+    return len(inputs)
+  return run
+
+def file_cli(handler, make_file_names):
+  def run(client, batch_size, concurrency, count):
+    file_names = make_file_names()
+    inputs = [file_names[index % len(file_names)] for index in range(count)]
+    options = {'showHeaders': False, 'jobs': concurrency, 'from_stdin': False}
+    handler(client, options, inputs, NullOutput())
+    return len(inputs)
+  return run
+
+def format_coordinates(coordinates):
+  return str(coordinates[0])+','+str(coordinates[1])
+
+# Swallows the output of the command-line handlers
+class NullOutput:
+
+  def write(self, data):
+    pass
+
+  def flush(self):
+    pass
+
+# Scenarios that send many items per request are run at every batch size and
+# concurrency level, and the ones that send a single item per request are run at
+# every concurrency level
+BATCH_SCENARIOS = [
+  ('ip2coordinates', batch_method('ip2coordinates', make_ips)),
+  ('street2coordinates', batch_method('street2coordinates', make_addresses)),
+  ('coordinates2politics', batch_method('coordinates2politics', make_coordinates)),
+  ('coordinates2statistics', batch_method('coordinates2statistics', make_coordinates)),
+  ('text2sentiment_batch', batch_method('text2sentiment_batch', make_texts)),
+  ('cli:ip2coordinates', line_cli(dstk.ip2coordinates_cli, make_ips)),
+  ('cli:street2coordinates', line_cli(dstk.street2coordinates_cli, make_addresses)),
+  ('cli:coordinates2politics', line_cli(dstk.coordinates2politics_cli, make_coordinates,
+    format_coordinates)),
+  ('cli:coordinates2statistics', line_cli(dstk.coordinates2statistics_cli, make_coordinates,
+    format_coordinates)),
+]
+
+SINGLE_SCENARIOS = [
+  ('text2places', text_method('text2places', make_texts)),
+  ('text2sentences', text_method('text2sentences', make_texts)),
+  ('html2text', html_method('html2text')),
+  ('html2story', html_method('html2story')),
+  ('text2people', text_method('text2people', make_texts)),
+  ('text2times', text_method('text2times', make_texts)),
+  ('text2sentiment', text_method('text2sentiment', make_texts)),
+  ('file2text', file2text_method),
+  ('cli:text2places', file_cli(dstk.text2places_cli, text_file_names)),
+  ('cli:text2sentences', file_cli(dstk.text2sentences_cli, text_file_names)),
+  ('cli:html2text', file_cli(dstk.html2text_cli, text_file_names)),
+  ('cli:html2story', file_cli(dstk.html2story_cli, text_file_names)),
+  ('cli:text2people', file_cli(dstk.text2people_cli, text_file_names)),
+  ('cli:text2times', file_cli(dstk.text2times_cli, text_file_names)),
+  ('cli:text2sentiment', file_cli(dstk.text2sentiment_cli, text_file_names)),
+  ('cli:file2text', file_cli(dstk.file2text_cli, document_file_names)),
+]
+
+def list_scenarios():
+  result = []
+  for name, function in BATCH_SCENARIOS:
+    for batch_size in BATCH_SIZES:
+      for concurrency in CONCURRENCY_LEVELS:
+        result.append((name, batch_size, concurrency))
+  for name, function in SINGLE_SCENARIOS:
+    for concurrency in CONCURRENCY_LEVELS:
+      result.append((name, 1, concurrency))
+  return result
+
+def scenario_label(name, batch_size, concurrency):
+  return name+' batch='+str(batch_size)+' concurrency='+str(concurrency)
+
+def percentile(values, fraction):
+  if len(values) == 0:
+    return None
+  values = sorted(values)
+  return values[min(len(values)-1, int(len(values) * fraction))]
+
+def peak_rss_megabytes():
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Linux reports this in kilobytes, and OS X in bytes
+  if sys.platform == 'darwin':
+    peak /= 1024
+  return peak / 1024.0
+
+# Runs one scenario in this process and returns its measurements
+def run_scenario(api_base, name, batch_size, concurrency, count):
+
+  function = dict(BATCH_SCENARIOS + SINGLE_SCENARIOS)[name]
+
+  # Leave batching of anything else, like the sentences in text2sentiment files, to
+  # the client's defaults
+  if name not in dict(BATCH_SCENARIOS):
+    batch_size = None
+
+  latencies = []
+  def record_sample(endpoint, sample):
+    latencies.append(sample['encode_seconds']+sample['network_seconds']+sample['decode_seconds'])
+
+  client = dstk.DSTK({
+    'apiBase': api_base,
+    'checkVersion': False,
+    'batchSize': batch_size,
+    'batchConcurrency': concurrency,
+    'poolMaxPerHost': max(4, concurrency),
+    'poolSize': max(10, concurrency),
+    'memoryCacheSize': 0,
+    'metricsCallback': record_sample,
+  })
+
+  # Some of the command-line handlers print directly to stdout
+  stdout = sys.stdout
+  sys.stdout = NullOutput()
+  try:
+    start = time.time()
+    items = function(client, batch_size, concurrency, count)
+    elapsed = time.time()-start
+  finally:
+    sys.stdout = stdout
+  client.close()
+
+  return {
+    'requests': len(latencies),
+    'items': items,
+    'seconds': elapsed,
+    'requests_per_second': len(latencies) / elapsed,
+    'items_per_second': items / elapsed,
+    'p50_ms': percentile(latencies, 0.5) * 1000,
+    'p99_ms': percentile(latencies, 0.99) * 1000,
+    'peak_rss_mb': peak_rss_megabytes(),
+  }
+
+def run_scenario_process(api_base, name, batch_size, concurrency, count):
+  command = [sys.executable, os.path.abspath(__file__), '--run_scenario',
+    json.dumps([api_base, name, batch_size, concurrency, count])]
+  output = subprocess.check_output(command)
+  return json.loads(output.splitlines()[-1])
+
+def find_free_port():
+  probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  probe.bind(('127.0.0.1', 0))
+  port = probe.getsockname()[1]
+  probe.close()
+  return port
+
+def start_fake_server(delay):
+  port = find_free_port()
+  process = subprocess.Popen([sys.executable, os.path.join(TESTS_DIR, 'fake_server.py'),
+    str(port), str(delay)], stdout=subprocess.PIPE)
+  api_base = 'http://127.0.0.1:'+str(port)
+  for attempt in range(100):
+    try:
+      urllib2.urlopen(api_base+'/info').read()
+      return process, api_base
+    except (urllib2.URLError, socket.error):
+      time.sleep(0.05)
+  process.kill()
+  raise Exception('The fake DSTK server didn\'t start')
+
+# Returns a list of descriptions of any scenarios that got worse than the baseline
+def find_regressions(results, baseline, tolerance):
+  regressions = []
+  for label, result in sorted(results.items()):
+    if label not in baseline:
+      continue
+    expected = baseline[label]
+    if result['items_per_second'] < expected['items_per_second'] * (1 - tolerance):
+      regressions.append('%s: %.0f items/s, baseline %.0f' % (label,
+        result['items_per_second'], expected['items_per_second']))
+    # Ignore tiny latencies, where timing noise swamps the differences
+    limit = max(expected['p99_ms'] * (1 + tolerance), expected['p99_ms'] + 1)
+    if result['p99_ms'] > limit:
+      regressions.append('%s: p99 %.1fms, baseline %.1fms' % (label,
+        result['p99_ms'], expected['p99_ms']))
+  return regressions
+
+def print_result(label, result):
+  print '%-62s %7d %9.0f %9.0f %8.2f %8.2f %8.1f' % (label, result['requests'],
+    result['requests_per_second'], result['items_per_second'], result['p50_ms'],
+    result['p99_ms'], result['peak_rss_mb'])
+  sys.stdout.flush()
+
+if __name__ == '__main__':
+
+  if len(sys.argv) == 3 and sys.argv[1] == '--run_scenario':
+    api_base, name, batch_size, concurrency, count = json.loads(sys.argv[2])
+    print json.dumps(run_scenario(str(api_base), name, batch_size, concurrency, count))
+    sys.exit(0)
+
+  parser = optparse.OptionParser(usage='%prog [options] [scenario name filters]')
+  parser.add_option('-a', '--api_base', help='Benchmark against this server instead of a local fake one')
+  parser.add_option('-n', '--items', type='int', default=500, help='Items to process in each scenario')
+  parser.add_option('-d', '--delay', type='float', default=0, help='Seconds the fake server waits before each response')
+  parser.add_option('--save_baseline', help='Write the results to this JSON file')
+  parser.add_option('--baseline', help='Compare the results with this JSON file')
+  parser.add_option('--tolerance', type='float', default=0.2, help='Fraction of slowdown allowed before reporting a regression')
+  options, filters = parser.parse_args()
+
+  server = None
+  api_base = options.api_base
+  if api_base is None:
+    server, api_base = start_fake_server(options.delay)
+
+  results = {}
+  try:
+    print '%-62s %7s %9s %9s %8s %8s %8s' % ('scenario', 'reqs', 'reqs/s', 'items/s',
+      'p50 ms', 'p99 ms', 'rss MB')
+    for name, batch_size, concurrency in list_scenarios():
+      label = scenario_label(name, batch_size, concurrency)
+      if filters and not any(filter in label for filter in filters):
+        continue
+      result = run_scenario_process(api_base, name, batch_size, concurrency, options.items)
+      results[label] = result
+      print_result(label, result)
+  finally:
+    if server is not None:
+      server.kill()
+
+  if options.save_baseline:
+    output = open(options.save_baseline, 'w')
+    json.dump(results, output, indent=2, sort_keys=True)
+    output.close()
+    print 'Saved baseline to '+options.save_baseline
+
+  if options.baseline:
+    baseline = json.load(open(options.baseline))
+    regressions = find_regressions(results, baseline, options.tolerance)
+    if len(regressions) > 0:
+      print 'Regressions compared to '+options.baseline+':'
+      for regression in regressions:
+        print '  '+regression
+      sys.exit(1)
+    print 'No regressions compared to '+options.baseline
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+#
+# A stand-in for the DSTK server, for testing and benchmarking the Python client
+# without a live server or any of the geographic data it needs.
+#
+# It answers every route the client uses with made-up results in the same format
+# as the real server, worked out from the inputs so that repeated runs give the
+# same output. Run it like this:
+#
+# python fake_server.py [port] [delay]
+#
+# where delay is an optional number of seconds to wait before answering each
+# request, to simulate the time the real server spends doing the work. Tests can
+# call start_fake_server() instead, to run one in a background thread.
+
+import BaseHTTPServer
+import SocketServer
+import StringIO
+import cgi
+import json
+import re
+import socket
+import sys
+import threading
+import time
+import urlparse
+
+API_VERSION = 52
+
+class FakeDSTKServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+  daemon_threads = True
+  allow_reuse_address = True
+  # The default backlog of 5 makes connections fail when many clients start at once
+  request_queue_size = 128
+
+  def __init__(self, address, delay=0):
+    BaseHTTPServer.HTTPServer.__init__(self, address, FakeDSTKHandler)
+    self.delay = delay
+    # The routes that have been asked for, in order, so tests can count requests
+    self.requests = []
+
+  # Clients abandon requests on purpose, when hedging or past a deadline, so a
+  # connection that's gone away before the answer is sent isn't worth reporting
+  def handle_error(self, request, client_address):
+    if not isinstance(sys.exc_info()[1], socket.error):
+      BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class FakeDSTKHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  # Keep connections alive between requests, like the real server behind nginx
+  protocol_version = 'HTTP/1.1'
+  # Otherwise small responses can be held back waiting for an acknowledgement
+  disable_nagle_algorithm = True
+
+  def log_message(self, format, *args):
+    pass
+
+  def do_GET(self):
+    parts = urlparse.urlsplit(self.path)
+    self.server.requests.append(parts.path.rstrip('/'))
+    if parts.path.rstrip('/') == '/info':
+      return self.send_json({'version': API_VERSION})
+    self.send_error_json('Unknown route "'+parts.path+'"', 404)
+
+  def do_POST(self):
+    parts = urlparse.urlsplit(self.path)
+    params = urlparse.parse_qs(parts.query)
+    route = parts.path.rstrip('/')
+    self.server.requests.append(route)
+
+    length = int(self.headers.getheader('content-length') or 0)
+    body = self.rfile.read(length)
+
+    if self.server.delay:
+      time.sleep(self.server.delay)
+
+    if route == '/file2text':
+      return self.file2text(body)
+
+    handler = ROUTES.get(route)
+    if handler is None:
+      return self.send_error_json('Unknown route "'+route+'"', 404)
+
+    try:
+      result = handler(body, params)
+    except ValueError, e:
+      return self.send_error_json(str(e))
+
+    self.send_json(result)
+
+  def file2text(self, body):
+    environ = {
+      'REQUEST_METHOD': 'POST',
+      'CONTENT_TYPE': self.headers.getheader('content-type'),
+      'CONTENT_LENGTH': str(len(body)),
+    }
+    form = cgi.FieldStorage(fp=StringIO.StringIO(body), environ=environ)
+    if 'inputfile' not in form:
+      return self.send_error_json('Something went wrong with the file uploading')
+    upload = form['inputfile']
+    text = 'Text from '+upload.filename+' ('+str(len(upload.value))+' bytes)\n'
+    self.send_body(text, 'text/plain')
+
+  def send_json(self, result, status=200):
+    self.send_body(json.dumps(result), 'application/json', status)
+
+  def send_error_json(self, message, status=500):
+    self.send_json({'error': message}, status)
+
+  def send_body(self, body, content_type, status=200):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+# Returns a number between 0 and 1 that's always the same for the same string
+def stable_fraction(value):
+  total = 0
+  for character in value:
+    total = (total * 31 + ord(character)) % 1000003
+  return total / 1000003.0
+
+def ips_list_from_string(ips_string):
+  return [ip for ip in re.sub(r'["\[\] ]', '', ips_string).split(',') if ip != '']
+
+def json_list_from_string(input_string, description):
+  if input_string == '':
+    raise ValueError('Empty string passed in to '+description)
+  if input_string[0] == '[':
+    return json.loads(input_string)
+  return [input_string]
+
+def locations_list_from_string(locations_string):
+  locations = json_list_from_string(locations_string, 'coordinates2politics')
+  if len(locations) == 2 and isinstance(locations[0], (int, long, float)):
+    locations = [locations]
+  result = []
+  for location in locations:
+    result.append({'latitude': float(location[0]), 'longitude': float(location[1])})
+  return result
+
+# Like the real server, inputs that can't be found come back as null. Here that's
+# anything that isn't a dotted quad, or any address that mentions Nowhere.
+def ip2coordinates(body, params):
+  output = {}
+  for ip in ips_list_from_string(body):
+    if not re.match(r'\d+\.\d+\.\d+\.\d+$', ip):
+      output[ip] = None
+      continue
+    fraction = stable_fraction(ip)
+    output[ip] = {
+      'country_code': 'US',
+      'country_code3': 'USA',
+      'country_name': 'United States',
+      'region': 'CA',
+      'locality': 'San Francisco',
+      'latitude': round(fraction * 180 - 90, 4),
+      'longitude': round(fraction * 360 - 180, 4),
+      'dma_code': 807,
+      'area_code': 415,
+      'postal_code': '94117',
+    }
+  return output
+
+def street2coordinates(body, params):
+  output = {}
+  for address in json_list_from_string(body.decode('latin-1'), 'street2coordinates'):
+    if 'nowhere' in address.lower():
+      output[address] = None
+      continue
+    fraction = stable_fraction(address)
+    number_match = re.match(r'\s*(\d+)', address)
+    output[address] = {
+      'latitude': round(fraction * 180 - 90, 6),
+      'longitude': round(fraction * 360 - 180, 6),
+      'country_code': 'US',
+      'country_code3': 'USA',
+      'country_name': 'United States',
+      'region': 'CA',
+      'locality': 'Simi Valley',
+      'street_address': address.split(',')[0],
+      'street_number': number_match.group(1) if number_match else None,
+      'street_name': address.split(',')[0],
+      'confidence': round(fraction * 10, 3),
+      'fips_county': '06111',
+    }
+  return output
+
+def coordinates2politics(body, params):
+  result = []
+  for location in locations_list_from_string(body):
+    result.append({
+      'location': location,
+      'politics': [
+        {'type': 'admin2', 'friendly_type': 'country', 'name': 'United States', 'code': 'usa'},
+        {'type': 'admin4', 'friendly_type': 'state', 'name': 'California', 'code': 'us06'},
+      ],
+    })
+  return result
+
+def coordinates2statistics(body, params):
+  wanted = ['population_density', 'elevation', 'mean_temperature']
+  if 'statistics' in params:
+    wanted = params['statistics'][0].split(',')
+  result = []
+  for location in locations_list_from_string(body):
+    fraction = stable_fraction(repr((location['latitude'], location['longitude'])))
+    statistics = {}
+    for name in wanted:
+      statistics[name] = {
+        'value': round(fraction * 1000, 2),
+        'description': 'A made-up value for '+name,
+      }
+    result.append({'location': location, 'statistics': statistics})
+  return result
+
+def words_with_offsets(text):
+  for match in re.finditer(r'[A-Z][a-z]+', text):
+    yield match.group(0), match.start(), match.end()
+
+def text2places(body, params):
+  result = []
+  for word, start_index, end_index in words_with_offsets(body):
+    if stable_fraction(word) > 0.2:
+      continue
+    result.append({
+      'type': 'CITY',
+      'name': word,
+      'latitude': str(round(stable_fraction(word) * 90, 4)),
+      'longitude': str(round(stable_fraction(word) * 180, 4)),
+      'start_index': str(start_index),
+      'end_index': str(end_index),
+      'matched_string': word,
+      'code': '',
+    })
+  return result
+
+def text2people(body, params):
+  result = []
+  for word, start_index, end_index in words_with_offsets(body):
+    if stable_fraction(word) > 0.1:
+      continue
+    result.append({
+      'gender': 'f' if stable_fraction(word) < 0.05 else 'm',
+      'first_name': word,
+      'title': '',
+      'surnames': '',
+      'matched_string': word,
+      'start_index': start_index,
+      'end_index': end_index,
+      'ethnicity': None,
+    })
+  return result
+
+def text2times(body, params):
+  result = []
+  for match in re.finditer(r'\d{1,2}:\d\d|\d{4}', body):
+    result.append({
+      'time_seconds': stable_fraction(match.group(0)) * 2000000000,
+      'time_string': match.group(0),
+      'is_relative': False,
+      'duration': 60,
+      'matched_string': match.group(0),
+      'start_index': match.start(),
+      'end_index': match.end(),
+    })
+  return result
+
+def text2sentiment_score(text):
+  return round(stable_fraction(text) * 10 - 5, 2)
+
+def text2sentiment(body, params):
+  if 'batch' in params:
+    try:
+      texts = json.loads(body)
+    except ValueError:
+      texts = None
+    if not isinstance(texts, list):
+      raise ValueError('You need to place the texts as a JSON-encoded array of strings inside the POST body')
+    return [{'score': text2sentiment_score(unicode(text))} for text in texts]
+  return {'score': text2sentiment_score(body)}
+
+def strip_tags(html):
+  return re.sub(r'\s+', ' ', re.sub(r'<[^>]*>', ' ', html)).strip()
+
+ROUTES = {
+  '/ip2coordinates': ip2coordinates,
+  '/street2coordinates': street2coordinates,
+  '/coordinates2politics': coordinates2politics,
+  '/coordinates2statistics': coordinates2statistics,
+  '/text2places': text2places,
+  '/text2sentences': lambda body, params: {'sentences': body},
+  '/html2text': lambda body, params: {'text': strip_tags(body)},
+  '/html2story': lambda body, params: {'story': strip_tags(body)},
+  '/text2people': text2people,
+  '/text2times': text2times,
+  '/text2sentiment': text2sentiment,
+}
+
+# Starts a server on a free local port, answering requests from a background
+# thread, and returns it along with its address. Call shutdown() on it when done.
+def start_fake_server(delay=0):
+  server = FakeDSTKServer(('127.0.0.1', 0), delay)
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server, 'http://127.0.0.1:'+str(server.server_address[1])
+
+if __name__ == '__main__':
+  port = 8765
+  delay = 0
+  if len(sys.argv) > 1:
+    port = int(sys.argv[1])
+  if len(sys.argv) > 2:
+    delay = float(sys.argv[2])
+
+  server = FakeDSTKServer(('127.0.0.1', port), delay)
+  # Port 0 picks a free port, so report the one that was actually used
+  print 'Fake DSTK server listening on http://127.0.0.1:'+str(server.server_address[1])
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Tests for AsyncDSTK, the asyncio client in dstk_async.py. They need Python 3,
+# and run the stand-in server from fake_server.py under Python 2 as a separate
+# process, using the interpreter named by the PYTHON2 environment variable:
+#
+# PYTHON2=python2 python3 test_async.py
+
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk_async
+
+# Starts fake_server.py on a free port, answering after delay seconds, and returns
+# the process along with the server's address
+def start_fake_server(delay=0):
+  process = subprocess.Popen([os.environ.get('PYTHON2', 'python2'),
+    os.path.join(TESTS_DIR, 'fake_server.py'), '0', str(delay)],
+    stdout=subprocess.PIPE, universal_newlines=True)
+  line = process.stdout.readline()
+  if 'listening on ' not in line:
+    process.kill()
+    raise Exception('The fake server didn\'t start')
+  return process, line.split('listening on ')[1].strip()
+
+def run(coroutine):
+  loop = asyncio.new_event_loop()
+  try:
+    return loop.run_until_complete(coroutine)
+  finally:
+    loop.close()
+
+class AsyncDSTKTest(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.server, cls.api_base = start_fake_server()
+    cls.slow_server, cls.slow_api_base = start_fake_server(0.3)
+
+  @classmethod
+  def tearDownClass(cls):
+    for process in (cls.server, cls.slow_server):
+      process.kill()
+      process.wait()
+      process.stdout.close()
+
+  def make_client(self, api_base, **options):
+    options['apiBase'] = api_base
+    return dstk_async.AsyncDSTK(options)
+
+  def test_gather(self):
+    async def gather():
+      async with self.make_client(self.slow_api_base) as client:
+        texts = ['Sentence '+str(index)+'.' for index in range(20)]
+        started = time.time()
+        results = await asyncio.gather(*[client.text2sentences(text) for text in texts])
+        return texts, results, time.time()-started
+
+    texts, results, elapsed = run(gather())
+    self.assertEqual([{'sentences': text} for text in texts], results)
+    # All twenty were in flight at once, rather than taking 0.3 seconds each
+    self.assertTrue(elapsed < 1.5)
+
+  def test_reuses_connections(self):
+    async def sequential():
+      async with self.make_client(self.api_base) as client:
+        for index in range(5):
+          result = await client.ip2coordinates('67.169.73.11'+str(index))
+          self.assertTrue('67.169.73.11'+str(index) in result)
+        return client.pool.open_count
+
+    self.assertEqual(1, run(sequential()))
+
+  def test_pool_size_limits_connections(self):
+    async def limited():
+      client = self.make_client(self.slow_api_base, poolSize=2)
+      peak = [0]
+      original_acquire = client.pool.acquire
+
+      async def acquire(key, fresh=False):
+        result = await original_acquire(key, fresh)
+        peak[0] = max(peak[0], client.pool.open_count)
+        return result
+      client.pool.acquire = acquire
+
+      try:
+        started = time.time()
+        await asyncio.gather(*[client.text2sentences(str(index)) for index in range(6)])
+        return peak[0], time.time()-started, client.pool.open_count
+      finally:
+        await client.close()
+
+    peak, elapsed, open_count = run(limited())
+    self.assertEqual(2, peak)
+    self.assertEqual(2, open_count)
+    # Three rounds of two requests
+    self.assertTrue(elapsed >= 0.85)
+
+  def test_timeout(self):
+    async def timed_out():
+      async with self.make_client(self.slow_api_base, timeout=0.05) as client:
+        try:
+          await client.text2sentences('Too slow.')
+        except asyncio.TimeoutError:
+          pass
+        else:
+          self.fail('Expected a timeout')
+        # A per-call timeout overrides the default
+        result = await client.text2sentences('In time.', timeout=5)
+        return result, client.pool.open_count
+
+    result, open_count = run(timed_out())
+    self.assertEqual({'sentences': 'In time.'}, result)
+    # The connection that timed out was closed rather than reused
+    self.assertEqual(1, open_count)
+
+  def test_cancellation(self):
+    async def cancelled():
+      async with self.make_client(self.slow_api_base) as client:
+        task = asyncio.ensure_future(client.text2sentences('Never mind.'))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+          await task
+        except asyncio.CancelledError:
+          pass
+        else:
+          self.fail('Expected the call to be cancelled')
+        return client.pool.open_count
+
+    self.assertEqual(0, run(cancelled()))
+
+  def test_error_status(self):
+    async def errors():
+      messages = []
+      async with self.make_client(self.api_base) as client:
+        for call in (client.api_request('/no_such_endpoint'),
+          client.api_call('/street2coordinates', '')):
+          try:
+            await call
+          except Exception as e:
+            messages.append(str(e))
+        # The connection is still usable after an error response
+        result = await client.text2sentences('Still here.')
+      return messages, result
+
+    messages, result = run(errors())
+    self.assertEqual(2, len(messages))
+    self.assertTrue('Unknown route' in messages[0])
+    self.assertTrue('Empty string' in messages[1])
+    self.assertEqual({'sentences': 'Still here.'}, result)
+
+  def test_check_version(self):
+    async def check():
+      async with self.make_client(self.api_base) as client:
+        await client.check_version()
+
+    run(check())
+
+if __name__ == '__main__':
+  unittest.main()
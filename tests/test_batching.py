@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Tests for the pieces that large batch jobs rely on, reading JSON responses as
+# they stream in and the ConcurrencyController's adaptive limits, including runs
+# against the stand-in server in fake_server.py:
+#
+# python test_batching.py
+
+import StringIO
+import os
+import sys
+import time
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+class JSONStreamReaderTest(unittest.TestCase):
+
+  def items(self, text, chunk_size, encoding='utf-8'):
+    original_size = dstk.JSONStreamReader.CHUNK_SIZE
+    dstk.JSONStreamReader.CHUNK_SIZE = chunk_size
+    try:
+      return list(dstk.iter_json_items(StringIO.StringIO(text), encoding))
+    finally:
+      dstk.JSONStreamReader.CHUNK_SIZE = original_size
+
+  def test_object_split_across_chunks(self):
+    value = {u'Caf\xe9': {'latitude': 1.5, 'longitude': -12.25}, u'b': [1, 22, 333],
+      u'c': None, u'd': True}
+    text = dstk.json.dumps(value, ensure_ascii=False).encode('utf-8')
+    # Every chunk size, so that numbers and multi-byte characters get cut in two
+    for chunk_size in range(1, len(text)+1):
+      self.assertEqual(value, dict(self.items(text, chunk_size)))
+
+  def test_array(self):
+    text = ' [ 1.25 , {"a": "b"}, 300 ] '
+    for chunk_size in (1, 2, 3, 64):
+      self.assertEqual([(0, 1.25), (1, {'a': 'b'}), (2, 300)], self.items(text, chunk_size))
+    self.assertEqual([], self.items('[]', 1))
+
+  def test_latin1(self):
+    self.assertEqual([(u'M\xfcnchen', 1)], self.items('{"M\xfcnchen": 1}', 3, 'latin-1'))
+
+  def test_errors(self):
+    self.assertRaises(ValueError, self.items, '"text"', 64)
+    self.assertRaises(ValueError, self.items, '{"a": 1', 2)
+    self.assertRaises(ValueError, self.items, '[1 2]', 64)
+
+class ConcurrencyControllerTest(unittest.TestCase):
+
+  def test_grows_while_fast(self):
+    controller = dstk.ConcurrencyController(2, 8, 100, 1000, target_latency=1.0)
+    for index in range(20):
+      started = [controller.acquire('/ip2coordinates') for slot in range(
+        controller.limits().get('/ip2coordinates', {'concurrency': 2})['concurrency'])]
+      for start in started:
+        controller.release('/ip2coordinates', start, controller.batch_size('/ip2coordinates'),
+          latency=0.1)
+    limits = controller.limits()['/ip2coordinates']
+    self.assertTrue(limits['concurrency'] > 2)
+    self.assertTrue(limits['concurrency'] <= 8)
+    self.assertTrue(limits['batch_size'] > 100)
+    self.assertTrue(limits['batch_size'] <= 1000)
+    self.assertEqual(0, limits['in_flight'])
+
+  def test_halves_once_per_round(self):
+    controller = dstk.ConcurrencyController(8, 32, 400, 1000, target_latency=1.0)
+    started = [controller.acquire('/street2coordinates') for slot in range(4)]
+    for start in started:
+      controller.release('/street2coordinates', start, 400, latency=5.0)
+    limits = controller.limits()['/street2coordinates']
+    self.assertEqual(4, limits['concurrency'])
+    self.assertEqual(200, limits['batch_size'])
+    self.assertEqual(1, limits['decreases'])
+
+    time.sleep(0.01)
+    controller.release('/street2coordinates', controller.acquire('/street2coordinates'),
+      10, failed=True)
+    limits = controller.limits()['/street2coordinates']
+    self.assertEqual(2, limits['concurrency'])
+    self.assertEqual(1, limits['errors'])
+    # Other endpoints aren't affected
+    self.assertEqual(400, controller.batch_size('/ip2coordinates'))
+
+class DSTKBatchingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.api_base = start_fake_server()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_batches(self):
+    client = dstk.DSTK({'apiBase': self.api_base, 'versionCacheFile': None,
+      'batchSize': 7})
+    try:
+      ips = ['10.0.%d.%d' % (index / 256, index % 256) for index in range(50)]
+      result = client.ip2coordinates(ips)
+    finally:
+      client.close()
+    self.assertEqual(sorted(ips), sorted(result.keys()))
+    self.assertEqual(8, self.server.requests.count('/ip2coordinates'))
+
+  def test_positional_batches_keep_order(self):
+    client = dstk.DSTK({'apiBase': self.api_base, 'versionCacheFile': None,
+      'batchSize': 7, 'batchConcurrency': 3})
+    try:
+      points = [[index * 0.01, index * 0.02] for index in range(50)]
+      result = client.coordinates2politics(points)
+    finally:
+      client.close()
+    self.assertEqual(points, [[item['location']['latitude'], item['location']['longitude']]
+      for item in result])
+    self.assertEqual(8, self.server.requests.count('/coordinates2politics'))
+
+  def test_adaptive(self):
+    client = dstk.DSTK({'apiBase': self.api_base, 'versionCacheFile': None,
+      'adaptiveConcurrency': True, 'batchSize': 10, 'maxBatchSize': 40})
+    try:
+      points = [[index * 0.01, index * 0.02] for index in range(500)]
+      result = client.coordinates2politics(points)
+      self.assertEqual(500, len(result))
+      for point, item in zip(points, result):
+        self.assertEqual({'latitude': point[0], 'longitude': point[1]}, item['location'])
+      limits = client.concurrency.limits()['/coordinates2politics']
+      self.assertTrue(limits['batch_size'] > 10)
+      self.assertTrue(limits['batch_size'] <= 40)
+      self.assertEqual(0, limits['errors'])
+    finally:
+      client.close()
+
+if __name__ == '__main__':
+  unittest.main()
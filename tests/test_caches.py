@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+# Tests for the response caches, ResponseCache, LRUCache and SpatialCache, both on
+# their own and through DSTK calls to the stand-in server in fake_server.py:
+#
+# python test_caches.py
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+class ResponseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.file_name = os.path.join(self.directory, 'cache.sqlite')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_ttl(self):
+    cache = dstk.ResponseCache(self.file_name, ttl=60)
+    try:
+      cache.set_many({u'old': {'value': 1}, u'new': {'value': 2}})
+      cache.connection.execute('UPDATE responses SET created=? WHERE key=?',
+        (time.time()-120, u'old'))
+      cache.connection.commit()
+      self.assertEqual({u'new': {'value': 2}}, cache.get_many([u'old', u'new']))
+      self.assertEqual(1, cache.hits)
+      self.assertEqual(1, cache.misses)
+    finally:
+      cache.close()
+
+  def test_evicts_least_recently_used(self):
+    cache = dstk.ResponseCache(self.file_name, max_entries=2)
+    try:
+      cache.set_many({u'a': 1})
+      cache.set_many({u'b': 2})
+      # Touch a, so that b is the least recently used when c arrives
+      cache.connection.execute('UPDATE responses SET last_used=? WHERE key=?',
+        (time.time()-60, u'b'))
+      cache.connection.commit()
+      cache.get_many([u'a'])
+      cache.set_many({u'c': 3})
+      self.assertEqual({u'a': 1, u'c': 3}, cache.get_many([u'a', u'b', u'c']))
+      self.assertEqual(2, cache.stats()['entries'])
+    finally:
+      cache.close()
+
+  def test_survives_reopening(self):
+    cache = dstk.ResponseCache(self.file_name)
+    cache.set_many({u'Caf\xe9': [1, 2]})
+    cache.close()
+    cache = dstk.ResponseCache(self.file_name)
+    try:
+      self.assertEqual({u'Caf\xe9': [1, 2]}, cache.get_many([u'Caf\xe9']))
+    finally:
+      cache.close()
+
+class LRUCacheTest(unittest.TestCase):
+
+  def test_evicts_least_recently_used(self):
+    cache = dstk.LRUCache(2)
+    cache.set_many({'a': 1})
+    cache.set_many({'b': 2})
+    cache.get_many(['a'])
+    cache.set_many({'c': 3})
+    self.assertEqual({'a': 1, 'c': 3}, cache.get_many(['a', 'b', 'c']))
+    self.assertEqual({'hits': 3, 'misses': 1, 'entries': 2}, cache.stats())
+
+  def test_returns_copies(self):
+    cache = dstk.LRUCache(2)
+    value = {'politics': [{'name': 'California'}]}
+    cache.set_many({'a': value})
+    value['politics'].append({'name': 'Changed'})
+    first = cache.get_many(['a'])['a']
+    first['politics'][0]['name'] = 'Changed'
+    self.assertEqual({'politics': [{'name': 'California'}]}, cache.get_many(['a'])['a'])
+
+class SpatialCacheTest(unittest.TestCase):
+
+  def test_probes_busy_cells_only(self):
+    cache = dstk.SpatialCache(5, probe_threshold=3)
+    point = [37.7793, -122.4193]
+    cell = cache.cell(point)
+    self.assertFalse(cache.start_probe('/coordinates2politics', cell))
+    self.assertFalse(cache.start_probe('/coordinates2politics', cell))
+    self.assertTrue(cache.start_probe('/coordinates2politics', cell))
+    self.assertEqual(9, len(cache.probe_points(cell)))
+    answer = {'location': {}, 'politics': [{'name': 'California'}]}
+    cache.settle('/coordinates2politics', cell, [answer] * 9)
+
+    first = cache.get('/coordinates2politics', cell, point)
+    self.assertEqual({'latitude': 37.7793, 'longitude': -122.4193}, first['location'])
+    first['politics'][0]['name'] = 'Changed'
+    second = cache.get('/coordinates2politics', cell, point)
+    self.assertEqual([{'name': 'California'}], second['politics'])
+    # Cells are kept separately for each endpoint
+    self.assertEqual(None, cache.get('/coordinates2statistics', cell, point))
+
+  def test_mixed_cells_go_to_server(self):
+    cache = dstk.SpatialCache(5, probe_threshold=1)
+    point = [37.7793, -122.4193]
+    cell = cache.cell(point)
+    self.assertTrue(cache.start_probe('/coordinates2politics', cell))
+    results = [{'politics': [{'name': 'One'}]}] * 8+[{'politics': [{'name': 'Two'}]}]
+    cache.settle('/coordinates2politics', cell, results)
+    self.assertEqual(None, cache.get('/coordinates2politics', cell, point))
+    self.assertFalse(cache.start_probe('/coordinates2politics', cell))
+    self.assertEqual(1, cache.stats()['mixed_cells'])
+
+class DSTKCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.server, self.api_base = start_fake_server()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  def make_client(self, **options):
+    options['apiBase'] = self.api_base
+    options['versionCacheFile'] = None
+    return dstk.DSTK(options)
+
+  def test_persistent_cache(self):
+    cache_file = os.path.join(self.directory, 'cache.sqlite')
+    for index in range(2):
+      client = self.make_client(cacheFile=cache_file)
+      try:
+        result = client.ip2coordinates(['67.169.73.113', '8.8.8.8'])
+      finally:
+        client.close()
+      self.assertEqual(['67.169.73.113', '8.8.8.8'], sorted(result.keys()))
+    # The second client found both in the file left by the first
+    self.assertEqual(1, self.server.requests.count('/ip2coordinates'))
+
+  def test_persistent_cache_with_non_ascii_keys(self):
+    cache_file = os.path.join(self.directory, 'cache.sqlite')
+    addresses = ['Caf\xc3\xa9 Road 1, Paris', u'2 Stra\xdfe, Berlin', '3 Main St, Simi Valley']
+    client = self.make_client(cacheFile=cache_file)
+    try:
+      first = client.street2coordinates(addresses)
+    finally:
+      client.close()
+    self.assertEqual(3, len(first))
+    for address in addresses:
+      self.assertTrue(address in first)
+    self.assertEqual(1, self.server.requests.count('/street2coordinates'))
+
+    client = self.make_client(cacheFile=cache_file)
+    try:
+      second = client.street2coordinates(addresses)
+    finally:
+      client.close()
+    self.assertEqual(first, second)
+    self.assertEqual(1, self.server.requests.count('/street2coordinates'))
+
+  def test_memory_cache_is_opt_in(self):
+    client = self.make_client()
+    try:
+      self.assertEqual(None, client.memory_cache)
+      client.ip2coordinates('67.169.73.113')
+      client.ip2coordinates('67.169.73.113')
+    finally:
+      client.close()
+    self.assertEqual(2, self.server.requests.count('/ip2coordinates'))
+
+    client = self.make_client(memoryCacheSize=10)
+    try:
+      client.ip2coordinates('67.169.73.113')
+      client.ip2coordinates('67.169.73.113')
+    finally:
+      client.close()
+    self.assertEqual(3, self.server.requests.count('/ip2coordinates'))
+
+  def test_repeated_inputs_get_separate_results(self):
+    client = self.make_client(memoryCacheSize=10)
+    try:
+      result = client.coordinates2politics([[37.7793, -122.4193], [37.7793, -122.4193]])
+      result[0]['politics'].append({'name': 'Changed'})
+      self.assertEqual(2, len(result[1]['politics']))
+      again = client.coordinates2politics([[37.7793, -122.4193]])
+      self.assertEqual(2, len(again[0]['politics']))
+    finally:
+      client.close()
+    self.assertEqual(1, self.server.requests.count('/coordinates2politics'))
+
+  def test_spatial_cache_answers_settled_cells(self):
+    client = self.make_client(spatialCachePrecision=5, spatialCacheProbeThreshold=2)
+    try:
+      points = [[37.7793+index * 0.0001, -122.4193] for index in range(20)]
+      results = client.coordinates2politics(points)
+      self.assertEqual(20, len(results))
+      for result, point in zip(results, points):
+        self.assertEqual(point, [result['location']['latitude'],
+          result['location']['longitude']])
+        self.assertEqual('California', result['politics'][1]['name'])
+      stats = client.spatial_cache.stats()
+      self.assertEqual(1, stats['uniform_cells'])
+      self.assertTrue(stats['hits'] > 0)
+    finally:
+      client.close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# Tests for resuming interrupted command line jobs with --checkpoint. dstk.py is
+# run as a separate process against the stand-in server in fake_server.py, and
+# the journal is cut short to simulate a crash part way through:
+#
+# python test_checkpoint.py
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DSTK_SCRIPT = os.path.join(os.path.dirname(TESTS_DIR), 'python', 'dstk.py')
+
+from fake_server import start_fake_server
+
+INPUTS = ['67.169.73.%d' % index for index in range(10)]
+
+class CheckpointTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.journal = os.path.join(self.directory, 'journal')
+    self.server, self.api_base = start_fake_server()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  # Runs dstk.py with the inputs on stdin, and returns its exit code and output
+  def run_dstk(self, arguments, inputs=INPUTS):
+    environment = dict(os.environ)
+    # Keeps the version check cache out of the real home directory
+    environment['HOME'] = self.directory
+    environment.pop('DSTK_API_BASE', None)
+    process = subprocess.Popen([sys.executable, DSTK_SCRIPT]+arguments+['-a', self.api_base],
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+      env=environment)
+    output, errors = process.communicate(''.join([input+'\n' for input in inputs]))
+    return process.returncode, output, errors
+
+  def journal_lines(self):
+    return open(self.journal, 'rb').readlines()
+
+  def ip_requests(self):
+    return self.server.requests.count('/ip2coordinates')
+
+  def test_resume_gives_same_output(self):
+    code, expected, errors = self.run_dstk(['ip2coordinates', '-h', '-w', '3'])
+    self.assertEqual(0, code, errors)
+    self.assertEqual(len(INPUTS)+1, len(expected.splitlines()))
+
+    code, output, errors = self.run_dstk(['ip2coordinates', '-h', '-w', '3',
+      '--checkpoint', self.journal])
+    self.assertEqual(0, code, errors)
+    self.assertEqual(expected, output)
+    lines = self.journal_lines()
+    self.assertEqual(4, len(lines))
+
+    # Keep two finished windows, and half of the line for the third as if the
+    # process had died while writing it
+    journal = open(self.journal, 'wb')
+    journal.write(''.join(lines[:2])+lines[2][:len(lines[2])/2])
+    journal.close()
+
+    requests_before = self.ip_requests()
+    code, output, errors = self.run_dstk(['ip2coordinates', '-h', '-w', '3',
+      '--checkpoint', self.journal])
+    self.assertEqual(0, code, errors)
+    self.assertEqual(expected, output)
+    self.assertEqual(2, self.ip_requests()-requests_before)
+    self.assertEqual(lines, self.journal_lines())
+
+    # Once everything is done, running again doesn't contact the server at all
+    requests_before = self.ip_requests()
+    code, output, errors = self.run_dstk(['ip2coordinates', '-h', '-w', '3',
+      '--checkpoint', self.journal])
+    self.assertEqual(0, code, errors)
+    self.assertEqual(expected, output)
+    self.assertEqual(0, self.ip_requests()-requests_before)
+
+  def test_rejects_different_inputs(self):
+    code, output, errors = self.run_dstk(['ip2coordinates', '-w', '3',
+      '--checkpoint', self.journal])
+    self.assertEqual(0, code, errors)
+    changed = list(INPUTS)
+    changed[1] = '10.0.0.1'
+    code, output, errors = self.run_dstk(['ip2coordinates', '-w', '3',
+      '--checkpoint', self.journal], changed)
+    self.assertNotEqual(0, code)
+    self.assertTrue('don\'t match' in errors)
+
+  def test_rejects_unsupported_commands(self):
+    code, output, errors = self.run_dstk(['text2sentences', '--checkpoint', self.journal],
+      ['Hello.'])
+    self.assertNotEqual(0, code)
+    self.assertTrue('--checkpoint can\'t be used with text2sentences' in output)
+    self.assertFalse(os.path.exists(self.journal))
+
+if __name__ == '__main__':
+  unittest.main()
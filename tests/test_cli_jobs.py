@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# Tests for processing trees of files from the command line with --jobs and
+# --processed_log. dstk.py is run as a separate process against the stand-in
+# server in fake_server.py:
+#
+# python test_cli_jobs.py
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+DSTK_SCRIPT = os.path.join(os.path.dirname(TESTS_DIR), 'python', 'dstk.py')
+
+from fake_server import start_fake_server
+
+class CLIJobsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.inputs = os.path.join(self.directory, 'inputs')
+    self.file_names = []
+    for index in range(12):
+      sub_directory = os.path.join(self.inputs, 'part'+str(index % 3))
+      if not os.path.isdir(sub_directory):
+        os.makedirs(sub_directory)
+      file_name = os.path.join(sub_directory, 'file%02d.txt' % index)
+      output = open(file_name, 'wb')
+      output.write('This is file number '+str(index)+'.')
+      output.close()
+      self.file_names.append(file_name)
+    self.file_names.sort()
+    self.log = os.path.join(self.directory, 'processed.log')
+    # A delay lets several requests overlap, so they can finish out of order
+    self.server, self.api_base = start_fake_server(0.05)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  # Runs dstk.py and returns its output, failing if it doesn't exit cleanly
+  def run_dstk(self, arguments):
+    environment = dict(os.environ)
+    environment['HOME'] = self.directory
+    environment.pop('DSTK_API_BASE', None)
+    process = subprocess.Popen([sys.executable, DSTK_SCRIPT]+arguments+['-a', self.api_base],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment)
+    output, errors = process.communicate()
+    self.assertEqual(0, process.returncode, errors)
+    return output
+
+  def expected_output(self, file_names):
+    lines = []
+    for file_name in file_names:
+      lines.append('--File--: '+file_name)
+      lines.append(open(file_name, 'rb').read())
+    return ''.join([line+'\n' for line in lines])
+
+  def sentence_requests(self):
+    return self.server.requests.count('/text2sentences')
+
+  def test_jobs_keep_input_order(self):
+    expected = self.expected_output(self.file_names)
+    self.assertEqual(expected, self.run_dstk(['text2sentences', '-h', self.inputs]))
+    for jobs in ('4', '12'):
+      self.assertEqual(expected, self.run_dstk(['text2sentences', '-h', '-j', jobs,
+        self.inputs]))
+
+  def test_processed_log_skips_finished_files(self):
+    output = self.run_dstk(['text2sentences', '-h', '-j', '4', '--processed_log',
+      self.log, self.inputs])
+    self.assertEqual(self.expected_output(self.file_names), output)
+    self.assertEqual(12, self.sentence_requests())
+    self.assertEqual(12, len(open(self.log).readlines()))
+
+    output = self.run_dstk(['text2sentences', '-h', '-j', '4', '--processed_log',
+      self.log, self.inputs])
+    self.assertEqual('', output)
+    self.assertEqual(12, self.sentence_requests())
+
+    # A file that's changed since it was processed is done again
+    changed = self.file_names[5]
+    modified_time = os.path.getmtime(changed)
+    os.utime(changed, (modified_time+10, modified_time+10))
+    output = self.run_dstk(['text2sentences', '-h', '-j', '4', '--processed_log',
+      self.log, self.inputs])
+    self.assertEqual(self.expected_output([changed]), output)
+    self.assertEqual(13, self.sentence_requests())
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#
+# Tests that the _columns versions of ip2coordinates and street2coordinates agree
+# with the dictionaries the plain versions return, run against the stand-in server
+# in fake_server.py:
+#
+# python test_columns.py
+
+import array
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+def is_nan(value):
+  return value != value
+
+class ColumnsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.api_base = start_fake_server()
+    # Small batches, so repeated inputs land in different requests
+    self.client = dstk.DSTK({'apiBase': self.api_base, 'batchSize': 2})
+
+  def tearDown(self):
+    self.client.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def check_column_types(self, columns):
+    for field, column in columns.items():
+      numeric = field in dstk.ResultColumns.NUMERIC_FIELDS
+      if numpy is not None:
+        self.assertTrue(isinstance(column, numpy.ndarray))
+        self.assertEqual(numeric, column.dtype == numpy.float64)
+      elif numeric:
+        self.assertTrue(isinstance(column, array.array))
+        self.assertEqual('d', column.typecode)
+      else:
+        self.assertTrue(isinstance(column, list))
+
+  # Every row of the columns has to match the dictionary result for its input,
+  # with NaN and None standing in for inputs the server couldn't find
+  def check_matches(self, inputs, by_input, columns, fields):
+    self.assertEqual(sorted(fields), sorted(columns.keys()))
+    self.check_column_types(columns)
+    for field in fields:
+      column = list(columns[field])
+      self.assertEqual(len(inputs), len(column))
+      for item, value in zip(inputs, column):
+        info = by_input[item]
+        if field in dstk.ResultColumns.NUMERIC_FIELDS:
+          if info is None:
+            self.assertTrue(is_nan(value))
+          else:
+            self.assertEqual(float(info[field]), value)
+        else:
+          if info is None:
+            self.assertEqual(None, value)
+          else:
+            self.assertEqual(info[field], value)
+
+  def test_ip2coordinates(self):
+    ips = ['67.169.73.113', '8.8.8.8', 'unknown', '67.169.73.113', '10.0.0.1']
+    fields = ('latitude', 'longitude', 'country_code', 'postal_code')
+    by_ip = self.client.ip2coordinates(ips)
+    self.assertEqual(None, by_ip['unknown'])
+    self.check_matches(ips, by_ip, self.client.ip2coordinates_columns(ips, fields),
+      fields)
+
+  def test_street2coordinates(self):
+    addresses = ['2543 Graystone Place, Simi Valley, CA 93065', '1 Nowhere Lane',
+      '400 Duboce Ave, San Francisco, CA', '2543 Graystone Place, Simi Valley, CA 93065',
+      u'Caf\xe9 Road 1, Paris']
+    fields = ('latitude', 'longitude', 'confidence', 'street_number', 'locality')
+    by_address = self.client.street2coordinates(addresses)
+    self.assertEqual(None, by_address['1 Nowhere Lane'])
+    self.check_matches(addresses, by_address,
+      self.client.street2coordinates_columns(addresses, fields), fields)
+
+  def test_default_fields(self):
+    columns = self.client.street2coordinates_columns(['1 Nowhere Lane'])
+    self.assertEqual(['confidence', 'latitude', 'longitude'], sorted(columns.keys()))
+    self.assertTrue(is_nan(columns['latitude'][0]))
+    self.assertEqual(['latitude', 'longitude'],
+      sorted(self.client.ip2coordinates_columns([]).keys()))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Tests that the compact location records behave like the dictionaries they
+# replace, both on their own and as returned by calls to the stand-in server in
+# fake_server.py:
+#
+# python test_compact.py
+
+import json
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+STREET_INFO = {
+  u'latitude': 34.2622, u'longitude': -118.7654, u'country_code': u'US',
+  u'country_code3': u'USA', u'country_name': u'United States', u'region': u'CA',
+  u'locality': u'Simi Valley', u'street_address': u'2543 Graystone Pl',
+  u'street_number': u'2543', u'street_name': u'Graystone Pl', u'confidence': 0.9,
+  u'fips_county': u'06111',
+}
+
+class CompactLocationTest(unittest.TestCase):
+
+  def test_fields(self):
+    location = dstk.StreetLocation(STREET_INFO)
+    self.assertEqual(34.2622, location.latitude)
+    self.assertEqual(34.2622, location['latitude'])
+    self.assertEqual(u'Simi Valley', location.get('locality'))
+    self.assertTrue('street_number' in location)
+    # Records don't carry a dictionary of their own
+    self.assertFalse(hasattr(location, '__dict__'))
+    self.assertRaises(AttributeError, setattr, location, 'no_such_field', 1)
+
+  def test_to_dict(self):
+    location = dstk.StreetLocation(STREET_INFO)
+    self.assertEqual(STREET_INFO, location.to_dict())
+    self.assertEqual(STREET_INFO, json.loads(json.dumps(location.to_dict())))
+    self.assertEqual(location, STREET_INFO)
+    self.assertEqual(location, dstk.StreetLocation(dict(STREET_INFO)))
+    self.assertNotEqual(location, dict(STREET_INFO, locality=u'Elsewhere'))
+
+  def test_missing_and_null_fields(self):
+    info = {u'latitude': u'37.5', u'longitude': -122, u'street_number': None}
+    location = dstk.StreetLocation(info)
+    # Numbers always come back as floats
+    self.assertEqual(37.5, location.latitude)
+    self.assertTrue(isinstance(location.longitude, float))
+    self.assertEqual(None, location['street_number'])
+    self.assertTrue('street_number' in location)
+    self.assertFalse('locality' in location)
+    self.assertRaises(KeyError, lambda: location['locality'])
+    self.assertRaises(AttributeError, lambda: location.locality)
+    self.assertEqual(None, location.get('locality'))
+    self.assertEqual('', location.get('locality', ''))
+    self.assertEqual({u'latitude': 37.5, u'longitude': -122.0, u'street_number': None},
+      location.to_dict())
+
+  def test_unknown_fields_are_kept(self):
+    info = dict(STREET_INFO, new_field=[1, 2])
+    location = dstk.StreetLocation(info)
+    self.assertEqual([1, 2], location['new_field'])
+    self.assertTrue('new_field' in location)
+    self.assertEqual(info, location.to_dict())
+
+  def test_shared_strings(self):
+    shared = {}
+    first = dstk.IPLocation({u'country_name': u''.join([u'United', u' States'])}, shared)
+    second = dstk.IPLocation({u'country_name': u''.join([u'United ', u'States'])}, shared)
+    self.assertTrue(first.country_name is second.country_name)
+
+class DSTKCompactTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.api_base = start_fake_server()
+    self.client = dstk.DSTK({'apiBase': self.api_base})
+
+  def tearDown(self):
+    self.client.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def check_equivalent(self, plain, compact, record_class):
+    self.assertEqual(sorted(plain.keys()), sorted(compact.keys()))
+    for key, info in plain.items():
+      if info is None:
+        self.assertEqual(None, compact[key])
+        continue
+      self.assertTrue(isinstance(compact[key], record_class))
+      self.assertEqual(info, compact[key].to_dict())
+      for field, value in info.items():
+        self.assertEqual(value, compact[key][field])
+
+  def test_street2coordinates(self):
+    addresses = ['2543 Graystone Place, Simi Valley, CA 93065', '1 Nowhere Lane',
+      '400 Duboce Ave, San Francisco, CA']
+    plain = self.client.street2coordinates(addresses)
+    compact = self.client.street2coordinates(addresses, compact=True)
+    self.check_equivalent(plain, compact, dstk.StreetLocation)
+    first = compact[addresses[0]]
+    self.assertTrue(first.region is compact[addresses[2]].region)
+
+  def test_ip2coordinates(self):
+    ips = ['67.169.73.113', '8.8.8.8', 'unknown']
+    self.check_equivalent(self.client.ip2coordinates(ips),
+      self.client.ip2coordinates(ips, compact=True), dstk.IPLocation)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+#
+# Tests for the keep-alive ConnectionPool, run against the stand-in server in
+# fake_server.py, so they don't need a real DSTK server or the network:
+#
+# python test_connection_pool.py
+
+import os
+import socket
+import sys
+import threading
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+class ConnectionPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server, self.api_base = start_fake_server()
+    self.pool = dstk.ConnectionPool(max_size=4, max_per_host=2, idle_timeout=30)
+
+  def tearDown(self):
+    self.pool.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def idle_connections(self):
+    result = []
+    for idle in self.pool.idle_connections.values():
+      result.extend([connection for connection, last_used in idle])
+    return result
+
+  def test_reuses_connection(self):
+    ports = set()
+    for index in range(5):
+      status, body = self.pool.request('GET', self.api_base+'/info')
+      self.assertEqual(200, status)
+      self.assertEqual(52, dstk.json.loads(body)['version'])
+      connections = self.idle_connections()
+      self.assertEqual(1, len(connections))
+      ports.add(connections[0].sock.getsockname()[1])
+    # Every request went out from the same local port, so over one connection
+    self.assertEqual(1, len(ports))
+    self.assertEqual(1, self.pool.total_count)
+
+  def test_retries_when_server_dropped_connection(self):
+    self.pool.request('GET', self.api_base+'/info')
+    connection = self.idle_connections()[0]
+    old_port = connection.sock.getsockname()[1]
+    # Simulate the server closing the kept-alive connection while it was idle
+    connection.sock.shutdown(socket.SHUT_RDWR)
+
+    status, body = self.pool.request('POST', self.api_base+'/text2sentences', 'Hello.')
+    self.assertEqual(200, status)
+    self.assertEqual({'sentences': 'Hello.'}, dstk.json.loads(body))
+    connections = self.idle_connections()
+    self.assertEqual(1, len(connections))
+    self.assertNotEqual(old_port, connections[0].sock.getsockname()[1])
+    self.assertEqual(1, self.pool.total_count)
+
+  def test_fresh_connection_failure_is_not_retried(self):
+    # Nothing is listening on a port we've just closed
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    listener.close()
+    self.assertRaises(socket.error, self.pool.request, 'GET',
+      'http://127.0.0.1:'+str(port)+'/info')
+    self.assertEqual(0, self.pool.total_count)
+
+  def test_idle_timeout_closes_connections(self):
+    self.pool.idle_timeout = -1
+    self.pool.request('GET', self.api_base+'/info')
+    first = self.idle_connections()[0]
+    self.pool.request('GET', self.api_base+'/info')
+    self.assertTrue(first.sock is None)
+    self.assertEqual(1, self.pool.total_count)
+
+  def test_limits_connections_per_host(self):
+    server, api_base = start_fake_server(0.2)
+    try:
+      peak = [0]
+      lock = threading.Lock()
+      original_create = self.pool.create_connection
+
+      def create_connection(key):
+        with lock:
+          active = sum(self.pool.active_counts.values())
+          peak[0] = max(peak[0], active+1)
+        return original_create(key)
+      self.pool.create_connection = create_connection
+
+      results = dstk.map_concurrently(
+        lambda index: self.pool.request('GET', api_base+'/info')[0], range(6), 6)
+      self.assertEqual([200] * 6, results)
+      self.assertTrue(peak[0] <= 2)
+      self.assertEqual(2, self.pool.total_count)
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def test_dstk_calls_share_the_pool(self):
+    client = dstk.DSTK({'apiBase': self.api_base, 'versionCacheFile': None})
+    try:
+      client.text2sentences('One.')
+      client.html2text('<p>Two</p>')
+      client.ip2coordinates('67.169.73.113')
+      self.assertEqual(1, client.pool.total_count)
+    finally:
+      client.close()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+#
+# Tests for the local indexes that answer lookups without the server, built from
+# small made-up versions of the data files each one is normally compiled from:
+#
+# python test_local_indexes.py
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+class LocalIndexTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def write_file(self, name, contents):
+    file_name = os.path.join(self.directory, name)
+    output = open(file_name, 'wb')
+    output.write(contents)
+    output.close()
+    return file_name
+
+class IPRangeIndexTest(LocalIndexTest):
+
+  def setUp(self):
+    LocalIndexTest.setUp(self)
+    blocks = self.write_file('blocks.csv',
+      'Copyright (c) 2012 MaxMind LLC.  All Rights Reserved.\n'+
+      'startIpNum,endIpNum,locId\n'+
+      '"16777216","16777471","17"\n'+
+      '"1311637504","1311638015","223"\n')
+    locations = self.write_file('locations.csv',
+      'Copyright (c) 2012 MaxMind LLC.  All Rights Reserved.\n'+
+      'locId,country,region,city,postalCode,latitude,longitude,metroCode,areaCode\n'+
+      '17,"AU","","","",-27.0000,133.0000,,\n'+
+      '223,"DE","02","M\xfcnchen","80331",48.1500,11.5833,,\n')
+    countries = self.write_file('countries.csv', 'AU,AUS,Australia\nDE,DEU,Germany\n')
+    self.file_name = os.path.join(self.directory, 'ip.dat')
+    self.assertEqual(2, dstk.compile_ip_database(blocks, locations, self.file_name,
+      countries))
+
+  def test_lookup(self):
+    index = dstk.IPRangeIndex(self.file_name)
+    try:
+      result = index.lookup_many(['1.0.0.1', '78.46.0.255', '78.46.2.0', 'unknown'])
+    finally:
+      index.close()
+    self.assertEqual(-27.0, result['1.0.0.1']['latitude'])
+    self.assertEqual('AUS', result['1.0.0.1']['country_code3'])
+    self.assertEqual(None, result['1.0.0.1']['locality'])
+    self.assertEqual(u'M\xfcnchen', result['78.46.0.255']['locality'])
+    self.assertEqual('Germany', result['78.46.0.255']['country_name'])
+    self.assertEqual(None, result['78.46.2.0'])
+    self.assertEqual(None, result['unknown'])
+
+  def test_used_by_dstk(self):
+    client = dstk.DSTK({'apiBase': 'http://127.0.0.1:1', 'checkVersion': False,
+      'versionCacheFile': None, 'ipDatabaseFile': self.file_name})
+    try:
+      result = client.ip2coordinates('78.46.1.1')
+    finally:
+      client.close()
+    self.assertEqual('80331', result['78.46.1.1']['postal_code'])
+
+class PoliticsIndexTest(LocalIndexTest):
+
+  def setUp(self):
+    LocalIndexTest.setUp(self)
+    self.countries = self.write_file('countries.json', dstk.json.dumps({
+      'type': 'FeatureCollection',
+      'features': [{
+        'type': 'Feature',
+        'properties': {'name': 'Squareland', 'country_code': 'SQL'},
+        'geometry': {'type': 'Polygon', 'coordinates': [
+          [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+          [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]],
+        ]},
+      }],
+    }))
+    self.states = self.write_file('states.json', dstk.json.dumps({
+      'type': 'FeatureCollection',
+      'features': [{
+        'type': 'Feature',
+        'properties': {'name': 'West Square', 'code': 'SQ-W', 'type': 'admin4'},
+        'geometry': {'type': 'Polygon', 'coordinates': [
+          [[0, 0], [5, 0], [5, 10], [0, 10], [0, 0]],
+        ]},
+      }],
+    }))
+
+  def names(self, result):
+    return [[area['name'] for area in item['politics'] or []] for item in result]
+
+  def test_lookup(self):
+    index = dstk.PoliticsIndex([self.countries, self.states])
+    # The middle of the country is a hole, and points are [latitude, longitude]
+    result = index.lookup_many([[2, 2], [8, 8], [5, 5.5], [20, 20], '3,1'])
+    self.assertEqual([['Squareland', 'West Square'], ['Squareland'], [], [],
+      ['Squareland', 'West Square']], self.names(result))
+    self.assertEqual({'latitude': 2.0, 'longitude': 2.0}, result[0]['location'])
+    state = result[0]['politics'][1]
+    self.assertEqual('admin4', state['type'])
+    self.assertEqual('state', state['friendly_type'])
+    self.assertEqual('sq-w', state['code'])
+
+  def test_tolerance(self):
+    index = dstk.PoliticsIndex([self.countries, self.states])
+    # Countries match up to 0.1 degrees outside, other areas up to 0.01
+    result = index.lookup_many([[10.05, 8], [2, 5.005], [10.5, 8], [2, 5.05], [4.05, 5.5]])
+    self.assertEqual([['Squareland'], ['Squareland', 'West Square'], [], ['Squareland'],
+      ['Squareland']], self.names(result))
+
+  # Without numpy the pure Python path runs, which is covered by the tests above
+  def test_numpy_path_is_quiet(self):
+    try:
+      import numpy
+    except ImportError:
+      self.skipTest('numpy is not installed')
+    index = dstk.PoliticsIndex([self.countries, self.states])
+    self.assertTrue(index.numpy is not None)
+    # The squares have horizontal edges, which divide by zero
+    with numpy.errstate(all='raise'):
+      result = index.lookup_many([[2, 2], [8, 8], [5, 5.5], [20, 20], [10.05, 8]])
+    self.assertEqual([['Squareland', 'West Square'], ['Squareland'], [], [],
+      ['Squareland']], self.names(result))
+
+  def test_used_by_dstk(self):
+    client = dstk.DSTK({'apiBase': 'http://127.0.0.1:1', 'checkVersion': False,
+      'versionCacheFile': None, 'politicsFiles': [self.countries, self.states]})
+    try:
+      result = client.coordinates2politics([[2, 2], ['8', '8']])
+    finally:
+      client.close()
+    self.assertEqual([['Squareland', 'West Square'], ['Squareland']], self.names(result))
+
+class PlacesIndexTest(LocalIndexTest):
+
+  def setUp(self):
+    LocalIndexTest.setUp(self)
+    countries = self.write_file('countries.csv',
+      'country,country_code,lat,lon,last_word\n'+
+      'France,FR,46.0,2.0,France\n'+
+      'United Kingdom,GB,54.0,-2.0,Kingdom\n')
+    regions = self.write_file('regions.csv',
+      'region,region_code,country_code,lat,lon,last_word\n'+
+      'California,CA,US,37.0,-120.0,California\n')
+    cities = self.write_file('cities.csv',
+      'city,country,region_code,population,lat,lon,last_word\n'+
+      'Paris,fr,A8,2000000,48.8567,2.3508,paris\n'+
+      'Paris,us,TX,25000,33.6609,-95.5555,paris\n'+
+      'San Francisco,us,CA,800000,37.7749,-122.4194,francisco\n')
+    self.file_name = os.path.join(self.directory, 'places.dat')
+    dstk.compile_places_database(countries, regions, cities, None, self.file_name)
+
+  def test_lookup(self):
+    index = dstk.PlacesIndex(self.file_name)
+    text = 'I flew from Paris, France to San Francisco, California and the United Kingdom.'
+    result = index.text2places(text)
+    self.assertEqual(['CITY', 'CITY', 'COUNTRY'], [place['type'] for place in result])
+    paris = result[0]
+    self.assertEqual('Paris', paris['name'])
+    self.assertEqual('48.8567', paris['latitude'])
+    self.assertEqual('Paris, France', paris['matched_string'])
+    self.assertEqual(text.index('Paris'), int(paris['start_index']))
+    self.assertEqual('San Francisco, California', result[1]['matched_string'])
+    self.assertEqual('United Kingdom', result[2]['name'])
+    self.assertEqual('GB', result[2]['code'])
+
+  def test_cities_need_a_country_or_region(self):
+    index = dstk.PlacesIndex(self.file_name)
+    self.assertEqual([], index.text2places('Paris is lovely.'))
+    # The country picks which of the cities with the same name is meant
+    result = index.text2places('Paris, France')
+    self.assertEqual('2.3508', result[0]['longitude'])
+
+class PeopleIndexTest(LocalIndexTest):
+
+  def setUp(self):
+    LocalIndexTest.setUp(self)
+    gender_names = self.write_file('genderfromname.rb',
+      '$Males = {\n'+
+      "  'samuel' => 100,\n"+
+      "  'elvis' => 50,\n"+
+      "  'chris' => 10,\n"+
+      '}\n'+
+      '$Females = {\n'+
+      "  'chris' => 30,\n"+
+      "  'mary' => 100,\n"+
+      '}\n')
+    first_names = self.write_file('first_names.csv',
+      'samuel,1000,0.99,1985,1950,2000,0.1_0.2_0.3\n'+
+      'elvis,200,1.0,1935,1930,1960,0.5_0.1\n')
+    surnames = self.write_file('surnames.csv',
+      'name,rank,count,prop100k,cum_prop100k,pctwhite,pctblack,pctapi,pctaian,pct2prace,pcthispanic\n'+
+      'JACKSON,18,666125,246.93,9999,41.93,53.02,0.31,1.04,2.18,1.53\n'+
+      'PRESLEY,2000,1000,3.5,1,90,5,(S),1,1,2\n')
+    self.file_name = os.path.join(self.directory, 'people.dat')
+    self.assertEqual(6, dstk.compile_people_database(gender_names, first_names,
+      surnames, self.file_name))
+
+  def test_lookup(self):
+    index = dstk.PeopleIndex(self.file_name)
+    try:
+      # As on the server, a name can run on to the next line, so each is looked up
+      # on its own
+      result = [index.text2people(text) for text in ('Elvis Presley', 'Chris Smith',
+        'Dr. Jones', 'Something else')]
+    finally:
+      index.close()
+    self.assertEqual([], result.pop())
+    result = [people[0] for people in result]
+    self.assertEqual(['Elvis Presley', 'Chris Smith', 'Dr. Jones'],
+      [person['matched_string'] for person in result])
+
+    elvis = result[0]
+    self.assertEqual('m', elvis['gender'])
+    self.assertEqual(1.0, elvis['male_percentage'])
+    self.assertEqual([0.5, 0.1], elvis['year_percentages'])
+    self.assertEqual(2000, elvis['ethnicity']['rank'])
+    self.assertEqual(0.0, elvis['ethnicity']['percentage_asian_or_pacific_islander'])
+    self.assertEqual(0, elvis['start_index'])
+
+    chris = result[1]
+    self.assertEqual('f', chris['gender'])
+    self.assertEqual(None, chris['male_percentage'])
+    self.assertEqual(None, chris['ethnicity'])
+
+    doctor = result[2]
+    self.assertEqual('u', doctor['gender'])
+    self.assertEqual('dr', doctor['title'])
+    self.assertEqual('Jones', doctor['surnames'])
+
+class StatisticsIndexTest(LocalIndexTest):
+
+  def setUp(self):
+    LocalIndexTest.setUp(self)
+    # A two by two grid covering 0 to 2 degrees, with the pixels in rows from north
+    # to south and one of them missing
+    self.write_file('elevation.hdr', 'ncols 2\nnrows 2\nxllcorner 0\nyllcorner 0\n'+
+      'cellsize 1\nNODATA_value -9999\nbyteorder LSBFIRST\n')
+    self.write_file('elevation.flt', struct.pack('<4f', 10.7, 20.2, -9999, 40.0))
+
+  def test_lookup(self):
+    index = dstk.StatisticsIndex(self.directory)
+    try:
+      self.assertEqual(['elevation'], index.available_statistics())
+      result = index.lookup_many([[1.5, 0.5], [1.5, 1.5], [0.5, 0.5], [0.5, 1.5],
+        '5,5'])
+    finally:
+      index.close()
+    values = [item['statistics'].get('elevation', {}).get('value') for item in result]
+    self.assertEqual([10, 20, 0, 40, None], values)
+    self.assertEqual('meters', result[0]['statistics']['elevation']['units'])
+    self.assertEqual({'latitude': 5.0, 'longitude': 5.0}, result[4]['location'])
+
+  def test_unknown_statistic(self):
+    index = dstk.StatisticsIndex(self.directory)
+    try:
+      self.assertRaises(Exception, index.lookup_many, [[0.5, 0.5]], ['no_such_thing'])
+      self.assertRaises(Exception, index.lookup_many, [[0.5, 0.5]], ['population'])
+    finally:
+      index.close()
+
+  def test_matches_server_format(self):
+    server, api_base = start_fake_server()
+    client = dstk.DSTK({'apiBase': api_base, 'versionCacheFile': None,
+      'statisticsDirectory': self.directory})
+    try:
+      local = client.coordinates2statistics([[1.5, 0.5]], ['elevation'])
+    finally:
+      client.close()
+      server.shutdown()
+      server.server_close()
+    self.assertEqual([], server.requests)
+    self.assertEqual(10, local[0]['statistics']['elevation']['value'])
+
+if __name__ == '__main__':
+  unittest.main()
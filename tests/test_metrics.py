@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Tests for the per-endpoint metrics that DSTK objects keep, both the histograms on
+# their own and the numbers recorded by calls to the stand-in server in
+# fake_server.py:
+#
+# python test_metrics.py
+
+import json
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+class HistogramTest(unittest.TestCase):
+
+  def make_histogram(self):
+    histogram = dstk.Histogram([1, 2, 5, 10])
+    for value in (0.5, 1, 1.5, 2, 3, 4, 6, 8, 9, 20):
+      histogram.add(value)
+    return histogram
+
+  def test_percentiles(self):
+    histogram = self.make_histogram()
+    self.assertEqual(1, histogram.percentile(10))
+    self.assertEqual(2, histogram.percentile(40))
+    self.assertEqual(5, histogram.percentile(50))
+    self.assertEqual(10, histogram.percentile(90))
+    # Past the last bound, so only the largest value is known
+    self.assertEqual(20, histogram.percentile(99))
+    self.assertEqual(20, histogram.percentile(100))
+
+  def test_percentiles_never_exceed_the_largest_value(self):
+    histogram = dstk.Histogram([1, 2, 5, 10])
+    self.assertEqual(None, histogram.percentile(50))
+    histogram.add(3)
+    self.assertEqual(3, histogram.percentile(50))
+    self.assertEqual(3, histogram.percentile(99))
+
+  def test_snapshot(self):
+    snapshot = self.make_histogram().snapshot()
+    self.assertEqual(10, snapshot['count'])
+    self.assertEqual(55, snapshot['sum'])
+    self.assertEqual(0.5, snapshot['min'])
+    self.assertEqual(20, snapshot['max'])
+    self.assertEqual((5, 10, 20), (snapshot['p50'], snapshot['p90'], snapshot['p99']))
+    self.assertEqual([('1', 2), ('2', 2), ('5', 2), ('10', 3), ('+Inf', 1)],
+      snapshot['buckets'].items())
+
+class DSTKMetricsTest(unittest.TestCase):
+
+  IPS = ['67.169.73.113', '8.8.8.8', '67.169.73.113']
+
+  def setUp(self):
+    self.server, self.api_base = start_fake_server()
+    self.samples = []
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def make_client(self, **options):
+    options['apiBase'] = self.api_base
+    options['metricsCallback'] = lambda endpoint, sample: self.samples.append((endpoint, sample))
+    return dstk.DSTK(options)
+
+  def test_requests(self):
+    client = self.make_client()
+    try:
+      client.ip2coordinates(self.IPS)
+      self.assertRaises(Exception, client.api_call, '/street2coordinates', '')
+      snapshot = client.metrics.snapshot()
+    finally:
+      client.close()
+
+    stats = snapshot['/ip2coordinates']
+    self.assertEqual(1, stats['requests'])
+    self.assertEqual(0, stats['errors'])
+    self.assertEqual(2, stats['items'])
+    self.assertTrue(stats['request_bytes'] > 0)
+    self.assertTrue(stats['response_bytes'] > 0)
+    for name in ('encode_seconds', 'network_seconds', 'decode_seconds'):
+      self.assertEqual(1, stats[name]['count'])
+    self.assertEqual(2, stats['items_per_request']['max'])
+    # Snapshots are plain values that can be logged as JSON
+    self.assertEqual(snapshot, json.loads(json.dumps(snapshot)))
+
+    self.assertEqual(1, snapshot['/street2coordinates']['errors'])
+
+  def test_callback(self):
+    client = self.make_client()
+    try:
+      client.ip2coordinates(self.IPS)
+      self.assertRaises(Exception, client.api_call, '/street2coordinates', '')
+    finally:
+      client.close()
+
+    self.assertEqual(['/ip2coordinates', '/street2coordinates'],
+      [endpoint for endpoint, sample in self.samples])
+    sample = self.samples[0][1]
+    self.assertEqual(['decode_seconds', 'encode_seconds', 'error', 'items',
+      'network_seconds', 'request_bytes', 'response_bytes'], sorted(sample.keys()))
+    self.assertEqual(2, sample['items'])
+    self.assertEqual(None, sample['error'])
+    self.assertTrue('Empty string' in self.samples[1][1]['error'])
+
+  def test_repeats_are_not_cache_hits(self):
+    client = self.make_client()
+    try:
+      client.ip2coordinates(self.IPS)
+      stats = client.metrics.snapshot()['/ip2coordinates']
+    finally:
+      client.close()
+    self.assertEqual(1, stats['dedup_hits'])
+    self.assertEqual(0, stats['cache_hits'])
+    self.assertEqual(0, stats['cache_misses'])
+
+  def test_cache_hits(self):
+    client = self.make_client(memoryCacheSize=10)
+    try:
+      client.ip2coordinates(self.IPS)
+      client.ip2coordinates(self.IPS)
+      stats = client.metrics.snapshot()['/ip2coordinates']
+    finally:
+      client.close()
+    self.assertEqual(1, stats['requests'])
+    self.assertEqual(2, stats['dedup_hits'])
+    self.assertEqual(2, stats['cache_hits'])
+    self.assertEqual(2, stats['cache_misses'])
+
+if __name__ == '__main__':
+  unittest.main()
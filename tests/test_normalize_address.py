@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#
+# Tests for the keys normalize_address makes to spot repeated addresses, and for
+# street2coordinates sending each address only once to the stand-in server in
+# fake_server.py:
+#
+# python test_normalize_address.py
+
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+class NormalizeAddressTest(unittest.TestCase):
+
+  def assertSameKey(self, addresses):
+    keys = [dstk.normalize_address(address) for address in addresses]
+    self.assertEqual([keys[0]] * len(keys), keys, repr(addresses))
+
+  def assertDifferentKeys(self, first, second):
+    self.assertNotEqual(dstk.normalize_address(first), dstk.normalize_address(second))
+
+  def test_case_spacing_and_punctuation(self):
+    self.assertSameKey(['2543 Graystone Place, Simi Valley, CA 93065',
+      '2543  GRAYSTONE PLACE ,Simi   Valley,  CA 93065 ',
+      '2543 Graystone Place., Simi Valley., CA. 93065',
+      '\t2543 graystone place,\nsimi valley, ca 93065'])
+    self.assertSameKey(["O'Farrell Street, San Francisco", 'OFarrell St, San Francisco'])
+
+  def test_abbreviations(self):
+    self.assertSameKey(['2543 Graystone Place, Simi Valley, CA 93065',
+      '2543 Graystone Pl, Simi Valley, CA 93065',
+      '2543 Graystone Pl, Simi Valley, California 93065',
+      '2543 Graystone Pl, Simi Valley, California, 93065'])
+    self.assertSameKey(['400 Duboce Ave #208, San Francisco, CA',
+      '400 Duboce Avenue # 208, San Francisco, California'])
+    self.assertSameKey(['1 Pleasant Rd, Paris, Texas', '1 Pleasant Road, Paris, TX'])
+    self.assertEqual('2543 graystone pl, simi valley, ca 93065',
+      dstk.normalize_address('2543 Graystone Place, Simi Valley, California 93065'))
+
+  def test_different_addresses_stay_apart(self):
+    self.assertDifferentKeys('400 Duboce Ave #208, San Francisco, CA',
+      '400 Duboce Ave #209, San Francisco, CA')
+    self.assertDifferentKeys('123 Main St, Springfield', '1 23 Main St, Springfield')
+    # Directions can mean different streets
+    self.assertDifferentKeys('1 E Street, Boston, MA', '1 East Street, Boston, MA')
+    # Street types and states share abbreviations, so they're only swapped where
+    # each belongs
+    self.assertDifferentKeys('12 Court St, Hartford, CT', '12 Connecticut St, Hartford, CT')
+    self.assertDifferentKeys('5 Mount Rd, Helena, MT', '5 Montana Rd, Helena, MT')
+    self.assertDifferentKeys('1 Main St, Paris, Texas', '1 Main St Paris Texas')
+    # Washington is as likely to be a city as a state
+    self.assertDifferentKeys('1 Main St, Seattle, Washington', '1 Main St, Seattle, WA')
+
+  def test_unusual_input(self):
+    self.assertEqual('', dstk.normalize_address(''))
+    self.assertEqual('', dstk.normalize_address(' ,, .'))
+    self.assertEqual(u'caf\xe9 rd 1, paris', dstk.normalize_address(u'Caf\xe9 Road 1, Paris'))
+
+class DSTKNormalizeTest(unittest.TestCase):
+
+  ADDRESSES = ['2543 Graystone Place, Simi Valley, CA 93065',
+    '2543 graystone pl, simi valley, california 93065',
+    '400 Duboce Ave, San Francisco, CA']
+
+  def setUp(self):
+    self.server, self.api_base = start_fake_server()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def addresses_sent(self, **options):
+    options['apiBase'] = self.api_base
+    client = dstk.DSTK(options)
+    try:
+      result = client.street2coordinates(self.ADDRESSES)
+      sent = client.metrics.snapshot()['/street2coordinates']['items']
+    finally:
+      client.close()
+    # Every original input gets a result of its own
+    self.assertEqual(sorted(self.ADDRESSES), sorted(result.keys()))
+    return result, sent
+
+  def test_variants_are_sent_once(self):
+    result, sent = self.addresses_sent()
+    self.assertEqual(2, sent)
+    self.assertEqual(result[self.ADDRESSES[0]], result[self.ADDRESSES[1]])
+    self.assertFalse(result[self.ADDRESSES[0]] is result[self.ADDRESSES[1]])
+
+  def test_can_be_turned_off(self):
+    result, sent = self.addresses_sent(normalizeAddresses=False)
+    self.assertEqual(3, sent)
+
+if __name__ == '__main__':
+  unittest.main()
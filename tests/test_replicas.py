@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+#
+# Tests for spreading requests across several servers with ReplicaSet, covering
+# failover, hedged requests and deadlines. They run against stand-in servers from
+# fake_server.py, one of which is slowed down to answer after a second:
+#
+# python test_replicas.py
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+# Returns an address that nothing is listening on
+def unused_api_base():
+  listener = socket.socket()
+  listener.bind(('127.0.0.1', 0))
+  port = listener.getsockname()[1]
+  listener.close()
+  return 'http://127.0.0.1:'+str(port)
+
+class ReplicaSetTest(unittest.TestCase):
+
+  def test_spreads_requests(self):
+    replicas = dstk.ReplicaSet(['a', 'b'])
+    used = []
+    for index in range(4):
+      used.append(replicas.run(lambda api_base, handle: api_base))
+    self.assertEqual(2, used.count('a'))
+    self.assertEqual(2, used.count('b'))
+
+  def test_fails_over_and_marks_unhealthy(self):
+    replicas = dstk.ReplicaSet(['bad', 'good'], retry_interval=60)
+
+    def function(api_base, handle):
+      if api_base == 'bad':
+        raise socket.error('Connection refused')
+      return api_base
+
+    for index in range(3):
+      self.assertEqual('good', replicas.run(function))
+    self.assertFalse(replicas.replicas[0].healthy)
+    self.assertTrue(replicas.replicas[1].healthy)
+
+  def test_hedges_slow_requests(self):
+    replicas = dstk.ReplicaSet(['slow', 'fast'], hedge_percentile=50, hedge_min_samples=1)
+    for replica in replicas.replicas:
+      replica.latencies.extend([0.05] * 10)
+    cancelled = []
+
+    def function(api_base, handle):
+      if api_base == 'slow':
+        for index in range(100):
+          if handle.cancelled:
+            cancelled.append(api_base)
+            raise socket.error('Cancelled')
+          time.sleep(0.01)
+      return api_base
+
+    for index in range(2):
+      started = time.time()
+      self.assertEqual('fast', replicas.run(function))
+      self.assertTrue(time.time()-started < 0.5)
+    # The copy sent to the slow replica was abandoned rather than left running
+    time.sleep(0.1)
+    self.assertEqual(['slow'], cancelled)
+    self.assertTrue(replicas.replicas[0].healthy)
+
+  def test_winner_is_left_running(self):
+    replicas = dstk.ReplicaSet(['a', 'b'], hedge_percentile=50, hedge_min_samples=1,
+      deadline=5)
+    for replica in replicas.replicas:
+      replica.latencies.extend([0.05] * 10)
+    # The caller still has to read the winner's body after run returns
+    handle = replicas.run(lambda api_base, handle: handle)
+    self.assertFalse(handle.cancelled)
+
+  def test_no_hedging_without_enough_samples(self):
+    replicas = dstk.ReplicaSet(['a', 'b'], hedge_percentile=50, hedge_min_samples=20)
+    self.assertEqual(None, replicas.hedge_delay())
+
+  def test_deadline(self):
+    replicas = dstk.ReplicaSet(['slow'], deadline=0.2)
+    finished = threading.Event()
+
+    def function(api_base, handle):
+      while not handle.cancelled:
+        time.sleep(0.01)
+      finished.set()
+      raise socket.error('Cancelled')
+
+    started = time.time()
+    try:
+      replicas.run(function)
+      self.fail('Expected the deadline to be hit')
+    except Exception, e:
+      self.assertTrue('deadline' in str(e))
+    self.assertTrue(time.time()-started < 0.5)
+    self.assertTrue(finished.wait(1.0))
+
+class DSTKReplicaTest(unittest.TestCase):
+
+  def setUp(self):
+    self.slow_server, self.slow_api_base = start_fake_server(1.0)
+    self.fast_server, self.fast_api_base = start_fake_server()
+
+  def tearDown(self):
+    for server in (self.slow_server, self.fast_server):
+      server.shutdown()
+      server.server_close()
+
+  def make_client(self, api_bases, **options):
+    options['apiBase'] = ','.join(api_bases)
+    options['versionCacheFile'] = None
+    options['checkVersion'] = False
+    return dstk.DSTK(options)
+
+  def test_hedged_calls_avoid_slow_server(self):
+    client = self.make_client([self.slow_api_base, self.fast_api_base],
+      hedgePercentile=50, hedgeMinSamples=1)
+    try:
+      for replica in client.replicas.replicas:
+        replica.latencies.extend([0.05] * 10)
+      for index in range(4):
+        started = time.time()
+        result = client.text2sentences('Sentence '+str(index)+'.')
+        self.assertEqual({'sentences': 'Sentence '+str(index)+'.'}, result)
+        self.assertTrue(time.time()-started < 0.8)
+    finally:
+      client.close()
+
+  def test_deadline(self):
+    client = self.make_client([self.slow_api_base], deadline=0.2)
+    try:
+      started = time.time()
+      try:
+        client.text2sentences('Too slow.')
+        self.fail('Expected the deadline to be hit')
+      except Exception, e:
+        self.assertTrue('deadline' in str(e))
+      self.assertTrue(time.time()-started < 0.8)
+    finally:
+      client.close()
+
+  # Big responses are still being read after the headers arrive, so they broke
+  # when the winning request was cancelled along with the others
+  def test_large_responses(self):
+    addresses = [str(index)+' Main St, Simi Valley, CA' for index in range(20000)]
+    for options in ({'deadline': 30}, {'hedgePercentile': 50, 'hedgeMinSamples': 1}):
+      client = self.make_client([self.fast_api_base, self.fast_api_base],
+        **options)
+      try:
+        result = client.street2coordinates(addresses)
+      finally:
+        client.close()
+      self.assertEqual(sorted(addresses), sorted(result.keys()))
+
+  def test_fails_over_from_dead_server(self):
+    client = self.make_client([unused_api_base(), self.fast_api_base])
+    try:
+      for index in range(3):
+        result = client.ip2coordinates('67.169.73.11'+str(index))
+        self.assertTrue('67.169.73.11'+str(index) in result)
+      self.assertFalse(client.replicas.replicas[0].healthy)
+    finally:
+      client.close()
+
+if __name__ == '__main__':
+  unittest.main()
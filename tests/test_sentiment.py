@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#
+# Tests for scoring lists of texts with text2sentiment_batch, against the stand-in
+# server in fake_server.py pretending to be both current and older versions:
+#
+# python test_sentiment.py
+
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+import fake_server
+
+TEXTS = ['I love this.', 'I hate this.', 'It is fine.', 'I love this.']
+
+class SentimentBatchTest(unittest.TestCase):
+
+  def setUp(self):
+    self.original_version = fake_server.API_VERSION
+    self.server, self.api_base = fake_server.start_fake_server()
+
+  def tearDown(self):
+    fake_server.API_VERSION = self.original_version
+    self.server.shutdown()
+    self.server.server_close()
+
+  def make_client(self, **options):
+    options['apiBase'] = self.api_base
+    options['versionCacheFile'] = None
+    return dstk.DSTK(options)
+
+  def expected_scores(self):
+    return [{'score': fake_server.text2sentiment_score(unicode(text))} for text in TEXTS]
+
+  def test_batched(self):
+    client = self.make_client()
+    try:
+      self.assertEqual(self.expected_scores(), client.text2sentiment_batch(TEXTS))
+      client.text2sentiment_batch(TEXTS[:2])
+    finally:
+      client.close()
+    # The version from the check before the first request is reused
+    self.assertEqual(1, self.server.requests.count('/info'))
+    self.assertEqual(2, self.server.requests.count('/text2sentiment'))
+
+  def test_old_servers_get_one_text_at_a_time(self):
+    fake_server.API_VERSION = dstk.BATCH_SENTIMENT_VERSION-1
+    client = self.make_client()
+    try:
+      self.assertEqual(self.expected_scores(), client.text2sentiment_batch(TEXTS))
+    finally:
+      client.close()
+    self.assertEqual(1, self.server.requests.count('/info'))
+    # The repeated text is only sent once
+    self.assertEqual(3, self.server.requests.count('/text2sentiment'))
+
+  def test_without_version_check(self):
+    client = self.make_client(checkVersion=False)
+    try:
+      self.assertEqual(self.expected_scores(), client.text2sentiment_batch(TEXTS))
+    finally:
+      client.close()
+    self.assertEqual(0, self.server.requests.count('/info'))
+    self.assertEqual(1, self.server.requests.count('/text2sentiment'))
+
+if __name__ == '__main__':
+  unittest.main()
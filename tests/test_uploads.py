@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# Tests for the streamed multipart bodies that file2text uploads, both on their own
+# and sent to the stand-in server in fake_server.py:
+#
+# python test_uploads.py
+
+import cgi
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+from fake_server import start_fake_server
+
+# Bigger than MultipartBody.CHUNK_SIZE, so it's sent in several pieces
+FILE_DATA = ''.join([chr(index % 256) for index in range(150000)])
+
+def parse_upload(body):
+  data = ''.join(body)
+  environ = {
+    'REQUEST_METHOD': 'POST',
+    'CONTENT_TYPE': body.content_type,
+    'CONTENT_LENGTH': str(len(data)),
+  }
+  return data, cgi.FieldStorage(fp=StringIO.StringIO(data), environ=environ)
+
+class MultipartBodyTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.file_name = os.path.join(self.directory, 'upload.pdf')
+    output = open(self.file_name, 'wb')
+    output.write(FILE_DATA)
+    output.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def check_body(self, body, expected_value):
+    data, form = parse_upload(body)
+    self.assertEqual(len(data), len(body))
+    self.assertEqual('upload.pdf', form['inputfile'].filename)
+    self.assertEqual('application/pdf', form['inputfile'].type)
+    self.assertEqual(expected_value, form['inputfile'].value)
+    self.assertEqual('1', form['version'].value)
+
+  def test_string_value(self):
+    self.check_body(dstk.MultipartBody([('version', '1')],
+      [('inputfile', 'upload.pdf', FILE_DATA)]), FILE_DATA)
+
+  def test_open_file(self):
+    opened_file = open(self.file_name, 'rb')
+    try:
+      body = dstk.MultipartBody([('version', '1')],
+        [('inputfile', 'upload.pdf', opened_file)])
+      self.check_body(body, FILE_DATA)
+      # The file is read again from the same place on a second pass
+      self.check_body(body, FILE_DATA)
+    finally:
+      opened_file.close()
+
+  def test_open_file_part_way_through(self):
+    opened_file = open(self.file_name, 'rb')
+    try:
+      opened_file.seek(1000)
+      self.check_body(dstk.MultipartBody([('version', '1')],
+        [('inputfile', 'upload.pdf', opened_file)]), FILE_DATA[1000:])
+    finally:
+      opened_file.close()
+
+  def test_file_like_object(self):
+    self.check_body(dstk.MultipartBody([('version', '1')],
+      [('inputfile', 'upload.pdf', StringIO.StringIO(FILE_DATA))]), FILE_DATA)
+
+  def test_file_that_shrinks(self):
+    opened_file = open(self.file_name, 'rb')
+    try:
+      body = dstk.MultipartBody([], [('inputfile', 'upload.pdf', opened_file)])
+      open(self.file_name, 'wb').write(FILE_DATA[:100])
+      self.assertRaises(IOError, lambda: ''.join(body))
+    finally:
+      opened_file.close()
+
+class File2TextTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.file_name = os.path.join(self.directory, 'upload.pdf')
+    output = open(self.file_name, 'wb')
+    output.write(FILE_DATA)
+    output.close()
+    self.server, self.api_base = start_fake_server()
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.directory)
+
+  def test_uploads(self):
+    client = dstk.DSTK({'apiBase': self.api_base, 'versionCacheFile': None})
+    try:
+      expected = 'Text from '+self.file_name+' ('+str(len(FILE_DATA))+' bytes)\n'
+      self.assertEqual(expected, client.file2text(self.file_name))
+      self.assertEqual(expected, client.file2text(self.file_name, FILE_DATA))
+      self.assertEqual(expected, client.file2text(self.file_name,
+        StringIO.StringIO(FILE_DATA)))
+      # The connection is still in step with the server afterwards
+      self.assertEqual({'sentences': 'Done.'}, client.text2sentences('Done.'))
+    finally:
+      client.close()
+    self.assertEqual(3, self.server.requests.count('/file2text'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+# Tests for the lazy server version check and the caches that let clients skip it,
+# against the stand-in servers in fake_server.py:
+#
+# python test_version_check.py
+
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+if 'PYTHONPATH' not in os.environ:
+  sys.path.insert(0, os.path.join(os.path.dirname(TESTS_DIR), 'python'))
+
+import dstk
+import fake_server
+
+# Returns the address of a local port with nothing listening on it
+def dead_api_base():
+  listener = socket.socket()
+  listener.bind(('127.0.0.1', 0))
+  port = listener.getsockname()[1]
+  listener.close()
+  return 'http://127.0.0.1:'+str(port)
+
+class VersionCheckTest(unittest.TestCase):
+
+  def setUp(self):
+    dstk.checked_versions.clear()
+    self.original_version = fake_server.API_VERSION
+    self.directory = tempfile.mkdtemp()
+    self.cache_file = os.path.join(self.directory, 'version_cache')
+    self.servers = []
+    self.api_bases = []
+    for index in range(2):
+      server, api_base = fake_server.start_fake_server()
+      self.servers.append(server)
+      self.api_bases.append(api_base)
+
+  def tearDown(self):
+    fake_server.API_VERSION = self.original_version
+    dstk.checked_versions.clear()
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+    shutil.rmtree(self.directory)
+
+  def make_client(self, api_bases, **options):
+    options['apiBase'] = api_bases
+    return dstk.DSTK(options)
+
+  def info_counts(self):
+    return [server.requests.count('/info') for server in self.servers]
+
+  def call(self, client):
+    try:
+      self.assertEqual({'sentences': 'Hello.'}, client.text2sentences('Hello.'))
+      return client.api_version()
+    finally:
+      client.close()
+
+  def test_checked_on_first_request(self):
+    client = self.make_client(self.api_bases[0])
+    self.assertEqual([0, 0], self.info_counts())
+    self.assertEqual(52, self.call(client))
+    self.assertEqual([1, 0], self.info_counts())
+    # Not repeated by other clients in the same process
+    self.call(self.make_client(self.api_bases[0]))
+    self.assertEqual([1, 0], self.info_counts())
+
+  def test_every_replica_is_checked(self):
+    self.call(self.make_client(self.api_bases))
+    self.assertEqual([1, 1], self.info_counts())
+    self.assertEqual(sorted(self.api_bases), sorted(dstk.checked_versions.keys()))
+
+  def test_oldest_replica_version_is_used(self):
+    dstk.checked_versions[self.api_bases[1]] = [time.time(), 51]
+    self.assertEqual(51, self.call(self.make_client(self.api_bases)))
+    # Only the replica that hadn't been checked was asked
+    self.assertEqual([1, 0], self.info_counts())
+
+  def test_unreachable_replica_is_skipped(self):
+    dead = dead_api_base()
+    self.assertEqual(52, self.call(self.make_client([self.api_bases[0], dead])))
+    self.assertFalse(dead in dstk.checked_versions)
+
+    client = self.make_client(dead)
+    try:
+      self.assertRaises(Exception, client.api_version)
+    finally:
+      client.close()
+
+  def test_old_server_is_refused(self):
+    fake_server.API_VERSION = 49
+    client = self.make_client(self.api_bases[0])
+    try:
+      self.assertRaises(Exception, client.text2sentences, 'Hello.')
+    finally:
+      client.close()
+    self.assertEqual(0, self.servers[0].requests.count('/text2sentences'))
+    self.assertEqual({}, dstk.checked_versions)
+
+  def test_ttl(self):
+    dstk.checked_versions[self.api_bases[0]] = [time.time()-30, 52]
+    self.call(self.make_client(self.api_bases[0], versionCacheTTL=60))
+    self.assertEqual([0, 0], self.info_counts())
+
+    dstk.checked_versions[self.api_bases[0]] = [time.time()-90, 52]
+    self.call(self.make_client(self.api_bases[0], versionCacheTTL=60))
+    self.assertEqual([1, 0], self.info_counts())
+
+  def test_no_file_by_default(self):
+    client = self.make_client(self.api_bases[0])
+    self.assertEqual(None, client.version_cache_file)
+    self.call(client)
+
+  def test_cache_file(self):
+    self.call(self.make_client(self.api_bases, versionCacheFile=self.cache_file))
+    self.assertEqual([1, 1], self.info_counts())
+    on_file = json.loads(open(self.cache_file).read())
+    self.assertEqual(sorted(self.api_bases), sorted(on_file.keys()))
+    self.assertEqual(52, on_file[self.api_bases[0]][1])
+
+    # A new process would only have the file to go on
+    dstk.checked_versions.clear()
+    self.assertEqual(52, self.call(self.make_client(self.api_bases,
+      versionCacheFile=self.cache_file)))
+    self.assertEqual([1, 1], self.info_counts())
+
+    # Entries on file expire too
+    dstk.checked_versions.clear()
+    on_file[self.api_bases[1]][0] = time.time()-120
+    open(self.cache_file, 'w').write(json.dumps(on_file))
+    self.call(self.make_client(self.api_bases, versionCacheFile=self.cache_file,
+      versionCacheTTL=60))
+    self.assertEqual([1, 2], self.info_counts())
+
+  def test_unreadable_cache_file(self):
+    for contents in ('not json', json.dumps([1, 2]),
+      json.dumps({self.api_bases[0]: time.time()})):
+      dstk.checked_versions.clear()
+      open(self.cache_file, 'w').write(contents)
+      self.call(self.make_client(self.api_bases[0], versionCacheFile=self.cache_file))
+    self.assertEqual([3, 0], self.info_counts())
+
+if __name__ == '__main__':
+  unittest.main()